@@ -0,0 +1,221 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A synthetic, but hopefully realistic, corpus of the syslog lines that Fastly
+# sends us. Real traffic is dominated by a handful of recent pip versions on a
+# handful of platforms, with a long tail of everything else, so we draw our
+# user agents from a large pool with a skewed (Zipf like) distribution, which
+# also gives our user agent cache a realistic mix of hits and misses.
+
+import itertools
+import json
+import random
+import time
+
+
+COUNTRIES = ["US", "US", "US", "DE", "GB", "CN", "JP", "FR", "IN", "(null)"]
+
+PYTHONS = ["2.7.12", "3.5.2", "3.6.0", "2.6.9", "3.4.5"]
+
+DISTROS = [
+    ("Ubuntu", "16.04", "xenial", "2.23"),
+    ("Ubuntu", "14.04", "trusty", "2.19"),
+    ("CentOS Linux", "7.2.1511", "Core", "2.17"),
+    ("Debian GNU/Linux", "8", "jessie", "2.19"),
+    ("Amazon Linux AMI", "2016.09", "", "2.17"),
+]
+
+SYSTEMS = [
+    ("Linux", "4.4.0-53-generic"),
+    ("Linux", "3.10.0-327.el7.x86_64"),
+    ("Darwin", "16.3.0"),
+    ("Windows", "10"),
+]
+
+
+def _pip_json(rand):
+    version = rand.choice(["9.0.1", "8.1.2", "8.1.1", "7.1.2", "6.1.1"])
+    python = rand.choice(PYTHONS)
+    system, release = rand.choice(SYSTEMS)
+
+    data = {
+        "installer": {"name": "pip", "version": version},
+        "python": python,
+        "implementation": {"name": "CPython", "version": python},
+        "system": {"name": system, "release": release},
+        "cpu": "x86_64",
+    }
+    if system == "Linux":
+        name, distro_version, distro_id, libc = rand.choice(DISTROS)
+        data["distro"] = {
+            "name": name,
+            "version": distro_version,
+            "id": distro_id,
+            "libc": {"lib": "glibc", "version": libc},
+        }
+    if rand.random() < 0.3:
+        data["openssl_version"] = "OpenSSL 1.0.2j  26 Sep 2016"
+
+    return "pip/{} {}".format(
+        version,
+        json.dumps(data, separators=(",", ":"), sort_keys=True),
+    )
+
+
+def _pip_old(rand):
+    return "pip/{} CPython/{} {}/{}".format(
+        rand.choice(["1.5.6", "1.5.4", "1.4.1"]),
+        rand.choice(PYTHONS),
+        *rand.choice(SYSTEMS)
+    )
+
+
+def _conda(rand):
+    return "conda/{} requests/2.12.4 CPython/{} {}/{}".format(
+        rand.choice(["4.3.8", "4.2.13", "4.1.11"]),
+        rand.choice(PYTHONS),
+        *rand.choice(SYSTEMS)
+    )
+
+
+def _setuptools(rand):
+    return "Python-urllib/{} setuptools/{}".format(
+        rand.choice(["2.7", "3.5", "3.6"]),
+        rand.choice(["32.1.0", "28.8.0", "20.1.1"]),
+    )
+
+
+def _browser(rand):
+    return (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/{}.0.{}.{} Safari/537.36".format(
+            rand.randrange(40, 56),
+            rand.randrange(2000, 3000),
+            rand.randrange(100),
+        )
+    )
+
+
+def _ignored(rand):
+    return rand.choice([
+        "Datadog Agent/{}".format(rand.choice(["5.10.1", "5.9.0"])),
+        "Go-http-client/1.1",
+        "Java/1.8.0_{}".format(rand.randrange(100)),
+        "Debian uscan/2.16.{}".format(rand.randrange(10)),
+    ])
+
+
+def _unknown(rand):
+    return "SomeCrawler/{}.{} (+http://example.com/bot)".format(
+        rand.randrange(10),
+        rand.randrange(10),
+    )
+
+
+# How often each kind of user agent shows up in our corpus.
+USER_AGENTS = [
+    (_pip_json, 70),
+    (_pip_old, 8),
+    (_conda, 5),
+    (_setuptools, 5),
+    (_browser, 5),
+    (_ignored, 5),
+    (_unknown, 2),
+]
+
+
+def _user_agents(rand, count):
+    kinds, weights = zip(*USER_AGENTS)
+    pool = [
+        kind(rand)
+        for kind in rand.choices(kinds, weights=weights, k=count)
+    ]
+    # Skew our pool so that a few user agents make up most of our traffic.
+    zipf = list(itertools.accumulate(1 / (i + 1) for i in range(count)))
+    return pool, zipf
+
+
+def _project(rand):
+    # Most project names are short, but every so often we'll get a really long
+    # one, which also makes for a longer url and filename.
+    if rand.random() < 0.05:
+        return "-".join(
+            "".join(rand.choice("abcdefghij") for _ in range(8))
+            for _ in range(rand.randrange(4, 16))
+        )
+    return rand.choice(
+        ["requests", "six", "setuptools", "pip", "numpy", "django", "foo"]
+    )
+
+
+def _file(rand, project):
+    version = "{}.{}.{}".format(
+        rand.randrange(5),
+        rand.randrange(20),
+        rand.randrange(10),
+    )
+    if rand.random() < 0.6:
+        filename = "{}-{}-py2.py3-none-any.whl".format(
+            project.replace("-", "_"),
+            version,
+        )
+        url = "/packages/{}/{}/{}/{}".format(
+            "py2.py3",
+            project[0],
+            project,
+            filename,
+        )
+        return url, version, "bdist_wheel"
+
+    filename = "{}-{}.tar.gz".format(project, version)
+    url = "/packages/source/{}/{}/{}".format(project[0], project, filename)
+    return url, version, "sdist"
+
+
+def corpus(count, *, seed=0, user_agents=2000, start=1483228800):
+    rand = random.Random(seed)
+    pool, zipf = _user_agents(rand, user_agents)
+
+    lines = []
+    for i in range(count):
+        timestamp = start + i * 86400 * 3 // count
+        project = _project(rand)
+        url, version, package_type = _file(rand, project)
+
+        message = "|".join([
+            time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp)),
+            rand.choice(COUNTRIES),
+            url,
+            project,
+            version,
+            package_type,
+            rand.choices(pool, cum_weights=zipf)[0],
+        ])
+        line = "<134>{} cache-{}{} linehaul[411617]: {}".format(
+            time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp)),
+            rand.choice(["iad", "ams", "sjc", "lhr"]),
+            rand.randrange(2000, 2200),
+            message,
+        )
+        lines.append(line.encode("utf8"))
+
+    return lines
+
+
+def messages(lines):
+    # Just the part of each line that comes after the syslog header, which is
+    # what linehaul.parser.parse is given.
+    return [line.decode("utf8").split(": ", 1)[1] for line in lines]
+
+
+def user_agents(lines):
+    return [message.rsplit("|", 1)[1] for message in messages(lines)]
@@ -0,0 +1,184 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+import json
+import random
+import time
+
+import click
+
+from aiohttp import web
+
+from linehaul import bigquery, core, parser
+from linehaul._server import AppServer
+
+
+USER_AGENTS = [
+    "pip/1.5.6 CPython/3.4.3 Linux/3.13.0-74-generic",
+    "pip/1.5.4 CPython/2.7.6 Darwin/14.5.0",
+    "bandersnatch/1.8 (CPython 2.7.6-final0, Linux x86_64)",
+    "Python-urllib/2.7 setuptools/18.0.1",
+] + [
+    "pip/8.0.2 " + json.dumps({
+        "installer": {"name": "pip", "version": "8.0.2"},
+        "python": python,
+        "implementation": {"name": "CPython", "version": python},
+        "distro": {
+            "name": distro,
+            "version": version,
+            "libc": {"lib": "glibc", "version": "2.19"},
+        },
+        "system": {"name": "Linux", "release": "3.13.0-74-generic"},
+        "cpu": "x86_64",
+    })
+    for python in ["2.7.6", "3.4.3", "3.5.1"]
+    for distro, version in [("Ubuntu", "14.04"), ("CentOS Linux", "7.2")]
+]
+
+LINE = (
+    "Mon, 07 Sep 2015 {:02d}:{:02d}:{:02d} GMT|{}|"
+    "/packages/source/{}/{}/{}-{}.tar.gz|{}|{}|sdist|{}"
+)
+
+
+def _corpus(count, seed=0):
+    rand = random.Random(seed)
+    projects = ["project{}".format(i) for i in range(200)]
+
+    rows = []
+    for _ in range(count):
+        project = rand.choice(projects)
+        version = "1.{}".format(rand.randrange(20))
+        line = LINE.format(
+            rand.randrange(24),
+            rand.randrange(60),
+            rand.randrange(60),
+            rand.choice(["US", "DE", "CN", "GB", "JP"]),
+            project[0],
+            project,
+            project,
+            version,
+            project,
+            version,
+            rand.choice(USER_AGENTS),
+        )
+        download = parser.parse(line)
+        rows.append(
+            bigquery.encode_row(
+                core.insert_id(line.encode("utf8")),
+                download.serialize(),
+            )
+        )
+    return rows
+
+
+class _Tokens:
+
+    # Stands in for our token manager, since we don't need real tokens to
+    # talk to our fake endpoint.
+
+    async def add_token(self, url, http_method, headers, body):
+        return url, dict(headers, Authorization="Bearer a token"), body
+
+
+def _app(received):
+
+    async def insert_all(request):
+        received.append(int(request.headers["Content-Length"]))
+        await request.read()
+        return web.json_response(
+            {"kind": "bigquery#tableDataInsertAllResponse"}
+        )
+
+    app = web.Application()
+    app.router.add_route(
+        "POST",
+        "/projects/{project}/datasets/{dataset}/tables/{table}/insertAll",
+        insert_all,
+    )
+    return app
+
+
+async def _send(level, batches, loop):
+    received = []
+
+    async with AppServer(_app(received), "127.0.0.1", 0, loop=loop) as s:
+        port = s.sockets[0].getsockname()[1]
+
+        client = bigquery.BigQueryClient(
+            "project",
+            "dataset",
+            "table",
+            compresslevel=level,
+            streaming_url=(
+                "http://127.0.0.1:" + str(port) +
+                "/projects/{project_id}/datasets/{dataset_id}/"
+                "tables/{table_id}/insertAll"
+            ),
+        )
+        client.tokens = _Tokens()
+
+        with client() as session:
+            start = time.perf_counter()
+            cpu = time.process_time()
+            for batch in batches:
+                await session.insert_all(batch)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+
+    return sum(received), elapsed, cpu
+
+
+def _compress_cost(level, batches):
+    bodies = [bigquery.encode_request(batch) for batch in batches]
+
+    start = time.process_time()
+    for body in bodies:
+        gzip.compress(body, level)
+    return time.process_time() - start
+
+
+@click.command()
+@click.option("--rows", type=int, default=20000)
+@click.option("--batch-size", type=int, default=500)
+def main(rows, batch_size):
+    corpus = _corpus(rows)
+    batches = [
+        corpus[i:i + batch_size] for i in range(0, len(corpus), batch_size)
+    ]
+    loop = asyncio.new_event_loop()
+
+    try:
+        for level in [None, 1, 6, 9]:
+            sent, elapsed, cpu = loop.run_until_complete(
+                _send(level, batches, loop)
+            )
+            compress = _compress_cost(level, batches) if level else 0.0
+
+            click.echo(
+                "gzip {:<4} {:>8.1f} bytes/row {:>8.2f} compress us/row "
+                "{:>8.2f} cpu us/row {:>10,.0f} rows/sec".format(
+                    "off" if level is None else level,
+                    sent / rows,
+                    compress / rows * 1e6,
+                    cpu / rows * 1e6,
+                    rows / elapsed,
+                )
+            )
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import tracemalloc
+
+import click
+
+from linehaul.syslog.protocol import LineProtocol
+
+
+class SplitLineProtocol:
+
+    # The way that LineProtocol used to frame lines, which we use as our
+    # baseline to compare against.
+
+    delimiter = b"\n"
+
+    def __init__(self):
+        self._buffer = b""
+        self.count = 0
+
+    def data_received(self, data):
+        lines = (self._buffer + data).split(self.delimiter)
+        self._buffer = lines.pop(-1)
+        for line in lines:
+            self.line_received(line)
+
+    def line_received(self, line):
+        self.count += 1
+
+
+class CountingLineProtocol(LineProtocol):
+
+    delimiter = b"\n"
+
+    count = 0
+
+    def line_received(self, line):
+        self.count += 1
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def _run(protocol, chunks):
+    start = time.perf_counter()
+    for chunk in chunks:
+        protocol.data_received(chunk)
+    return protocol.count / (time.perf_counter() - start)
+
+
+def _memory(protocol, chunks):
+    tracemalloc.start()
+    try:
+        for chunk in chunks:
+            protocol.data_received(chunk)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _current():
+    protocol = CountingLineProtocol()
+    protocol.connection_made(None)
+    return protocol
+
+
+@click.command()
+@click.option("--lines", type=int, default=100000)
+def main(lines):
+    scenarios = [
+        ("300B lines, 64KB reads", b"x" * 299 + b"\n", lines, 64 * 1024),
+        ("60KB lines, 512B reads", b"x" * 60000 + b"\n", lines // 1000, 512),
+    ]
+
+    for name, line, count, size in scenarios:
+        chunks = _chunks(line * count, size)
+
+        for impl, factory in [
+                ("split", SplitLineProtocol),
+                ("current", _current)]:
+            click.echo(
+                "{:<24} {:<10} {:>12,.0f} lines/sec {:>10,} peak bytes".format(
+                    name,
+                    impl,
+                    _run(factory(), chunks),
+                    _memory(factory(), chunks),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import random
+import time
+
+import click
+
+from linehaul import parser
+
+
+LINE = (
+    "Mon, 07 Sep 2015 {:02d}:{:02d}:{:02d} GMT|US|"
+    "/packages/source/f/foo/foo-1.{}.tar.gz|foo|1.{}|sdist|"
+    "pip/1.5.6 CPython/3.5.1 Darwin/15.2.0"
+)
+
+
+def _corpus(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        LINE.format(
+            rand.randrange(24),
+            rand.randrange(60),
+            rand.randrange(60),
+            rand.randrange(100),
+            rand.randrange(100),
+        )
+        for _ in range(count)
+    ]
+
+
+def _run(func, lines):
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--lines", type=int, default=20000)
+def main(lines):
+    corpus = _corpus(lines)
+
+    for name, decoder in sorted(parser.ENGINES.items()):
+        click.echo(
+            "decode {:<10} {:>12,.0f} lines/sec".format(
+                name,
+                _run(decoder, corpus),
+            )
+        )
+
+    for name in sorted(parser.ENGINES):
+        click.echo(
+            "parse  {:<10} {:>12,.0f} lines/sec".format(
+                name,
+                _run(functools.partial(parser.parse, engine=name), corpus),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks every stage of our pipeline, from syslog framing all the way to
+# building batches for BigQuery, against the same synthetic corpus, and writes
+# the results out as JSON so that different runs can be compared.
+
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import click
+
+from linehaul import core, parser, user_agents
+from linehaul._limiter import AIMDLimiter
+from linehaul._queue import CloseableFlowControlQueue
+from linehaul.syslog import parser as syslog_parser
+
+from ._corpus import corpus as _corpus, messages, user_agents as _uas
+
+
+class NullBigQuery:
+
+    def __init__(self):
+        self.rows = 0
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    async def insert_all(self, rows, template_suffix=None,
+                         skip_invalid_rows=False):
+        self.rows += len(rows)
+
+
+class Transport:
+
+    def __init__(self):
+        self.paused = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+def _each(func, items):
+    for item in items:
+        try:
+            func(item)
+        except ValueError:
+            pass
+    return len(items)
+
+
+def _uncached_user_agents(uas):
+    return _each(user_agents.Parser.parse, uas)
+
+
+def _cached_user_agents(uas):
+    user_agents.cache.clear()
+    return _each(user_agents.parse, uas)
+
+
+def _downloads(msgs):
+    downloads = []
+    for message in msgs:
+        try:
+            download = parser.parse(message)
+        except ValueError:
+            continue
+        if download is not None:
+            downloads.append((message.encode("utf8"), download))
+    return downloads
+
+
+def _encode(line, download):
+    return core._encode(download, core.insert_id(line))
+
+
+def _serialize(downloads):
+    for line, download in downloads:
+        _encode(line, download)
+    return len(downloads)
+
+
+def _send(rows):
+    loop = asyncio.new_event_loop()
+    try:
+        queue = CloseableFlowControlQueue()
+        for row in rows:
+            queue.put_nowait(row)
+        queue.close()
+
+        loop.run_until_complete(
+            core.send(
+                NullBigQuery(),
+                queue,
+                limiter=AIMDLimiter(loop=loop),
+                max_rows=core.BATCH_SIZE,
+                max_bytes=core.BATCH_BYTES,
+                loop=loop,
+            )
+        )
+    finally:
+        loop.close()
+
+    return len(rows)
+
+
+async def _feed(lines, *, loop, chunk_size):
+    bq = NullBigQuery()
+    batcher = core.Batcher(bq, loop=loop)
+    protocol = core.LinehaulProtocol(batcher=batcher, token="tok", loop=loop)
+    transport = Transport()
+
+    protocol.connection_made(transport)
+
+    # Mimic what a transport does, including stopping whenever our protocol
+    # asks us to stop reading.
+    data = b"".join(b"tok" + line + b"\n" for line in lines)
+    for i in range(0, len(data), chunk_size):
+        while transport.paused:
+            await asyncio.sleep(0)
+
+        protocol.data_received(data[i:i + chunk_size])
+
+        await asyncio.sleep(0)
+
+    protocol.connection_lost(None)
+    await batcher.wait_closed()
+
+    return bq.rows
+
+
+def _end_to_end(lines):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        user_agents.cache.clear()
+
+        # Our protocol prints every line that it fails to parse, which isn't
+        # something we want to see in our results.
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            return loop.run_until_complete(
+                _feed(lines, loop=loop, chunk_size=64 * 1024)
+            )
+    finally:
+        loop.close()
+
+
+def _time(func, arg, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func(arg)
+        runs.append(count / (time.perf_counter() - start))
+    return {"count": count, "best": max(runs), "runs": runs}
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL,
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option("--lines", type=int, default=50000)
+@click.option("--repeat", type=click.IntRange(1), default=3)
+@click.option("--seed", type=int, default=0)
+@click.option("--output", type=click.File("w"), default="-")
+@click.option("--compare", type=click.File("r"))
+def main(lines, repeat, seed, output, compare):
+    corpus = _corpus(lines, seed=seed)
+    msgs = messages(corpus)
+    downloads = _downloads(msgs)
+    rows = [_encode(line, download) for line, download in downloads]
+
+    benchmarks = [
+        ("syslog.parse", "lines/sec",
+         lambda ls: _each(syslog_parser.parse, ls),
+         [line.decode("utf8") for line in corpus]),
+        ("parser.parse", "lines/sec",
+         lambda ms: _each(parser.parse, ms), msgs),
+        ("user_agents.parse.uncached", "uas/sec",
+         _uncached_user_agents, _uas(corpus)),
+        ("user_agents.parse", "uas/sec", _cached_user_agents, _uas(corpus)),
+        ("serialize", "rows/sec", _serialize, downloads),
+        ("send", "rows/sec", _send, rows),
+        ("end_to_end", "events/sec", _end_to_end, corpus),
+    ]
+
+    results = {
+        "meta": {
+            "timestamp": time.time(),
+            "revision": _revision(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "lines": lines,
+            "seed": seed,
+            "repeat": repeat,
+            "mean_line_length": sum(map(len, corpus)) / len(corpus),
+            "max_line_length": max(map(len, corpus)),
+        },
+        "benchmarks": {},
+    }
+
+    previous = json.load(compare)["benchmarks"] if compare else {}
+
+    for name, unit, func, arg in benchmarks:
+        result = _time(func, arg, repeat)
+        result["unit"] = unit
+        results["benchmarks"][name] = result
+
+        line = "{:<28} {:>12,.0f} {}".format(name, result["best"], unit)
+        if name in previous:
+            line += " ({:+.1%})".format(
+                result["best"] / previous[name]["best"] - 1,
+            )
+        click.echo(line, err=True)
+
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
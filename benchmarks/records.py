@@ -0,0 +1,128 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import tracemalloc
+
+import click
+
+from linehaul import parser
+from linehaul._records import Record
+from linehaul.user_agents import UserAgent
+
+try:
+    import pyrsistent
+except ImportError:
+    pyrsistent = None
+
+
+DATA = {
+    "timestamp": "Mon, 07 Sep 2015 01:53:44 GMT",
+    "country_code": "US",
+    "url": "/packages/source/f/foo/foo-1.0.tar.gz",
+    "file": {
+        "filename": "foo-1.0.tar.gz",
+        "project": "foo",
+        "version": "1.0",
+        "type": "sdist",
+    },
+    "details": {
+        "installer": {"name": "pip", "version": "8.0.2"},
+        "python": "3.5.1",
+        "implementation": {"name": "CPython", "version": "3.5.1"},
+        "distro": {
+            "name": "Ubuntu",
+            "version": "14.04",
+            "id": "trusty",
+            "libc": {"lib": "glibc", "version": "2.19"},
+        },
+        "system": {"name": "Linux", "release": "3.13.0"},
+        "cpu": "x86_64",
+    },
+}
+
+
+def _as_precord(cls, _seen={}):
+    # Build a pyrsistent.PRecord with the same fields as one of our records,
+    # this is what we used prior to linehaul._records and we use it as our
+    # baseline to compare against.
+    if cls not in _seen:
+        fields = {}
+        for name, f in cls._fields.items():
+            types = tuple(
+                _as_precord(t) if issubclass(t, Record) else t
+                for t in f.type
+            )
+            kwargs = {"type": types, "mandatory": f.mandatory}
+            if len(types) == 1 and issubclass(f.type[0], Record):
+                kwargs["factory"] = types[0].create
+            elif f.factory is not None:
+                kwargs["factory"] = f.factory
+            if f.serializer is not None:
+                kwargs["serializer"] = f.serializer
+            fields[name] = pyrsistent.field(**kwargs)
+        _seen[cls] = type(cls.__name__, (pyrsistent.PRecord,), fields)
+    return _seen[cls]
+
+
+def _records(download, details, count):
+    return [
+        download.create(dict(DATA, details=details.create(DATA["details"])))
+        for _ in range(count)
+    ]
+
+
+def _throughput(download, details, count):
+    start = time.perf_counter()
+    for record in _records(download, details, count):
+        record.serialize()
+    return count / (time.perf_counter() - start)
+
+
+def _memory(download, details, count):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        records = _records(download, details, count)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del records
+    return (after - before) / count
+
+
+@click.command()
+@click.option("--events", type=int, default=20000)
+def main(events):
+    implementations = [("records", parser.Download, UserAgent)]
+    if pyrsistent is not None:
+        implementations.insert(
+            0,
+            (
+                "pyrsistent",
+                _as_precord(parser.Download),
+                _as_precord(UserAgent),
+            ),
+        )
+
+    for name, download, details in implementations:
+        click.echo(
+            "{:<10} {:>12,.0f} events/sec {:>8,.0f} bytes/event".format(
+                name,
+                _throughput(download, details, events),
+                _memory(download, details, events),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import time
+
+import click
+
+from linehaul.syslog import parser
+
+
+LINE = (
+    "<134>2015-09-07T{:02d}:{:02d}:{:02d}Z cache-iad21{:02d} "
+    "linehaul[411617]: "
+    "Mon, 07 Sep 2015 01:53:44 GMT|US|/packages/source/f/foo/foo-1.0.tar.gz|"
+    "foo|1.0|sdist|pip/7.1.2 {{\"installer\":{{\"name\":\"pip\"}}}}"
+)
+
+
+def _corpus(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        LINE.format(
+            rand.randrange(24),
+            rand.randrange(60),
+            rand.randrange(60),
+            rand.randrange(100),
+        )
+        for _ in range(count)
+    ]
+
+
+def _run(func, lines):
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--lines", type=int, default=20000)
+def main(lines):
+    corpus = _corpus(lines)
+
+    before = _run(parser._parse_grammar, corpus)
+    after = _run(parser.parse, corpus)
+
+    click.echo("pyparsing: {:>12,.0f} lines/sec".format(before))
+    click.echo("fast:      {:>12,.0f} lines/sec".format(after))
+    click.echo("speedup:   {:>12.1f}x".format(after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# An admin server for looking at what a running daemon is doing, without
+# having to restart it under a profiler and losing whatever state it was in.
+# Everything it returns can be opened with standard tools:
+#
+#   GET  /debug/profile?seconds=N            Folded stacks, for flamegraph.pl
+#                                            or speedscope.
+#   GET  /debug/profile?seconds=N&format=pstats
+#                                            cProfile output, for pstats or
+#                                            snakeviz.
+#   POST /debug/memory/start?frames=N        Start tracing allocations.
+#   POST /debug/memory/stop                  Stop tracing allocations.
+#   GET  /debug/memory?limit=N&group=lineno  Top allocators, and our queues.
+#   GET  /debug/memory/snapshot              A tracemalloc.Snapshot file.
+#   GET  /debug/queues                       The size of our queues, as JSON.
+
+import asyncio
+import cProfile
+import collections
+import functools
+import marshal
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+from aiohttp import web
+
+from ._server import AppServer
+
+
+MAX_PROFILE_SECONDS = 300
+
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+def _stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            "{} ({}:{})".format(
+                code.co_name,
+                code.co_filename,
+                code.co_firstlineno,
+            )
+        )
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample(thread_id, seconds, *, interval=0.005):
+    # A very simple sampling profiler, that looks at what the given thread is
+    # doing every so often from another thread. Unlike cProfile this doesn't
+    # slow down the thread being profiled, but it does need to grab the GIL
+    # for every sample.
+    samples = collections.Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[_stack(frame)] += 1
+        del frame
+
+        time.sleep(interval)
+
+    return samples
+
+
+def _attachment(body, filename):
+    return web.Response(
+        body=body,
+        content_type="application/octet-stream",
+        headers={
+            "Content-Disposition": 'attachment; filename="{}"'.format(
+                filename,
+            ),
+        },
+    )
+
+
+def _query(request):
+    # Older versions of aiohttp call this request.GET, and newer ones call it
+    # request.query, but they both give us the raw query string.
+    return dict(urllib.parse.parse_qsl(request.query_string))
+
+
+def _int(request, name, default):
+    try:
+        return int(_query(request).get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(
+            text="{} must be an integer\n".format(name),
+        ) from None
+
+
+class Admin:
+
+    def __init__(self, *, linehaul=None, batcher=None, rollup=None,
+                 loop=None):
+        self.linehaul = linehaul
+        self.batcher = batcher
+        self.rollup = rollup
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self._profiling = False
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("GET", "/debug/profile", self.profile)
+        app.router.add_route("GET", "/debug/memory", self.memory)
+        app.router.add_route("POST", "/debug/memory/start", self.memory_start)
+        app.router.add_route("POST", "/debug/memory/stop", self.memory_stop)
+        app.router.add_route(
+            "GET",
+            "/debug/memory/snapshot",
+            self.memory_snapshot,
+        )
+        app.router.add_route("GET", "/debug/queues", self.queues)
+        return app
+
+    def queue_sizes(self):
+        data = {"connections": []}
+
+        if self.linehaul is not None:
+            data["connections"] = [
+                protocol.queue_sizes() for protocol in self.linehaul.protocols
+            ]
+
+        if self.batcher is not None:
+            data["batcher"] = self.batcher.queue_sizes()
+
+        if self.rollup is not None:
+            data["rollup"] = self.rollup.queue_sizes()
+
+        return data
+
+    async def profile(self, request):
+        try:
+            seconds = float(_query(request).get("seconds", 30))
+        except ValueError:
+            raise web.HTTPBadRequest(
+                text="seconds must be a number\n",
+            ) from None
+
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise web.HTTPBadRequest(
+                text="seconds must be between 0 and {}\n".format(
+                    MAX_PROFILE_SECONDS,
+                ),
+            )
+
+        format = _query(request).get("format", "collapsed")
+        if format not in {"collapsed", "pstats"}:
+            raise web.HTTPBadRequest(
+                text="format must be one of collapsed or pstats\n",
+            )
+
+        # Two profiles running at once would just get in each other's way.
+        if self._profiling:
+            raise web.HTTPConflict(text="A profile is already running\n")
+
+        self._profiling = True
+        try:
+            if format == "pstats":
+                # A cProfile.Profile only profiles the thread that enabled it,
+                # which is the thread that our event loop, and so everything
+                # else we do, is running in.
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profile.disable()
+
+                # This is exactly what Profile.dump_stats writes to a file.
+                profile.create_stats()
+                return _attachment(
+                    marshal.dumps(profile.stats),
+                    "linehaul.pstats",
+                )
+            else:
+                samples = await self.loop.run_in_executor(
+                    None,
+                    functools.partial(sample, threading.get_ident(), seconds),
+                )
+                return _attachment(
+                    "".join(
+                        "{} {}\n".format(stack, count)
+                        for stack, count in samples.most_common()
+                    ).encode("utf8"),
+                    "linehaul.collapsed",
+                )
+        finally:
+            self._profiling = False
+
+    def _snapshot(self):
+        if not tracemalloc.is_tracing():
+            raise web.HTTPConflict(
+                text="Not tracing, POST to /debug/memory/start first\n",
+            )
+
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    async def memory(self, request):
+        limit = _int(request, "limit", 25)
+        group = _query(request).get("group", "lineno")
+        if group not in {"filename", "lineno", "traceback"}:
+            raise web.HTTPBadRequest(
+                text="group must be one of filename, lineno, or traceback\n",
+            )
+
+        stats = self._snapshot().statistics(group)
+
+        lines = ["Top {} allocators by {}:".format(limit, group), ""]
+        for stat in stats[:limit]:
+            lines.append(str(stat))
+            if group == "traceback":
+                lines.extend(
+                    "    " + line for line in stat.traceback.format()
+                )
+        lines.extend([
+            "",
+            "Total traced: {:.1f} KiB".format(
+                sum(stat.size for stat in stats) / 1024,
+            ),
+            "",
+            "Queues:",
+            "",
+        ])
+
+        sizes = self.queue_sizes()
+        for stage in ["batcher", "rollup"]:
+            for key, value in sorted(sizes.get(stage, {}).items()):
+                lines.append("{} {}: {}".format(stage, key, value))
+        for connection in sizes["connections"]:
+            lines.append(
+                " ".join(
+                    "{}={}".format(key, value)
+                    for key, value in sorted(connection.items())
+                )
+            )
+
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def memory_start(self, request):
+        frames = _int(request, "frames", 1)
+        if tracemalloc.is_tracing():
+            raise web.HTTPConflict(text="Already tracing\n")
+
+        tracemalloc.start(frames)
+        return web.Response(text="Tracing\n")
+
+    async def memory_stop(self, request):
+        tracemalloc.stop()
+        return web.Response(text="Stopped\n")
+
+    async def memory_snapshot(self, request):
+        snapshot = self._snapshot()
+
+        # Snapshots can only be written out to a file, and can be large, so
+        # we'll do that in a thread.
+        fd, path = tempfile.mkstemp(prefix="linehaul-", suffix=".tracemalloc")
+        os.close(fd)
+        try:
+            await self.loop.run_in_executor(None, snapshot.dump, path)
+            with open(path, "rb") as fp:
+                body = fp.read()
+        finally:
+            os.unlink(path)
+
+        return _attachment(body, "linehaul.tracemalloc")
+
+    async def queues(self, request):
+        return web.json_response(self.queue_sizes())
+
+
+async def start(admin, bind, port, *, loop=None):
+    server = AppServer(admin.app(), bind, port, loop=loop)
+    await server.__aenter__()
+    return server
+
+
+async def stop(server):
+    await server.__aexit__(None, None, None)
@@ -0,0 +1,107 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import weakref
+
+from . import _metrics as m
+
+
+# Every cache that exists in this process, so that we can collect their stats.
+_caches = weakref.WeakSet()
+
+
+class LRUCache:
+
+    # Our hits, misses, and evictions are only counted here, rather than going
+    # straight into our metrics, since we might be living in one of the
+    # processes in our parsing pool, where nobody will ever see our metrics.
+    # Instead they're collected with take_stats, and then handed to
+    # record_stats in whichever process is exporting our metrics.
+
+    def __init__(self, maxsize, *, name):
+        self.name = name
+
+        self._data = collections.OrderedDict()
+        self._maxsize = maxsize
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        self._maxsize = value
+        self._evict()
+
+    def _evict(self):
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+            self._evictions += 1
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self._misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self._hits += 1
+
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._evict()
+
+    def clear(self):
+        self._data.clear()
+
+    def take_stats(self):
+        stats = (self._hits, self._misses, self._evictions)
+        self._hits = self._misses = self._evictions = 0
+        return stats
+
+
+def take_stats():
+    # Returns the hits, misses, and evictions of every cache in this process
+    # since the last time that we were called.
+    stats = []
+    for cache in list(_caches):
+        hits, misses, evictions = cache.take_stats()
+        if hits or misses or evictions:
+            stats.append((cache.name, hits, misses, evictions))
+    return stats
+
+
+def record_stats(stats):
+    for name, hits, misses, evictions in stats:
+        if hits:
+            m.CACHE_HITS.labels(name).inc(hits)
+        if misses:
+            m.CACHE_MISSES.labels(name).inc(misses)
+        if evictions:
+            m.CACHE_EVICTIONS.labels(name).inc(evictions)
@@ -18,11 +18,22 @@ import inspect
 import click
 
 
+# These used to only be available as class methods on Task, which newer
+# versions of Python have since removed in favor of these functions.
+_current_task = getattr(asyncio, "current_task", None)
+if _current_task is None:
+    _current_task = asyncio.Task.current_task
+
+_all_tasks = getattr(asyncio, "all_tasks", None)
+if _all_tasks is None:
+    _all_tasks = asyncio.Task.all_tasks
+
+
 async def cleanup(loop, *, timeout=None, cancel=False):
-    current_task = asyncio.Task.current_task(loop=loop)
+    current_task = _current_task(loop=loop)
     tasks = [
-        t for t in asyncio.Task.all_tasks(loop=loop)
-        if t is not current_task
+        t for t in _all_tasks(loop=loop)
+        if t is not current_task and not t.done()
     ]
 
     if tasks:
@@ -30,7 +41,47 @@ async def cleanup(loop, *, timeout=None, cancel=False):
             for task in tasks:
                 task.cancel()
 
-        await asyncio.wait(tasks, timeout=timeout, loop=loop)
+        await asyncio.wait(tasks, timeout=timeout)
+
+
+def run(coro, *, loop):
+    main_t = asyncio.ensure_future(coro, loop=loop)
+
+    try:
+        try:
+            loop.run_until_complete(main_t)
+        except KeyboardInterrupt:
+            main_t.cancel()
+            # This won't actually run forever because the call to
+            # loop.run_until_complete added a callback to the future that will
+            # stop the loop once main_t has finished and return control back
+            # to this function.
+            loop.run_forever()
+
+        # Try to clean up all of the tasks by waiting for any existing tasks
+        # to finish. Ideally the main function triggered everything to try and
+        # finish up and exit on it's own. However, if it hadn't then we'll
+        # cancel everything after we wait a small amount of time.
+        cleanup_t = asyncio.ensure_future(
+            cleanup(loop, timeout=15),
+            loop=loop,
+        )
+        try:
+            loop.run_until_complete(cleanup_t)
+        except KeyboardInterrupt:
+            # We got another KeyboardInterrupt while waiting on the pending
+            # tasks to finish. We'll cancel that cleanup job and let
+            # everything fall through to the final cleanup that just cancels
+            # everything.
+            cleanup_t.cancel()
+            # Like above, this will not actually run forever because of
+            # callback added to the cleanup_t task.
+            loop.run_forever()
+    finally:
+        # Just cancel everything at this point, we don't want anything to
+        # still be executing once this is over.
+        loop.run_until_complete(cleanup(loop, cancel=True))
+        loop.stop()
 
 
 class AsyncCommand(click.Command):
@@ -47,52 +98,32 @@ class AsyncCommand(click.Command):
 
             @functools.wraps(original_callback)
             def wrapper(*args, **kwargs):
-                loop = asyncio.get_event_loop()
-                main_t = asyncio.ensure_future(
+                run(
                     original_callback(*args, **kwargs),
-                    loop=loop,
+                    loop=asyncio.get_event_loop(),
                 )
 
-                try:
-                    try:
-                        loop.run_until_complete(main_t)
-                    except KeyboardInterrupt:
-                        main_t.cancel()
-                        # This won't actually run forever because the call to
-                        # loop.run_until_complete added a callback to the
-                        # future that will stop the loop once main_t has
-                        # finished and return control back to this function.
-                        loop.run_forever()
-
-                    # Try to clean up all of the tasks by waiting for any
-                    # existing tasks to finish. Ideally the main function
-                    # triggered everything to try and finish up and exit on
-                    # it's own. However, if it hadn't then we'll cancel
-                    # everything after we wait a small amount of time.
-                    cleanup_t = asyncio.ensure_future(
-                        cleanup(loop, timeout=15),
-                        loop=loop,
-                    )
-                    try:
-                        loop.run_until_complete(cleanup_t)
-                    except KeyboardInterrupt:
-                        # We got another KeyboardInterrupt while waiting on the
-                        # pending tasks to finish. We'll cancel that cleanup
-                        # job and let everything fall through to the final
-                        # cleanup that just cancels everything.
-                        cleanup_t.cancel()
-                        # Like above, this will not actually run forever
-                        # because of callback added to the cleanup_t task.
-                        loop.run_forever()
-                finally:
-                    # Just cancel everything at this point, we don't want
-                    # anything to still be executing once this is over.
-                    loop.run_until_complete(cleanup(loop, cancel=True))
-                    loop.stop()
-
             self.callback = wrapper
 
     def make_context(self, *args, **kwargs):
         ctx = super().make_context(*args, **kwargs)
         ctx.event_loop = asyncio.get_event_loop()
         return ctx
+
+
+class DefaultGroup(click.Group):
+
+    # A group that falls back to one of its commands when it isn't given the
+    # name of one, so that adding subcommands doesn't break any existing
+    # invocations of what used to be a single command.
+
+    def __init__(self, *args, default, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default = default
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and
+                        args[0] not in ctx.help_option_names):
+            args = [self.default] + list(args)
+
+        return super().parse_args(ctx, args)
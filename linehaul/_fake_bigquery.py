@@ -0,0 +1,187 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A local stand in for the parts of Google's APIs that we talk to (the OAuth2
+# token endpoint and BigQuery's insertAll), for load testing. It can be made
+# to be slow, to fail, and to reject some of the rows that it's sent, the same
+# ways that the real thing does.
+
+import asyncio
+import collections
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+from . import bigquery
+from ._loadgen import LOADGEN_PROJECT
+
+
+def _error(status, reason, message):
+    return web.json_response(
+        {
+            "error": {
+                "code": status,
+                "message": message,
+                "errors": [{"reason": reason, "message": message}],
+            },
+        },
+        status=status,
+    )
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+class FakeBigQuery:
+
+    def __init__(self, *, latency=0.0, jitter=0.0, error_rate=0.0,
+                 quota_rate=0.0, row_error_rate=0.0, invalid_row_rate=0.0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.row_error_rate = row_error_rate
+        self.invalid_row_rate = invalid_row_rate
+
+        self.random = random.Random(seed)
+        self.stats = collections.Counter()
+
+        # How long it took for each of the rows sent to us by our load
+        # generator to make it here, since the last time we were asked.
+        self.latencies = []
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("POST", bigquery.TOKEN_PATH, self.token)
+        app.router.add_route(
+            "POST",
+            bigquery.STREAMING_PATH.format(
+                project_id="{project_id}",
+                dataset_id="{dataset_id}",
+                table_id="{table_id}",
+            ),
+            self.insert_all,
+        )
+        app.router.add_route("GET", "/stats", self.get_stats)
+        return app
+
+    async def token(self, request):
+        await request.read()
+        self.stats["tokens"] += 1
+
+        return web.json_response(
+            {
+                "access_token": uuid.uuid4().hex,
+                "token_type": "Bearer",
+                "expires_in": 3600,
+            },
+        )
+
+    async def insert_all(self, request):
+        # aiohttp takes care of decompressing our request for us, if it was
+        # compressed, so what we read isn't what was sent over the wire.
+        body = await request.read()
+        self.stats["requests"] += 1
+        self.stats["bytes"] += request.content_length or len(body)
+
+        rows = json.loads(body.decode("utf8"))["rows"]
+
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+        # Whole requests fail either because something went wrong on Google's
+        # side, or because we're sending more than our quota allows.
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            return _error(500, "backendError", "Backend Error")
+        elif roll < self.error_rate + self.quota_rate:
+            self.stats["quota_errors"] += 1
+            return _error(403, "quotaExceeded", "Quota exceeded")
+
+        insert_errors = []
+        now = time.time()
+        for index, row in enumerate(rows):
+            roll = self.random.random()
+            if roll < self.row_error_rate:
+                reason = "backendError"
+            elif roll < self.row_error_rate + self.invalid_row_rate:
+                reason = "invalid"
+            else:
+                self.stats["rows"] += 1
+                self._observe(row["json"], now)
+                continue
+
+            self.stats["row_errors"] += 1
+            insert_errors.append(
+                {"index": index, "errors": [{"reason": reason}]}
+            )
+
+        response = {"kind": "bigquery#tableDataInsertAllResponse"}
+        if insert_errors:
+            response["insertErrors"] = insert_errors
+        return web.json_response(response)
+
+    def _observe(self, row, now):
+        # Our load generator stamps every line that it sends with the time
+        # that it sent it, so we can tell how long it took to get here.
+        file = row.get("file", {})
+        if file.get("project") == LOADGEN_PROJECT:
+            try:
+                self.latencies.append(now - float(file["version"]))
+            except (KeyError, ValueError):
+                pass
+
+    def snapshot(self):
+        latencies, self.latencies = self.latencies, []
+        return dict(
+            self.stats,
+            latency_p50=_percentile(latencies, 0.5),
+            latency_p99=_percentile(latencies, 0.99),
+            latency_p999=_percentile(latencies, 0.999),
+            latency_max=max(latencies) if latencies else None,
+        )
+
+    async def get_stats(self, request):
+        return web.json_response(self.snapshot())
+
+
+async def report(fake, *, interval, echo):
+    last = collections.Counter()
+    while True:
+        await asyncio.sleep(interval)
+
+        stats = fake.snapshot()
+        rows = stats.get("rows", 0) - last["rows"]
+        requests = stats.get("requests", 0) - last["requests"]
+        last.update({"rows": rows, "requests": requests})
+
+        echo(
+            "{:>10,.0f} rows/sec {:>8,.1f} requests/sec "
+            "latency p50={} p99={} p999={} max={}".format(
+                rows / interval,
+                requests / interval,
+                *(
+                    "-" if stats[key] is None
+                    else "{:.3f}s".format(stats[key])
+                    for key in ["latency_p50", "latency_p99",
+                                "latency_p999", "latency_max"]
+                )
+            )
+        )
@@ -0,0 +1,86 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+
+from . import _metrics as m
+
+
+class AIMDLimiter:
+
+    # Limits the number of concurrent operations, adjusting that limit using
+    # additive increase/multiplicative decrease. Every operation that finishes
+    # under our latency target grows the limit by roughly one per "window" of
+    # operations, and any operation that fails or goes over our target cuts
+    # the limit down. Waiters are woken up in the order they arrived, so
+    # operations are always started in the order they were requested.
+
+    def __init__(self, *, initial=1, minimum=1, maximum=16, increase=1.0,
+                 decrease=0.5, latency_target=5.0, loop=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.limit = float(initial)
+        self.inflight = 0
+
+        self._waiters = collections.deque()
+
+        m.INSERT_CONCURRENCY.set(self.concurrency)
+
+    @property
+    def concurrency(self):
+        return max(self.minimum, min(self.maximum, int(self.limit)))
+
+    def _wakeup(self):
+        while self._waiters and self.inflight < self.concurrency:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        if not self._waiters and self.inflight < self.concurrency:
+            self.inflight += 1
+            return
+
+        waiter = asyncio.Future(loop=self.loop)
+        self._waiters.append(waiter)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # If we were already given a slot before we got cancelled, we need
+            # to give it back so that someone else can use it.
+            if waiter.done() and not waiter.cancelled():
+                self.inflight -= 1
+                self._wakeup()
+            raise
+
+    def release(self, latency=None, error=False):
+        self.inflight -= 1
+
+        if error or (latency is not None and latency > self.latency_target):
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        else:
+            self.limit = min(
+                self.maximum,
+                self.limit + (self.increase / self.limit),
+            )
+
+        m.INSERT_CONCURRENCY.set(self.concurrency)
+
+        self._wakeup()
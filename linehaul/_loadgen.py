@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Plays the part of Fastly for load testing, by opening a number of
+# connections to a linehaul server and sending syslog lines down them at a
+# given rate.
+
+import asyncio
+import collections
+import json
+import random
+import time
+
+
+# Every line we send is for this project, with the time that it was sent as
+# its version, so that whatever ends up receiving the rows (like our fake
+# BigQuery) can tell how long it took them to get there.
+LOADGEN_PROJECT = "linehaul-loadgen"
+
+USER_AGENTS = [
+    "pip/1.5.6 CPython/3.4.3 Linux/3.13.0-74-generic",
+    "conda/4.3.8 requests/2.12.4 CPython/3.5.2 Linux/4.4.0",
+    "Python-urllib/2.7 setuptools/32.1.0",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:50.0) Gecko/20100101 Firefox/50.0",
+    "Go-http-client/1.1",
+] + [
+    "pip/9.0.1 " + json.dumps(
+        {
+            "installer": {"name": "pip", "version": "9.0.1"},
+            "python": python,
+            "implementation": {"name": "CPython", "version": python},
+            "distro": {
+                "name": distro,
+                "version": version,
+                "libc": {"lib": "glibc", "version": "2.23"},
+            },
+            "system": {"name": "Linux", "release": "4.4.0-53-generic"},
+            "cpu": "x86_64",
+        },
+        separators=(",", ":"),
+    )
+    for python in ["2.7.12", "3.5.2", "3.6.0"]
+    for distro, version in [("Ubuntu", "16.04"), ("CentOS Linux", "7.2")]
+]
+
+
+def make_line(rand, *, token=b"", now=None):
+    now = time.time() if now is None else now
+    filename = "{}-0.0.tar.gz".format(LOADGEN_PROJECT)
+
+    message = "|".join([
+        time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(now)),
+        rand.choice(["US", "DE", "GB", "CN", "JP"]),
+        "/packages/source/l/{}/{}".format(LOADGEN_PROJECT, filename),
+        LOADGEN_PROJECT,
+        "{:.6f}".format(now),
+        "sdist",
+        rand.choice(USER_AGENTS),
+    ])
+    line = "<134>{} cache-loadgen linehaul[1]: {}\n".format(
+        time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
+        message,
+    )
+
+    return token + line.encode("utf8")
+
+
+async def _connection(host, port, *, rate, tick, deadline, token, ssl,
+                      stats, loop):
+    rand = random.Random()
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+    stats["connections"] += 1
+
+    try:
+        # Every tick we'll send however many lines we should have sent by
+        # now, so that we keep to our rate even when we fall behind.
+        start = loop.time()
+        sent = 0
+        while deadline is None or loop.time() < deadline:
+            due = int((loop.time() - start) * rate) - sent
+            if due > 0:
+                now = time.time()
+                writer.write(
+                    b"".join(
+                        make_line(rand, token=token, now=now)
+                        for _ in range(due)
+                    )
+                )
+                sent += due
+                stats["lines"] += due
+
+                # If the server isn't reading as fast as we're writing, then
+                # this is where we'll find out about it.
+                waited = loop.time()
+                await writer.drain()
+                stats["stalled"] += loop.time() - waited
+
+            await asyncio.sleep(tick)
+    finally:
+        writer.close()
+        stats["connections"] -= 1
+
+
+async def generate(host, port, *, connections, rate, duration=None,
+                   tick=0.01, token=None, ssl=None, stats=None, loop):
+    stats = stats if stats is not None else collections.Counter()
+    token = token.encode("utf8") if token is not None else b""
+    deadline = loop.time() + duration if duration else None
+
+    await asyncio.gather(
+        *[
+            _connection(
+                host,
+                port,
+                rate=rate / connections,
+                tick=tick,
+                deadline=deadline,
+                token=token,
+                ssl=ssl,
+                stats=stats,
+                loop=loop,
+            )
+            for _ in range(connections)
+        ]
+    )
+
+    return stats
+
+
+async def report(stats, *, interval, echo):
+    last = 0
+    while True:
+        await asyncio.sleep(interval)
+
+        lines, last = stats["lines"] - last, stats["lines"]
+        echo(
+            "{:>10,.0f} lines/sec {:>6} connections {:>8.2f}s stalled".format(
+                lines / interval,
+                stats["connections"],
+                stats["stalled"],
+            )
+        )
@@ -10,10 +10,149 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 
 EVENTS = Counter("linehaul_events", "# of total events processed.")
 
 QUEUED = Gauge(
     "linehaul_queued_events", "# of download events currently queued")
+
+CACHE_HITS = Counter("linehaul_cache_hits", "# of cache hits.", ["cache"])
+
+CACHE_MISSES = Counter(
+    "linehaul_cache_misses", "# of cache misses.", ["cache"])
+
+CACHE_EVICTIONS = Counter(
+    "linehaul_cache_evictions", "# of items evicted from a cache.", ["cache"])
+
+INSERT_CONCURRENCY = Gauge(
+    "linehaul_insert_concurrency",
+    "Current limit on concurrent insertAll requests.",
+)
+
+INFLIGHT_INSERTS = Gauge(
+    "linehaul_inflight_inserts", "# of insertAll requests in flight.")
+
+INFLIGHT_BYTES = Gauge(
+    "linehaul_inflight_bytes",
+    "# of row bytes in insertAll requests in flight.",
+)
+
+REQUEST_ROWS = Histogram(
+    "linehaul_request_rows",
+    "# of rows sent per insertAll request.",
+    buckets=[1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000],
+)
+
+REQUEST_BYTES = Histogram(
+    "linehaul_request_bytes",
+    "# of row bytes sent per insertAll request.",
+    buckets=[
+        1024, 16 * 1024, 64 * 1024, 256 * 1024, 512 * 1024,
+        1024 * 1024, 2 * 1024 * 1024, 5 * 1024 * 1024, 10 * 1024 * 1024,
+    ],
+)
+
+UPLOADED_BYTES = Counter(
+    "linehaul_uploaded_bytes",
+    "# of request body bytes sent to BigQuery, after any compression.",
+)
+
+INSERT_RETRIES = Counter(
+    "linehaul_insert_retries",
+    "# of insertAll requests that were retried.",
+    ["reason"],
+)
+
+FAILED_ROWS = Counter(
+    "linehaul_failed_rows",
+    "# of rows that could not be inserted.",
+    ["reason"],
+)
+
+SPOOL_SEGMENTS = Gauge(
+    "linehaul_spool_segments", "# of unacknowledged segments in the spool.")
+
+SPOOL_BYTES = Gauge(
+    "linehaul_spool_bytes", "# of compressed bytes in the spool.")
+
+SPOOL_ERRORS = Counter(
+    "linehaul_spool_errors",
+    "# of spool segments that were discarded because they could not be read.",
+)
+
+SPOOL_AGE = Gauge(
+    "linehaul_spool_age_seconds",
+    "Age of the oldest unacknowledged segment in the spool.",
+)
+
+TOKEN_REFRESHES = Counter(
+    "linehaul_token_refreshes", "# of times an access token was fetched.")
+
+TOKEN_ERRORS = Counter(
+    "linehaul_token_errors",
+    "# of times a background token refresh failed.",
+)
+
+TOKEN_AGE = Gauge(
+    "linehaul_token_age_seconds", "Age of the current access token.")
+
+PARSE_INFLIGHT = Gauge(
+    "linehaul_parse_inflight",
+    "# of batches of lines waiting to be parsed in the process pool.",
+)
+
+PARSE_POOL_ERRORS = Counter(
+    "linehaul_parse_pool_errors",
+    "# of batches of lines that failed in the process pool, and were parsed "
+    "in process instead.",
+)
+
+DROPPED_LINES = Counter(
+    "linehaul_dropped_lines",
+    "# of lines that were dropped before being parsed.",
+    ["reason"],
+)
+
+IGNORED_EVENTS = Counter(
+    "linehaul_ignored_events",
+    "# of events that were skipped because of their user agent.",
+)
+
+PARSE_ERRORS = Counter(
+    "linehaul_parse_errors",
+    "# of lines that could not be parsed.",
+    ["reason"],
+)
+
+INSERT_ERRORS = Counter(
+    "linehaul_insert_errors",
+    "# of rows that were rejected in an insertAll response.",
+    ["reason"],
+)
+
+ROLLUP_KEYS = Gauge(
+    "linehaul_rollup_keys", "# of distinct keys currently being counted.")
+
+ROLLUP_FLUSHES = Counter(
+    "linehaul_rollup_flushes",
+    "# of times our counts were flushed to the rollup table.",
+    ["reason"],
+)
+
+INSERT_SECONDS = Histogram(
+    "linehaul_insert_seconds",
+    "Latency of individual insertAll requests.",
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+)
+
+STAGE_SECONDS = Histogram(
+    "linehaul_stage_seconds",
+    "Time spent on a single event in each stage of processing, sampled.",
+    ["stage"],
+    buckets=[
+        1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5,
+        1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2,
+    ],
+)
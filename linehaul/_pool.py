@@ -0,0 +1,66 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import functools
+
+from . import _metrics as m
+from ._queue import FlowControl
+
+
+class BoundedExecutor:
+
+    # Runs work in an executor, while limiting how much of it can be in
+    # flight at once. Since the work is coming from our transports faster
+    # than we can get through it, we can't make anyone wait on a slot, so
+    # instead once we hit our limit we pause reading from all of them until
+    # we've caught back up.
+
+    def __init__(self, executor, *, max_inflight, loop=None):
+        self.executor = executor
+        self.max_inflight = max_inflight
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.inflight = 0
+
+        self._flow = FlowControl()
+
+    def add_transport(self, transport):
+        self._flow.add_transport(transport)
+
+    def remove_transport(self, transport):
+        self._flow.remove_transport(transport)
+
+    def _done(self, fut):
+        self.inflight -= 1
+        m.PARSE_INFLIGHT.set(self.inflight)
+
+        if self.inflight < self.max_inflight:
+            self._flow.resume()
+
+    def submit(self, func, *args, **kwargs):
+        fut = self.loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kwargs),
+        )
+        fut.add_done_callback(self._done)
+
+        self.inflight += 1
+        m.PARSE_INFLIGHT.set(self.inflight)
+
+        if self.inflight >= self.max_inflight:
+            self._flow.pause()
+
+        return fut
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -12,37 +12,111 @@
 # limitations under the License.
 
 import asyncio
+import weakref
 
 
 class QueueClosed(Exception):
     pass
 
 
-class FlowControlQueueMixin:
+# A transport can be paused by more than one thing at a time (for instance
+# when both our queue and our parsing pool are full), so we keep track of who
+# has paused each transport, and only resume reading once all of them have
+# asked us to.
+_paused = weakref.WeakKeyDictionary()
+
+
+def pause_transport(transport, owner):
+    owners = _paused.setdefault(transport, set())
+    if not owners:
+        transport.pause_reading()
+    owners.add(owner)
+
+
+def resume_transport(transport, owner):
+    owners = _paused.get(transport)
+    if owners and owner in owners:
+        owners.discard(owner)
+        if not owners:
+            transport.resume_reading()
 
-    def __init__(self, transport, *args, maxsize=2 ** 16, **kwargs):
-        self._transport = transport
+
+class FlowControl:
+
+    # Applies backpressure to any number of transports, pausing all of them
+    # whenever we're "full", and resuming them all again once we're not.
+
+    def __init__(self):
+        self._transports = set()
         self._paused = False
 
-        super().__init__(*args, maxsize=maxsize, **kwargs)
+    @property
+    def paused(self):
+        return self._paused
+
+    def add_transport(self, transport):
+        self._transports.add(transport)
 
-    def _maybe_resume_transport(self):
-        if self._paused and self.qsize() <= self.maxsize:
-            self._paused = False
-            self._transport.resume_reading()
+        if self._paused:
+            pause_transport(transport, self)
 
-    def _put(self, item):
-        if not self._paused and self.full():
+    def remove_transport(self, transport):
+        self._transports.discard(transport)
+        resume_transport(transport, self)
+
+    def pause(self):
+        if not self._paused:
             self._paused = True
-            self._transport.pause_reading()
+            for transport in self._transports:
+                pause_transport(transport, self)
 
-        return super()._put(item)
+    def resume(self):
+        if self._paused:
+            self._paused = False
+            for transport in self._transports:
+                resume_transport(transport, self)
+
+
+class FlowControlQueueMixin:
+
+    # A queue that applies backpressure to any number of transports that are
+    # feeding it. Once the queue grows to maxsize, every transport is asked
+    # to pause reading, and once it has drained back down below that they
+    # are all resumed. The maxsize is a high water mark rather than a hard
+    # limit, since a transport may have already handed us data before it gets
+    # paused, and we don't want to throw that away.
+
+    def __init__(self, *args, maxsize=2 ** 16, **kwargs):
+        self._flow = FlowControl()
+        self._high_water = maxsize
+
+        super().__init__(*args, **kwargs)
+
+    def add_transport(self, transport):
+        self._flow.add_transport(transport)
+
+    def remove_transport(self, transport):
+        self._flow.remove_transport(transport)
+
+    def _maybe_pause_transports(self):
+        if self.qsize() >= self._high_water:
+            self._flow.pause()
+
+    def _maybe_resume_transports(self):
+        if self.qsize() < self._high_water:
+            self._flow.resume()
+
+    def _put(self, item):
+        try:
+            return super()._put(item)
+        finally:
+            self._maybe_pause_transports()
 
     def _get(self):
         try:
             return super()._get()
         finally:
-            self._maybe_resume_transport()
+            self._maybe_resume_transports()
 
 
 class CloseableQueueMixin:
@@ -58,6 +132,14 @@ class CloseableQueueMixin:
 
         return super()._put(item)
 
+    async def get(self):
+        # A closed, empty queue is never going to have another item put into
+        # it, so rather than wait forever we'll raise QueueClosed.
+        if self.closed and self.empty():
+            raise QueueClosed
+
+        return await super().get()
+
     def _close_waiters(self, waiters):
         while waiters:
             waiter = waiters.popleft()
@@ -74,6 +156,10 @@ class CloseableQueueMixin:
         self._close_waiters(self._putters)
 
 
+class CloseableQueue(CloseableQueueMixin, asyncio.Queue):
+    pass
+
+
 class FlowControlQueue(FlowControlQueueMixin, asyncio.Queue):
     pass
 
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A small, immutable record type with a pyrsistent.PRecord like API. Unlike a
+# PRecord these are plain __slots__ classes, so we don't pay for building a
+# persistent map for every record we create.
+
+
+_MISSING = object()
+
+
+class Field:
+
+    __slots__ = ("type", "mandatory", "factory", "serializer")
+
+    def __init__(self, type=(), mandatory=False, factory=None,
+                 serializer=None):
+        self.type = type if isinstance(type, tuple) else (type,)
+        self.mandatory = mandatory
+        self.factory = factory
+        self.serializer = serializer
+
+
+field = Field
+
+
+class _RecordMeta(type):
+
+    def __new__(mcls, name, bases, attrs):
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, "_fields", {}))
+
+        own = {
+            key: attrs.pop(key)
+            for key, value in list(attrs.items())
+            if isinstance(value, Field)
+        }
+        fields.update(own)
+
+        attrs["__slots__"] = tuple(own)
+        attrs["_fields"] = fields
+
+        return super().__new__(mcls, name, bases, attrs)
+
+
+class Record(metaclass=_RecordMeta):
+
+    def __init__(self, **kwargs):
+        cls = type(self)
+
+        for key, value in kwargs.items():
+            try:
+                f = cls._fields[key]
+            except KeyError:
+                raise AttributeError(
+                    "{!r} is not among the specified fields for {}".format(
+                        key,
+                        cls.__name__,
+                    )
+                ) from None
+
+            if f.factory is not None:
+                value = f.factory(value)
+
+            if f.type and not isinstance(value, f.type):
+                raise TypeError(
+                    "Invalid type for field {}.{}, was {}".format(
+                        cls.__name__,
+                        key,
+                        type(value).__name__,
+                    )
+                )
+
+            object.__setattr__(self, key, value)
+
+        for key, f in cls._fields.items():
+            if f.mandatory and key not in kwargs:
+                raise ValueError(
+                    "Missing mandatory field {}.{}".format(cls.__name__, key)
+                )
+
+    @classmethod
+    def create(cls, kwargs):
+        if isinstance(kwargs, cls):
+            return kwargs
+
+        return cls(**kwargs)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(
+            "{} is immutable".format(type(self).__name__)
+        )
+
+    # Since we don't allow setting attributes, pickle (which is how records
+    # come back to us from our parsing pool) needs to be told how to restore
+    # the fields that were set.
+    def __getstate__(self):
+        return {
+            key: value
+            for key, value in zip(self._fields, self._values())
+            if value is not _MISSING
+        }
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    def _values(self):
+        return tuple(getattr(self, key, _MISSING) for key in self._fields)
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self._values() != other._values()
+
+    def __hash__(self):
+        return hash((type(self), self._values()))
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join(
+                "{}={!r}".format(key, value)
+                for key, value in zip(self._fields, self._values())
+                if value is not _MISSING
+            ),
+        )
+
+    def serialize(self, format=None):
+        data = {}
+
+        for key, f in self._fields.items():
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING:
+                continue
+
+            if f.serializer is not None:
+                value = f.serializer(format, value)
+            elif isinstance(value, Record):
+                value = value.serialize(format)
+
+            data[key] = value
+
+        return data
@@ -0,0 +1,248 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from ._limiter import AIMDLimiter
+from ._queue import CloseableQueue
+from ._retry import RetryPolicy
+from .bigquery import (
+    API_URL, STREAMING_PATH, TOKEN_PATH, BigQueryClient, BigQueryError,
+)
+from .core import Occurrences, parse_batch, send
+
+
+# How many lines we'll read, parse, and insert at a time. Our checkpoints are
+# only ever written in between chunks, once every row in a chunk has been
+# inserted, so this is also how much we might have to redo after a failure.
+CHUNK_LINES = 10000
+
+
+class Checkpoints:
+
+    # Keeps track of how far into each file we've gotten, as a byte offset
+    # into the (uncompressed) contents of the file, so that a replay that
+    # was interrupted can pick up where it left off.
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename).encode("utf8"))
+        return os.path.join(self.directory, key.hexdigest() + ".json")
+
+    def load(self, filename):
+        if self.directory is None:
+            return 0, False, None
+
+        try:
+            with open(self._path(filename), "r") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return 0, False, None
+
+        return data["offset"], data["done"], data.get("occurrences")
+
+    def save(self, filename, offset, done=False, occurrences=None):
+        if self.directory is None:
+            return
+
+        path = self._path(filename)
+        with open(path + ".tmp", "w") as fp:
+            json.dump(
+                {
+                    "filename": os.path.abspath(filename),
+                    "offset": offset,
+                    "done": done,
+                    "occurrences": occurrences,
+                },
+                fp,
+            )
+        os.rename(path + ".tmp", path)
+
+
+def _line_key(line):
+    # The built in hash of a line is different in every process, so we count
+    # our occurrences by a hash that isn't, which lets them be saved along
+    # with our checkpoints.
+    return zlib.crc32(line) << 32 | zlib.adler32(line)
+
+
+def _open(filename):
+    with open(filename, "rb") as fp:
+        magic = fp.read(2)
+
+    if magic == b"\x1f\x8b":
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def read_chunks(filename, offset=0, *, chunk_lines=CHUNK_LINES):
+    with _open(filename) as fp:
+        # Seeking in a gzip file means decompressing everything up to that
+        # point, but that is still a lot cheaper than parsing it all again.
+        fp.seek(offset)
+
+        lines = []
+        for line in fp:
+            offset += len(line)
+            lines.append(line[:-1] if line.endswith(b"\n") else line)
+
+            if len(lines) >= chunk_lines:
+                yield lines, offset
+                lines = []
+
+        if lines:
+            yield lines, offset
+
+
+async def replay_file(filename, *, client, checkpoints, token=None,
+                      engine="fast", max_rows, max_bytes,
+                      chunk_lines=CHUNK_LINES, loop=None):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    stats = collections.Counter()
+
+    offset, done, state = checkpoints.load(filename)
+    if done:
+        stats["skipped"] += 1
+        return stats
+
+    def on_error(line, exc):
+        stats["errors"] += 1
+
+    # A file is treated just like everything that a single server received,
+    # so we count how many times we've seen each line across the whole file
+    # (and not just within a chunk), which gives our rows the same insertIds
+    # that they would have gotten when they were first sent to us.
+    # When we're resuming, we pick up the counts from where we left off, or
+    # else any line that we'd already seen would get an insertId that its
+    # earlier copy already had, and get dropped by BigQuery as a duplicate.
+    occurrences = Occurrences(key=_line_key)
+    if state is not None:
+        occurrences.load_state(state)
+
+    # When we don't have a client, we're doing a dry run and we'll go through
+    # all of the motions, except for actually sending anything.
+    bq = client() if client is not None else None
+    limiter = AIMDLimiter(loop=loop)
+
+    try:
+        for lines, end in read_chunks(filename, offset,
+                                      chunk_lines=chunk_lines):
+            rows = parse_batch(
+                lines,
+                occurrences=occurrences.count(lines),
+                token=token,
+                engine=engine,
+                on_error=on_error,
+            ).rows
+
+            if bq is not None:
+                # Our rows get batched up and sent exactly the same way that
+                # they are when we're receiving them live, we just wait for
+                # every one of them to have been inserted before we move our
+                # checkpoint past them.
+                queue = CloseableQueue()
+                for row in rows:
+                    queue.put_nowait(row)
+                queue.close()
+
+                failed = await send(
+                    bq,
+                    queue,
+                    limiter=limiter,
+                    max_rows=max_rows,
+                    max_bytes=max_bytes,
+                    loop=loop,
+                )
+                if failed:
+                    raise BigQueryError(
+                        "Could not insert {} rows".format(failed),
+                        reason="failed_rows",
+                    )
+
+                checkpoints.save(
+                    filename,
+                    end,
+                    occurrences=occurrences.state(),
+                )
+
+            stats["lines"] += len(lines)
+            stats["rows"] += len(rows)
+            stats["bytes"] += end - offset
+            offset = end
+
+        if bq is not None:
+            checkpoints.save(filename, offset, done=True)
+    finally:
+        if bq is not None:
+            bq.__exit__(None, None, None)
+
+    return stats
+
+
+def replay(filename, *, table=None, account=None, key=None, token=None,
+           engine="fast", max_rows, max_bytes, insert_attempts=5,
+           insert_compression=None, checkpoint_dir=None, dry_run=False,
+           api_url=API_URL):
+    # This is what actually gets run in each of our worker processes, so it
+    # needs to set up everything (including an event loop) for itself.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    client = None
+    try:
+        if not dry_run:
+            client = BigQueryClient(
+                *table.split(":"),
+                client_id=account,
+                key=key,
+                retry=RetryPolicy(attempts=insert_attempts),
+                compresslevel=insert_compression,
+                streaming_url=api_url + STREAMING_PATH,
+                token_url=api_url + TOKEN_PATH,
+            )
+
+        start = time.perf_counter()
+        stats = loop.run_until_complete(
+            replay_file(
+                filename,
+                client=client,
+                checkpoints=Checkpoints(
+                    None if dry_run else checkpoint_dir
+                ),
+                token=token.encode("utf8") if token is not None else None,
+                engine=engine,
+                max_rows=max_rows,
+                max_bytes=max_bytes,
+                loop=loop,
+            )
+        )
+        stats["seconds"] = time.perf_counter() - start
+    finally:
+        if client is not None:
+            client.close()
+        loop.close()
+
+    return dict(stats)
@@ -0,0 +1,54 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+
+class RetryBudget:
+
+    # Limits retries to a fraction of the requests that we make, so that when
+    # the other end is having problems we don't multiply the load on it (and
+    # the work we do re-sending requests) by retrying everything several
+    # times over. A small reserve lets us retry a burst of requests when
+    # things are otherwise quiet.
+
+    def __init__(self, *, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+
+    def deposit(self):
+        self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def withdraw(self):
+        if self.balance < 1:
+            return False
+
+        self.balance -= 1
+        return True
+
+
+class RetryPolicy:
+
+    def __init__(self, *, attempts=5, base=0.5, cap=30.0, budget=None):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def delay(self, attempt):
+        # Exponential backoff with "full jitter", so that all of the requests
+        # that failed at the same time don't all come back at the same time.
+        return random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+
+    def should_retry(self, attempt):
+        return attempt + 1 < self.attempts and self.budget.withdraw()
@@ -0,0 +1,122 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Most of what gets asked of our downloads is how many there were of some
+# kind, on some day, so rather than (or as well as) streaming a row for every
+# download, we can count them up as they go by and stream rows like:
+#
+#   {"date": "2017-01-01", "project": "foo", "version": "1.0", ...,
+#    "count": 1234}
+#
+# Which columns those rows have is configurable, out of the DIMENSIONS below,
+# and the table they're streamed into needs to have a column for each of the
+# ones that are being used, along with a DATE "date" and an INTEGER "count".
+
+import sys
+import time
+import uuid
+
+from .bigquery import encode_row
+
+
+def _get(*names):
+    def get(download):
+        value = download
+        for name in names:
+            value = getattr(value, name, None)
+            if value is None:
+                break
+        return value
+    return get
+
+
+def _package_type(download):
+    return download.file.type.value
+
+
+DIMENSIONS = {
+    "country_code": _get("country_code"),
+    "project": _get("file", "project"),
+    "version": _get("file", "version"),
+    "type": _package_type,
+    "installer": _get("details", "installer", "name"),
+    "installer_version": _get("details", "installer", "version"),
+    "python": _get("details", "python"),
+    "implementation": _get("details", "implementation", "name"),
+    "implementation_version": _get("details", "implementation", "version"),
+    "distro": _get("details", "distro", "name"),
+    "distro_version": _get("details", "distro", "version"),
+    "system": _get("details", "system", "name"),
+    "system_release": _get("details", "system", "release"),
+    "cpu": _get("details", "cpu"),
+}
+
+DEFAULT_DIMENSIONS = (
+    "project",
+    "version",
+    "installer",
+    "python",
+    "country_code",
+)
+
+
+def parse_dimensions(value):
+    dimensions = tuple(d.strip() for d in value.split(",") if d.strip())
+    unknown = [d for d in dimensions if d not in DIMENSIONS]
+    if unknown:
+        raise ValueError(
+            "Unknown dimensions: {}, must be some of {}".format(
+                ", ".join(unknown),
+                ", ".join(sorted(DIMENSIONS)),
+            )
+        )
+    if len(set(dimensions)) != len(dimensions):
+        raise ValueError("Dimensions must not be repeated")
+    return dimensions
+
+
+def key(download, dimensions):
+    # Keys are just the day the download happened on, followed by the value
+    # of each of our dimensions, in order.
+    return (int(download.timestamp // 86400),) + tuple(
+        DIMENSIONS[dimension](download) for dimension in dimensions
+    )
+
+
+def compact(key):
+    # Our keys can stick around for a while, and many of them will share most
+    # of their values (every version of a project, every country downloading
+    # it, and so on), so we make sure that they're all sharing the same
+    # strings, rather than each having its own copy of them.
+    return tuple(
+        sys.intern(value) if type(value) is str else value for value in key
+    )
+
+
+def encode(counts, dimensions):
+    # Every flush gets an id of its own, and every row in it an index within
+    # that flush, since the same key can (and will) have the same count in
+    # more than one flush, and we don't want BigQuery to think that those are
+    # duplicates of each other.
+    flush_id = uuid.uuid4().hex
+
+    rows = []
+    for index, (key, count) in enumerate(counts.items()):
+        day = key[0] * 86400
+        row = {"date": time.strftime("%Y-%m-%d", time.gmtime(day))}
+        row.update(zip(dimensions, key[1:]))
+        row["count"] = count
+
+        rows.append(
+            (day, encode_row("{}-{}".format(flush_id, index), row))
+        )
+    return rows
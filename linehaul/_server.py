@@ -21,6 +21,10 @@ class Server:
         self._args = args
         self._kwargs = kwargs
 
+    @property
+    def sockets(self):
+        return self._server.sockets
+
     async def __aenter__(self):
         self._server = await self._loop.create_server(
             *self._args,
@@ -32,3 +36,30 @@ class Server:
         if self._server.sockets is not None:
             self._server.close()
             await self._server.wait_closed()
+
+
+class AppServer(Server):
+
+    # Serves an aiohttp web application. We build the server ourselves from
+    # the application's handler, since that's the API that every version of
+    # aiohttp that we support has in common.
+
+    def __init__(self, app, *args, shutdown_timeout=10, **kwargs):
+        self._handler = app.make_handler()
+        self._shutdown_timeout = shutdown_timeout
+
+        super().__init__(self._handler, *args, **kwargs)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._server.sockets is not None:
+            self._server.close()
+
+        # Give any requests that are still in flight a chance to finish, and
+        # close any idle connections. This is called shutdown rather than
+        # finish_connections in newer versions of aiohttp.
+        finish = getattr(self._handler, "finish_connections", None)
+        if finish is None:
+            finish = self._handler.shutdown
+        await finish(self._shutdown_timeout)
+
+        await self._server.wait_closed()
@@ -0,0 +1,217 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+import os
+import time
+
+from . import _metrics as m
+from ._queue import CloseableQueue, QueueClosed
+
+
+# A spool is a directory of segments, each of which holds one batch of already
+# encoded rows, gzip compressed and separated by newlines (which can never
+# appear inside of an encoded row). Segments are named so that sorting them
+# by name puts them in the order they were written, and they are written to a
+# temporary file that is only renamed into place once it has been fsync'd, so
+# a segment that exists is always complete.
+SEGMENT_EXT = ".seg"
+TEMP_EXT = ".tmp"
+
+
+class Segment:
+
+    __slots__ = ("name", "suffix", "size", "created")
+
+    def __init__(self, name, suffix, size, created):
+        self.name = name
+        self.suffix = suffix
+        self.size = size
+        self.created = created
+
+    def __repr__(self):
+        return "<Segment {!r}>".format(self.name)
+
+
+def _segment_name(seq, suffix):
+    return "{:016d}-{}{}".format(seq, suffix, SEGMENT_EXT)
+
+
+def _parse_segment_name(name):
+    seq, _, suffix = name[:-len(SEGMENT_EXT)].partition("-")
+    return int(seq), suffix
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_segment(directory, name, rows, compresslevel):
+    path = os.path.join(directory, name)
+    data = gzip.compress(b"\n".join(rows), compresslevel=compresslevel)
+
+    with open(path + TEMP_EXT, "wb") as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.rename(path + TEMP_EXT, path)
+    _fsync_directory(directory)
+
+    return len(data)
+
+
+def _read_segment(directory, name):
+    with open(os.path.join(directory, name), "rb") as fp:
+        return gzip.decompress(fp.read()).split(b"\n")
+
+
+class Spool:
+
+    def __init__(self, directory, *, max_bytes=None, compresslevel=1,
+                 retry_delay=30, loop=None, executor=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self.retry_delay = retry_delay
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.executor = executor
+
+        self.bytes = 0
+
+        self._seq = 0
+        self._segments = {}
+        self._pending = CloseableQueue()
+        self._changed = asyncio.Event()
+
+        m.SPOOL_AGE.set_function(self.age)
+
+    def __len__(self):
+        return len(self._segments)
+
+    def age(self):
+        if not self._segments:
+            return 0
+        return time.time() - min(s.created for s in self._segments.values())
+
+    def _add(self, segment):
+        self._segments[segment.name] = segment
+        self.bytes += segment.size
+
+        m.SPOOL_SEGMENTS.set(len(self._segments))
+        m.SPOOL_BYTES.set(self.bytes)
+
+    def _remove(self, segment):
+        del self._segments[segment.name]
+        self.bytes -= segment.size
+
+        m.SPOOL_SEGMENTS.set(len(self._segments))
+        m.SPOOL_BYTES.set(self.bytes)
+
+        self._changed.set()
+
+    async def _wait_for(self, predicate):
+        while not predicate():
+            self._changed.clear()
+            await self._changed.wait()
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Anything that is still sitting in the spool was never acknowledged
+        # by BigQuery, so we'll queue it up to be sent again, in the same
+        # order that it was originally written. Temporary files are segments
+        # that we never finished writing, and were never acknowledged to
+        # anyone, so we can just throw them away.
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+
+            if name.endswith(TEMP_EXT):
+                os.unlink(path)
+            elif name.endswith(SEGMENT_EXT):
+                seq, suffix = _parse_segment_name(name)
+                stat = os.stat(path)
+                segment = Segment(name, suffix, stat.st_size, stat.st_mtime)
+
+                self._seq = max(self._seq, seq + 1)
+                self._add(segment)
+                self._pending.put_nowait(segment)
+
+    async def write(self, suffix, rows):
+        # If our spool has grown too large, then we'll stop accepting new
+        # segments until some have been acknowledged, which will cause the
+        # queue in front of us to fill up and apply backpressure.
+        if self.max_bytes is not None:
+            await self._wait_for(lambda: self.bytes < self.max_bytes)
+
+        name = _segment_name(self._seq, suffix)
+        self._seq += 1
+
+        size = await self.loop.run_in_executor(
+            self.executor,
+            _write_segment,
+            self.directory,
+            name,
+            rows,
+            self.compresslevel,
+        )
+
+        segment = Segment(name, suffix, size, time.time())
+        self._add(segment)
+        self._pending.put_nowait(segment)
+
+        return segment
+
+    async def get(self):
+        # Once we've been closed we stop handing out segments, even if we still
+        # have some. They're safely on disk, and will be sent the next time
+        # that we're opened.
+        if self._pending.closed:
+            raise QueueClosed
+
+        return await self._pending.get()
+
+    async def read(self, segment):
+        return await self.loop.run_in_executor(
+            self.executor,
+            _read_segment,
+            self.directory,
+            segment.name,
+        )
+
+    def ack(self, segment):
+        os.unlink(os.path.join(self.directory, segment.name))
+        self._remove(segment)
+
+    def nack(self, segment):
+        # The segment is still sitting on disk, so all we need to do is put
+        # it back in line to be sent again after giving things a chance to
+        # recover.
+        self.loop.call_later(self.retry_delay, self._requeue, segment)
+
+    def _requeue(self, segment):
+        if not self._pending.closed:
+            self._pending.put_nowait(segment)
+
+    def close(self):
+        # Closing the spool doesn't throw away anything that's in it, we just
+        # stop handing out segments, and leave whatever hasn't been
+        # acknowledged yet for the next time we're opened.
+        self._pending.close()
+
+    async def join(self):
+        await self._wait_for(lambda: not self._segments)
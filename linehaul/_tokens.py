@@ -0,0 +1,167 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from oauthlib.oauth2.rfc6749.errors import TokenExpiredError
+
+from . import _metrics as m
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenError(Exception):
+    pass
+
+
+class TokenManager:
+
+    # Manages the access token for a single OAuth2 client, shared by all of
+    # the requests made with it. Rather than waiting for a token to expire
+    # (and stalling every request that is in flight when it does), we refresh
+    # it in the background some time before it expires, and any number of
+    # requests that need a token while a refresh is happening will all wait
+    # on that same refresh.
+
+    def __init__(self, oauth2, token_url, *, scope=None, margin=300,
+                 retry_delay=10, session=None, loop=None):
+        self.oauth2 = oauth2
+        self.token_url = token_url
+        self.scope = scope
+        self.margin = margin
+        self.retry_delay = retry_delay
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.issued_at = None
+        self.expires_at = None
+
+        self._session = session
+        self._owns_session = session is None
+        self._refreshing = None
+        self._timer = None
+
+        m.TOKEN_AGE.set_function(self.age)
+
+    def age(self):
+        if self.issued_at is None:
+            return 0
+        return time.time() - self.issued_at
+
+    @property
+    def valid(self):
+        return (
+            self.oauth2.access_token is not None and
+            self.expires_at is not None and
+            time.time() < self.expires_at
+        )
+
+    def invalidate(self):
+        self.expires_at = None
+
+    async def _fetch(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        url, headers, body = self.oauth2.prepare_token_request(
+            self.token_url,
+            scope=self.scope,
+        )
+
+        try:
+            async with self._session.post(url, headers=headers,
+                                          data=body) as resp:
+                status = resp.status
+                text = await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise TokenError(
+                "Error fetching a token: {!r}".format(exc)
+            ) from exc
+
+        if status != 200:
+            raise TokenError(
+                "Token endpoint returned a {} response: {}".format(
+                    status,
+                    text,
+                )
+            )
+
+        token = self.oauth2.parse_request_body_response(text)
+
+        self.issued_at = time.time()
+        self.expires_at = self.issued_at + int(token.get("expires_in", 3600))
+        m.TOKEN_REFRESHES.inc()
+
+        self._schedule(self.expires_at - self.margin - self.issued_at)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(max(0, delay), self._background)
+
+    def _background(self):
+        self._timer = None
+
+        def done(fut):
+            if fut.cancelled():
+                return
+
+            # If we failed to refresh our token in the background, then we
+            # still have a little while left before our current one expires,
+            # so we'll just try again in a bit.
+            exc = fut.exception()
+            if exc is not None:
+                logger.warning("Failed to refresh token", exc_info=exc)
+                m.TOKEN_ERRORS.inc()
+                self._schedule(self.retry_delay)
+
+        refresh = asyncio.ensure_future(self.refresh(), loop=self.loop)
+        refresh.add_done_callback(done)
+
+    async def refresh(self):
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(
+                self._fetch(),
+                loop=self.loop,
+            )
+
+            def clear(fut):
+                self._refreshing = None
+
+            self._refreshing.add_done_callback(clear)
+
+        # Shield the refresh, so that if any one of the requests waiting on
+        # it gets cancelled, the refresh still happens for everyone else.
+        await asyncio.shield(self._refreshing)
+
+    async def add_token(self, *args, **kwargs):
+        if not self.valid:
+            await self.refresh()
+
+        try:
+            return self.oauth2.add_token(*args, **kwargs)
+        except TokenExpiredError:
+            await self.refresh()
+            return self.oauth2.add_token(*args, **kwargs)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._owns_session and self._session is not None:
+            self._session.close()
+            self._session = None
@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import concurrent.futures
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import prometheus_client
+
+from aiohttp import web
+from prometheus_client.core import Metric
+from prometheus_client.parser import text_string_to_metric_families
+
+
+METRICS_EXT = ".prom"
+
+
+def metrics_path(directory, worker_id):
+    return os.path.join(
+        directory,
+        "worker-{}{}".format(worker_id, METRICS_EXT),
+    )
+
+
+def write_metrics(path, registry=prometheus_client.REGISTRY):
+    with open(path + ".tmp", "wb") as fp:
+        fp.write(prometheus_client.generate_latest(registry))
+    os.rename(path + ".tmp", path)
+
+
+def metrics_app(registry=prometheus_client.REGISTRY):
+    async def metrics(request):
+        return web.Response(
+            body=prometheus_client.generate_latest(registry),
+            headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST},
+        )
+
+    app = web.Application()
+    app.router.add_route("GET", "/", metrics)
+    app.router.add_route("GET", "/metrics", metrics)
+    return app
+
+
+def start_metrics_server(port, addr="", registry=prometheus_client.REGISTRY):
+    # The version of prometheus_client that we use can only start a server
+    # for its default registry, so we serve our metrics ourselves. Just like
+    # its server, ours runs in a thread of its own (with an event loop of its
+    # own), so that it keeps working in the supervisor, which doesn't have an
+    # event loop at all.
+    loop = asyncio.new_event_loop()
+    started = concurrent.futures.Future()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        try:
+            server = loop.run_until_complete(
+                loop.create_server(
+                    metrics_app(registry).make_handler(),
+                    addr,
+                    port,
+                )
+            )
+        except Exception as exc:
+            started.set_exception(exc)
+            return
+
+        started.set_result(server)
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    return started.result()
+
+
+async def export_metrics(path, *, interval=5):
+    # Every worker periodically writes out a snapshot of all of its metrics,
+    # which the supervisor reads and serves on behalf of all of its workers.
+    # We can't use prometheus_client's multiprocess mode for this, since it
+    # has to be turned on before any metrics are created, and it doesn't
+    # support things like Gauge.set_function.
+    while True:
+        write_metrics(path)
+        await asyncio.sleep(interval)
+
+
+class WorkerCollector:
+
+    # Collects the metrics that each of our workers have written out, adding
+    # a worker label to all of them so that they can be told apart (or added
+    # together) once they've been scraped.
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def collect(self):
+        families = {}
+
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(METRICS_EXT):
+                continue
+
+            worker = name[len("worker-"):-len(METRICS_EXT)]
+
+            try:
+                with open(os.path.join(self.directory, name)) as fp:
+                    text = fp.read()
+            except FileNotFoundError:
+                continue
+
+            for family in text_string_to_metric_families(text):
+                key = (family.name, family.type)
+                if key not in families:
+                    families[key] = Metric(
+                        family.name,
+                        family.documentation,
+                        family.type,
+                    )
+
+                # Older versions of prometheus_client give us plain tuples,
+                # newer ones give us a namedtuple with a few more fields
+                # that we don't have any use for.
+                for sample in family.samples:
+                    name, labels, value = sample[:3]
+                    families[key].add_sample(
+                        name,
+                        dict(labels, worker=worker),
+                        value,
+                    )
+
+        return list(families.values())
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class Supervisor:
+
+    # Forks a number of worker processes, each of which runs target(worker_id)
+    # and restarts any of them that exit for as long as we're running. When
+    # we're asked to shut down, we pass that along to all of the workers and
+    # wait for them to finish.
+
+    def __init__(self, count, target, *, metrics_dir, restart_delay=1):
+        self.count = count
+        self.target = target
+        self.metrics_dir = metrics_dir
+        self.restart_delay = restart_delay
+
+        self.workers = {}
+        self.stopping = False
+
+    def _spawn(self, worker_id):
+        pid = os.fork()
+
+        if pid == 0:
+            # We're in the worker now, so we want to handle our signals the
+            # same way that a single linehaul process would, and we want to
+            # make sure that we never return back into the supervisor.
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, _interrupt)
+
+            code = 0
+            try:
+                self.target(worker_id)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        self.workers[pid] = worker_id
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+
+        for worker_id in range(self.count):
+            self._spawn(worker_id)
+
+        while self.workers:
+            pid, status = os.wait()
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            # A worker that has gone away shouldn't keep reporting its stale
+            # metrics, its replacement will start reporting fresh ones.
+            try:
+                os.unlink(metrics_path(self.metrics_dir, worker_id))
+            except FileNotFoundError:
+                pass
+
+            if not self.stopping:
+                print(
+                    "Worker {} (pid {}) exited with status {}, "
+                    "restarting.".format(worker_id, pid, status),
+                    file=sys.stderr,
+                )
+                time.sleep(self.restart_delay)
+                if not self.stopping:
+                    self._spawn(worker_id)
@@ -11,34 +11,95 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import gzip
 import json
+import logging
 
-import arrow
 import aiohttp
 
-from oauthlib.oauth2.rfc6749.errors import TokenExpiredError
-
+from . import _metrics as m
 from ._oauth2 import ServiceApplicationClient
+from ._retry import RetryPolicy
+from ._tokens import TokenError, TokenManager
+
+
+API_URL = "https://www.googleapis.com"
 
+TOKEN_PATH = "/oauth2/v4/token"
+STREAMING_PATH = (
+    "/bigquery/v2/projects/{project_id}/"
+    "datasets/{dataset_id}/tables/{table_id}/insertAll"
+)
 
 GOOGLE_AUDIENCE = "https://www.googleapis.com/oauth2/v4/token"
-GOOGLE_TOKEN_URL = "https://www.googleapis.com/oauth2/v4/token"
+GOOGLE_TOKEN_URL = API_URL + TOKEN_PATH
 
 BIGQUERY_SCOPE = "https://www.googleapis.com/auth/bigquery"
 
-STREAMING_URL = (
-    "https://www.googleapis.com/bigquery/v2/projects/{project_id}/"
-    "datasets/{dataset_id}/tables/{table_id}/insertAll"
-)
+STREAMING_URL = API_URL + STREAMING_PATH
+
+logger = logging.getLogger(__name__)
+
+# Errors with these reasons are (generally) transient, and a request or a
+# row that failed with one of them may succeed if we try it again. Anything
+# else, like "invalid", is going to fail no matter how many times we retry.
+# Note that "stopped" is what BigQuery says about otherwise good rows in a
+# request that was stopped because of some other, bad, row.
+RETRYABLE_REASONS = frozenset([
+    "backendError",
+    "internalError",
+    "quotaExceeded",
+    "rateLimitExceeded",
+    "stopped",
+    "timeout",
+])
+
+RETRYABLE_STATUSES = frozenset([401, 408, 429])
+
+
+class BigQueryError(Exception):
+
+    def __init__(self, message, *, reason=None, retryable=False):
+        super().__init__(message)
+        self.reason = reason
+        self.retryable = retryable
+
+
+def _error_reason(errors):
+    # A row can fail for more than one reason, and if any of them are not
+    # retryable then neither is the row, so we want to report that reason.
+    reasons = [error.get("reason") for error in errors] or [None]
+    for reason in reasons:
+        if reason not in RETRYABLE_REASONS:
+            return reason, False
+    return reasons[0], True
+
+
+def encode_row(insert_id, row):
+    # Rows are encoded to JSON exactly once, when they're produced, and then
+    # the encoded bytes are spliced directly into the request body in
+    # insert_all, rather than re-encoding every row for every request.
+    return json.dumps(
+        {"insertId": insert_id, "json": row},
+        separators=(",", ":"),
+    ).encode("utf8")
 
 
-class BigQueryEncoder(json.JSONEncoder):
+def encode_request(rows, template_suffix=None, skip_invalid_rows=False):
+    data = {"kind": "bigquery#tableDataInsertAllRequest"}
 
-    def default(self, obj):
-        if isinstance(obj, arrow.Arrow):
-            return obj.float_timestamp
+    if template_suffix is not None:
+        data["templateSuffix"] = template_suffix
 
-        return super().default(obj)
+    if skip_invalid_rows:
+        data["skipInvalidRows"] = True
+
+    # Encode our envelope, and then open up the closing brace to add our
+    # already encoded rows onto the end of it.
+    envelope = json.dumps(data, separators=(",", ":")).encode("utf8")
+
+    return b"".join([envelope[:-1], b',"rows":[', b",".join(rows), b"]}"])
 
 
 class _BigQueryClientSession:
@@ -53,66 +114,172 @@ class _BigQueryClientSession:
     def __exit__(self, *args, **kwargs):
         self.session.close()
 
-    async def _get_token(self):
-        url, headers, body, = self.client.oauth2.prepare_token_request(
-            GOOGLE_TOKEN_URL,
-            scope=BIGQUERY_SCOPE,
-        )
-
-        async with self.session.post(url, headers=headers, data=body) as resp:
-            assert resp.status == 200  # TODO: Better Error Handling
-            self.client.oauth2.parse_request_body_response(await resp.text())
+    async def _insert_all(self, rows, template_suffix=None,
+                          skip_invalid_rows=False):
+        try:
+            url, headers, body = await self.client.tokens.add_token(
+                self.client.streaming_url.format(
+                    project_id=self.client.project_id,
+                    dataset_id=self.client.dataset,
+                    table_id=self.client.table,
+                ),
+                http_method="POST",
+                headers={"Content-Type": "application/json"},
+                body=encode_request(
+                    rows,
+                    template_suffix=template_suffix,
+                    skip_invalid_rows=skip_invalid_rows,
+                ),
+            )
+        except TokenError as exc:
+            raise BigQueryError(
+                str(exc),
+                reason="token",
+                retryable=True,
+            ) from exc
+
+        # The rows in a request are very repetitive, so compressing them saves
+        # us a lot of bandwidth, but compressing a large request takes long
+        # enough that we don't want to do it on the event loop.
+        if self.client.compresslevel is not None:
+            body = await asyncio.get_event_loop().run_in_executor(
+                self.client.executor,
+                gzip.compress,
+                body,
+                self.client.compresslevel,
+            )
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+
+        m.UPLOADED_BYTES.inc(len(body))
+
+        # We've already compressed our body ourselves if we wanted to, so we
+        # don't want aiohttp to see our Content-Encoding and compress it again.
+        try:
+            with m.INSERT_SECONDS.time():
+                async with self.session.post(url, headers=headers, data=body,
+                                             compress=False) as resp:
+                    status = resp.status
+                    text = await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise BigQueryError(
+                "Error connecting to BigQuery: {!r}".format(exc),
+                reason="connection",
+                retryable=True,
+            ) from exc
+
+        # If BigQuery doesn't like our token anymore, then we'll make sure we
+        # get a new one before we try again.
+        if status == 401:
+            self.client.tokens.invalidate()
+
+        if status != 200:
+            try:
+                reason, retryable = _error_reason(
+                    json.loads(text)["error"]["errors"]
+                )
+            except (ValueError, KeyError, TypeError):
+                reason, retryable = None, False
+
+            raise BigQueryError(
+                "BigQuery returned a {} response: {}".format(status, text),
+                reason=reason or "http_{}".format(status),
+                retryable=(
+                    retryable or
+                    status in RETRYABLE_STATUSES or
+                    status >= 500
+                ),
+            )
+
+        # A 200 that isn't the response we expect doesn't tell us whether our
+        # rows made it or not, and sending them again isn't going to tell us
+        # either.
+        try:
+            data = json.loads(text)
+            kind = data["kind"]
+        except (ValueError, KeyError, TypeError):
+            kind = None
 
-    async def _add_token(self, *args, **kwargs):
-        if not self.client.oauth2.access_token:
-            await self._get_token()
+        if kind != "bigquery#tableDataInsertAllResponse":
+            raise BigQueryError(
+                "BigQuery returned an unexpected response: {}".format(text),
+                reason="invalid_response",
+            )
 
-        try:
-            return self.client.oauth2.add_token(*args, **kwargs)
-        except TokenExpiredError:
-            await self._get_token()
-            return self.client.oauth2.add_token(*args, **kwargs)
+        return data.get("insertErrors", [])
 
     async def insert_all(self, rows, template_suffix=None,
                          skip_invalid_rows=False):
-        data = {
-            "kind": "bigquery#tableDataInsertAllRequest",
-            "rows": rows,
-        }
-
-        if template_suffix is not None:
-            data["templateSuffix"] = template_suffix
-
-        if skip_invalid_rows:
-            data["skipInvalidRows"] = True
-
-        url, headers, body = await self._add_token(
-            STREAMING_URL.format(
-                project_id=self.client.project_id,
-                dataset_id=self.client.dataset,
-                table_id=self.client.table,
-            ),
-            http_method="POST",
-            headers={"Content-Type": "application/json"},
-            body=json.dumps(data, cls=BigQueryEncoder),
-        )
-
-        async with self.session.post(url, headers=headers, data=body) as resp:
-            assert resp.status == 200  # TODO: Better Error Handling
-            data = await resp.json()
-
-        assert data["kind"] == "bigquery#tableDataInsertAllResponse"
-
-        for error in data.get("insertErrors", []):
-            print((rows[error["index"]], error["errors"]))
+        retry = self.client.retry
+        retry.budget.deposit()
+
+        attempt = 0
+        while True:
+            try:
+                insert_errors = await self._insert_all(
+                    rows,
+                    template_suffix=template_suffix,
+                    skip_invalid_rows=skip_invalid_rows,
+                )
+            except BigQueryError as exc:
+                if not exc.retryable or not retry.should_retry(attempt):
+                    m.FAILED_ROWS.labels(exc.reason).inc(len(rows))
+                    raise
+
+                m.INSERT_RETRIES.labels(exc.reason).inc()
+            else:
+                # Rows that failed for a reason that might go away are sent
+                # again, by themselves, rather than resending the entire
+                # request. Any others are never going to succeed, so we'll
+                # just report and drop them.
+                failed = []
+                for error in insert_errors:
+                    reason, retryable = _error_reason(error["errors"])
+                    m.INSERT_ERRORS.labels(reason).inc()
+                    if retryable:
+                        failed.append((rows[error["index"]], reason))
+                    else:
+                        m.FAILED_ROWS.labels(reason).inc()
+                        logger.warning(
+                            "Dropping row rejected by BigQuery: %r %r",
+                            rows[error["index"]],
+                            error["errors"],
+                        )
+
+                if not failed:
+                    return
+
+                rows = [row for row, _ in failed]
+                reason = failed[0][1]
+
+                if not retry.should_retry(attempt):
+                    m.FAILED_ROWS.labels(reason).inc(len(rows))
+                    raise BigQueryError(
+                        "{} rows failed after {} attempts".format(
+                            len(rows),
+                            attempt + 1,
+                        ),
+                        reason=reason,
+                        retryable=True,
+                    )
+
+                m.INSERT_RETRIES.labels(reason).inc()
+
+            await asyncio.sleep(retry.delay(attempt))
+            attempt += 1
 
 
 class BigQueryClient:
 
-    def __init__(self, project_id, dataset, table, client_id=None, key=None):
+    def __init__(self, project_id, dataset, table, client_id=None, key=None,
+                 retry=None, compresslevel=None, executor=None,
+                 streaming_url=STREAMING_URL, token_url=GOOGLE_TOKEN_URL):
         self.project_id = project_id
         self.dataset = dataset
         self.table = table
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.compresslevel = compresslevel
+        self.executor = executor
+        self.streaming_url = streaming_url
 
         self.oauth2 = ServiceApplicationClient(
             client_id,
@@ -120,6 +287,11 @@ class BigQueryClient:
             audience=GOOGLE_AUDIENCE,
             issuer=client_id,
         )
+        self.tokens = TokenManager(
+            self.oauth2,
+            token_url,
+            scope=BIGQUERY_SCOPE,
+        )
 
     def __repr__(self):
         return (
@@ -129,3 +301,6 @@ class BigQueryClient:
 
     def __call__(self):
         return _BigQueryClientSession(client=self)
+
+    def close(self):
+        self.tokens.close()
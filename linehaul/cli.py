@@ -12,18 +12,286 @@
 # limitations under the License.
 
 import asyncio
+import collections
+import concurrent.futures
+import functools
+import os.path
+import shutil
+import ssl
+import tempfile
+import time
 
 import click
 import prometheus_client
 
-from . import _tls as tls
-from ._click import AsyncCommand
-from ._server import Server
-from .bigquery import BigQueryClient
-from .core import Linehaul
+from . import _replay, _rollup, _tls as tls, parser, user_agents
+from ._fake_bigquery import FakeBigQuery, report as report_bigquery
+from ._loadgen import generate, report as report_load
+from ._admin import Admin, start as start_admin, stop as stop_admin
+from ._click import DefaultGroup, run
+from ._limiter import AIMDLimiter
+from ._pool import BoundedExecutor
+from ._retry import RetryPolicy
+from ._server import AppServer, Server
+from ._spool import Spool
+from ._workers import (
+    Supervisor, WorkerCollector, export_metrics, metrics_path,
+    start_metrics_server,
+)
+from .bigquery import API_URL, STREAMING_PATH, TOKEN_PATH, BigQueryClient
+from .core import Batcher, Linehaul, Rollup
+
+
+async def serve(*, bind, port, token, account, key, reuse_port, tls_ciphers,
+                tls_certificate, parser_engine, ua_cache_size,
+                max_concurrent_inserts, insert_latency_target, batch_max_rows,
+                batch_max_bytes, insert_attempts, insert_compression,
+                spool_dir, spool_max_bytes, parse_workers, max_line_length,
+                metrics_sample_rate, admin_bind, admin_port, api_url,
+                rollup_table, rollup_dimensions, rollup_interval,
+                rollup_max_keys, stream_raw, table, worker_id=None,
+                metrics_file=None, loop):
+    if metrics_file is not None:
+        exporter = loop.create_task(export_metrics(metrics_file))
+    else:
+        exporter = None
+
+    user_agents.cache.maxsize = ua_cache_size
+
+    # Every client has a token manager of its own, which we need to close
+    # once we're done with them.
+    clients = []
+
+    def client(table):
+        bq = BigQueryClient(
+            *table.split(":"),
+            client_id=account,
+            key=key,
+            retry=RetryPolicy(attempts=insert_attempts),
+            compresslevel=insert_compression,
+            streaming_url=api_url + STREAMING_PATH,
+            token_url=api_url + TOKEN_PATH,
+        )
+        clients.append(bq)
+        return bq
+
+    if tls_certificate is not None:
+        ssl_context = tls.create_context(tls_certificate, tls_ciphers)
+    else:
+        ssl_context = None
+
+    if spool_dir is not None:
+        # Every worker needs a spool of its own, a worker that gets restarted
+        # will pick up wherever its predecessor left off.
+        if worker_id is not None:
+            spool_dir = os.path.join(spool_dir, "worker-{}".format(worker_id))
+
+        spool = Spool(spool_dir, max_bytes=spool_max_bytes, loop=loop)
+    else:
+        spool = None
+
+    batcher = Batcher(
+        client(table),
+        limiter=AIMDLimiter(
+            maximum=max_concurrent_inserts,
+            latency_target=insert_latency_target,
+            loop=loop,
+        ),
+        spool=spool,
+        max_rows=batch_max_rows,
+        max_bytes=batch_max_bytes,
+        loop=loop,
+    )
+    batcher.start()
+
+    if rollup_table is not None:
+        # Our rollups go to a different table, but it's the same API and the
+        # same quota, so they share a limiter with everything else.
+        rollup = Rollup(
+            client(rollup_table),
+            dimensions=rollup_dimensions,
+            interval=rollup_interval,
+            max_keys=rollup_max_keys,
+            limiter=batcher.limiter,
+            max_rows=batch_max_rows,
+            max_bytes=batch_max_bytes,
+            loop=loop,
+        )
+        rollup.start()
+    else:
+        rollup = None
+
+    # Parsing can be moved off of our event loop and into a pool of processes,
+    # leaving the event loop to just deal with I/O.
+    if parse_workers:
+        pool = BoundedExecutor(
+            concurrent.futures.ProcessPoolExecutor(parse_workers),
+            max_inflight=parse_workers * 4,
+            loop=loop,
+        )
+    else:
+        pool = None
+
+    admin = None
+    try:
+        with Linehaul(token=token, batcher=batcher,
+                      parser_engine=parser_engine, pool=pool,
+                      rollup=rollup, stream_raw=stream_raw,
+                      max_line_length=max_line_length,
+                      sample_rate=metrics_sample_rate, loop=loop) as lh:
+            if admin_port is not None:
+                # Every worker gets an admin server of its own, since we'd
+                # want to know which one of them we were profiling.
+                admin = await start_admin(
+                    Admin(linehaul=lh, batcher=batcher, rollup=rollup,
+                          loop=loop),
+                    admin_bind,
+                    admin_port + (worker_id or 0),
+                    loop=loop,
+                )
+
+            async with Server(lh, bind, port,
+                              reuse_port=reuse_port,
+                              ssl=ssl_context,
+                              loop=loop) as s:
+                try:
+                    await s.wait_closed()
+                except asyncio.CancelledError:
+                    click.echo(click.style("Shutting Down...", fg="yellow"))
+    finally:
+        # All of our connections have been closed, but the rows that they've
+        # handed us still need to make it into BigQuery, or at least into our
+        # spool, before we can exit.
+        batcher.close()
+        await batcher.wait_closed()
+
+        # Whatever we've counted since our last flush would otherwise be lost.
+        if rollup is not None:
+            rollup.close()
+            await rollup.wait_closed()
+
+        if admin is not None:
+            await stop_admin(admin)
+
+        if pool is not None:
+            pool.shutdown()
+
+        for bq in clients:
+            bq.close()
+
+        if exporter is not None:
+            exporter.cancel()
 
 
-@click.command(cls=AsyncCommand)
+async def serve_fake_bigquery(fake, *, bind, port, interval, loop):
+    async with AppServer(fake.app(), bind, port, loop=loop):
+        click.echo("Fake BigQuery listening on {}:{}".format(bind, port))
+
+        try:
+            await report_bigquery(fake, interval=interval, echo=click.echo)
+        except asyncio.CancelledError:
+            click.echo(click.style("Shutting Down...", fg="yellow"))
+
+
+async def generate_load(host, port, *, connections, rate, duration, token,
+                        ssl_context, interval, loop):
+    stats = collections.Counter()
+    reporter = loop.create_task(
+        report_load(stats, interval=interval, echo=click.echo)
+    )
+
+    start = loop.time()
+    try:
+        await generate(
+            host,
+            port,
+            connections=connections,
+            rate=rate,
+            duration=duration,
+            token=token,
+            ssl=ssl_context,
+            stats=stats,
+            loop=loop,
+        )
+    except asyncio.CancelledError:
+        click.echo(click.style("Shutting Down...", fg="yellow"))
+    finally:
+        reporter.cancel()
+
+    elapsed = loop.time() - start
+    click.echo(
+        "Sent {:,} lines in {:.2f}s ({:,.0f} lines/sec), "
+        "{:.2f}s stalled on the server".format(
+            stats["lines"],
+            elapsed,
+            stats["lines"] / elapsed,
+            stats["stalled"],
+        )
+    )
+
+
+def _allow_api_url(api_url):
+    # oauthlib refuses to send our tokens anywhere but over https, which is
+    # exactly what we want, except when we've been pointed at a fake BigQuery
+    # for testing.
+    if api_url.startswith("http://"):
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+
+
+def _dimensions(ctx, param, value):
+    try:
+        return _rollup.parse_dimensions(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc)) from None
+
+
+def _float_range(minimum=None, maximum=None, *, min_open=False):
+    # click.FloatRange doesn't exist in the version of click that we use, so
+    # we check the range of our floats ourselves.
+    def check(ctx, param, value):
+        if value is None:
+            return value
+
+        if minimum is not None:
+            if value < minimum or (min_open and value == minimum):
+                raise click.BadParameter(
+                    "{} must be greater than {}{}.".format(
+                        value,
+                        "" if min_open else "or equal to ",
+                        minimum,
+                    )
+                )
+
+        if maximum is not None and value > maximum:
+            raise click.BadParameter(
+                "{} must be less than or equal to {}.".format(value, maximum)
+            )
+
+        return value
+
+    return check
+
+
+def _worker(serve, worker_id, *, metrics_dir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    run(
+        serve(
+            worker_id=worker_id,
+            metrics_file=metrics_path(metrics_dir, worker_id),
+            loop=loop,
+        ),
+        loop=loop,
+    )
+
+
+@click.group(cls=DefaultGroup, default="serve")
+def main():
+    pass
+
+
+@main.command("serve")
 @click.option("--bind", default="0.0.0.0")
 @click.option("--port", type=int, default=512)
 @click.option("--token")
@@ -44,26 +312,338 @@ from .core import Linehaul
     ),
 )
 @click.option("--metrics-port", type=int, default=12000)
+@click.option(
+    "--metrics-sample-rate",
+    type=float,
+    default=0.01,
+    callback=_float_range(0, 1),
+)
+@click.option("--admin-bind", default="127.0.0.1")
+@click.option("--admin-port", type=int)
+@click.option(
+    "--parser-engine",
+    type=click.Choice(sorted(parser.ENGINES)),
+    default="fast",
+)
+@click.option("--ua-cache-size", type=int, default=8192)
+@click.option("--max-concurrent-inserts", type=int, default=16)
+@click.option("--insert-latency-target", type=float, default=5.0)
+@click.option("--batch-max-rows", type=int, default=500)
+@click.option("--batch-max-bytes", type=int, default=5 * 1024 * 1024)
+@click.option("--insert-attempts", type=int, default=5)
+@click.option("--insert-compression", type=click.IntRange(0, 9))
+@click.option(
+    "--spool-dir",
+    type=click.Path(file_okay=False, writable=True, resolve_path=True),
+)
+@click.option("--spool-max-bytes", type=int, default=1024 * 1024 * 1024)
+@click.option("--parse-workers", type=click.IntRange(0), default=0)
+@click.option("--max-line-length", type=click.IntRange(1), default=64 * 1024)
+@click.option("--workers", type=click.IntRange(1), default=1)
+@click.option("--api-url", default=API_URL)
+@click.option("--rollup-table")
+@click.option(
+    "--rollup-dimensions",
+    default=",".join(_rollup.DEFAULT_DIMENSIONS),
+    callback=_dimensions,
+)
+@click.option(
+    "--rollup-interval",
+    type=float,
+    default=60.0,
+    callback=_float_range(0, min_open=True),
+)
+@click.option("--rollup-max-keys", type=click.IntRange(1), default=100000)
+@click.option("--stream-raw/--no-stream-raw", default=True)
 @click.argument("table")
-@click.pass_context
-async def main(ctx, bind, port, token, account, key, reuse_port, tls_ciphers,
-               tls_certificate, metrics_port, table):
-    # Start up our metrics server in another thread.
-    prometheus_client.start_http_server(metrics_port)
+def serve_command(bind, port, token, account, key, reuse_port, tls_ciphers,
+                  tls_certificate, metrics_port, metrics_sample_rate,
+                  admin_bind, admin_port, parser_engine, ua_cache_size,
+                  max_concurrent_inserts, insert_latency_target,
+                  batch_max_rows, batch_max_bytes, insert_attempts,
+                  insert_compression, spool_dir, spool_max_bytes,
+                  parse_workers, max_line_length, workers, api_url,
+                  rollup_table, rollup_dimensions, rollup_interval,
+                  rollup_max_keys, stream_raw, table):
+    if not stream_raw and rollup_table is None:
+        raise click.UsageError(
+            "--no-stream-raw requires --rollup-table, or nothing would be "
+            "sent at all"
+        )
 
-    bqc = BigQueryClient(*table.split(":"), client_id=account, key=key.read())
+    _allow_api_url(api_url)
 
-    if tls_certificate is not None:
-        ssl_context = tls.create_context(tls_certificate, tls_ciphers)
+    # We read our key up front, since every worker is going to need it, and
+    # they would otherwise all be sharing the same file object.
+    server = functools.partial(
+        serve,
+        bind=bind,
+        port=port,
+        token=token,
+        account=account,
+        key=key.read() if key is not None else None,
+        reuse_port=reuse_port,
+        tls_ciphers=tls_ciphers,
+        tls_certificate=tls_certificate,
+        parser_engine=parser_engine,
+        ua_cache_size=ua_cache_size,
+        max_concurrent_inserts=max_concurrent_inserts,
+        insert_latency_target=insert_latency_target,
+        batch_max_rows=batch_max_rows,
+        batch_max_bytes=batch_max_bytes,
+        insert_attempts=insert_attempts,
+        insert_compression=insert_compression,
+        spool_dir=spool_dir,
+        spool_max_bytes=spool_max_bytes,
+        parse_workers=parse_workers,
+        max_line_length=max_line_length,
+        metrics_sample_rate=metrics_sample_rate,
+        admin_bind=admin_bind,
+        admin_port=admin_port,
+        api_url=api_url,
+        rollup_table=rollup_table,
+        rollup_dimensions=rollup_dimensions,
+        rollup_interval=rollup_interval,
+        rollup_max_keys=rollup_max_keys,
+        stream_raw=stream_raw,
+        table=table,
+    )
+
+    if workers == 1:
+        # Start up our metrics server in another thread.
+        start_metrics_server(metrics_port)
+
+        loop = asyncio.get_event_loop()
+        run(server(loop=loop), loop=loop)
     else:
-        ssl_context = None
+        # Each of our workers will bind to the same port (which is what
+        # --reuse-port is for) and the kernel will spread the connections
+        # between them. Our own metrics server serves the metrics from all of
+        # our workers.
+        metrics_dir = tempfile.mkdtemp(prefix="linehaul-metrics-")
+        try:
+            registry = prometheus_client.CollectorRegistry()
+            registry.register(WorkerCollector(metrics_dir))
+            start_metrics_server(metrics_port, registry=registry)
+
+            supervisor = Supervisor(
+                workers,
+                functools.partial(_worker, server, metrics_dir=metrics_dir),
+                metrics_dir=metrics_dir,
+            )
+            supervisor.run()
+        finally:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+@main.command("replay")
+@click.option("--token")
+@click.option("--account")
+@click.option("--key", type=click.File("r"))
+@click.option("--table")
+@click.option(
+    "--parser-engine",
+    type=click.Choice(sorted(parser.ENGINES)),
+    default="fast",
+)
+@click.option("--batch-max-rows", type=int, default=500)
+@click.option("--batch-max-bytes", type=int, default=5 * 1024 * 1024)
+@click.option("--insert-attempts", type=int, default=5)
+@click.option("--insert-compression", type=click.IntRange(0, 9))
+@click.option(
+    "--checkpoint-dir",
+    type=click.Path(file_okay=False, writable=True, resolve_path=True),
+)
+@click.option("--jobs", type=click.IntRange(1), default=os.cpu_count())
+@click.option("--dry-run", is_flag=True, default=False)
+@click.option("--api-url", default=API_URL)
+@click.argument(
+    "files",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+)
+def replay_command(token, account, key, table, parser_engine, batch_max_rows,
+                   batch_max_bytes, insert_attempts, insert_compression,
+                   checkpoint_dir, jobs, dry_run, api_url, files):
+    if table is None and not dry_run:
+        raise click.UsageError("--table is required unless using --dry-run")
+
+    _allow_api_url(api_url)
+
+    replay = functools.partial(
+        _replay.replay,
+        table=table,
+        account=account,
+        key=key.read() if key is not None else None,
+        token=token,
+        engine=parser_engine,
+        max_rows=batch_max_rows,
+        max_bytes=batch_max_bytes,
+        insert_attempts=insert_attempts,
+        insert_compression=insert_compression,
+        checkpoint_dir=checkpoint_dir,
+        dry_run=dry_run,
+        api_url=api_url,
+    )
+
+    # Every file gets replayed in a process of its own, which parses it and
+    # inserts its rows in order, checkpointing as it goes.
+    totals = collections.Counter()
+    failed = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {pool.submit(replay, filename): filename
+                   for filename in files}
+
+        for fut in concurrent.futures.as_completed(futures):
+            filename = futures[fut]
 
-    with Linehaul(token=token, bigquery=bqc, loop=ctx.event_loop) as lh:
-        async with Server(lh, bind, port,
-                          reuse_port=reuse_port,
-                          ssl=ssl_context,
-                          loop=ctx.event_loop) as s:
             try:
-                await s.wait_closed()
-            except asyncio.CancelledError:
-                click.echo(click.style("Shutting Down...", fg="yellow"))
+                stats = fut.result()
+            except Exception as exc:
+                failed.append(filename)
+                click.echo(
+                    click.style("{}: {}".format(filename, exc), fg="red"),
+                    err=True,
+                )
+                continue
+
+            if stats.get("skipped"):
+                click.echo("{}: already done, skipping".format(filename))
+                continue
+
+            totals.update(stats)
+            click.echo(
+                "{}: {} lines, {} rows, {} errors in {:.2f}s".format(
+                    filename,
+                    stats.get("lines", 0),
+                    stats.get("rows", 0),
+                    stats.get("errors", 0),
+                    stats["seconds"],
+                )
+            )
+
+    # Our files were processed in parallel, so the wall clock time is what
+    # matters for throughput, rather than the sum of each file's time.
+    elapsed = time.perf_counter() - start
+    click.echo(
+        "Total: {} lines, {} rows, {} errors, {} failed files in {:.2f}s "
+        "({:.0f} lines/s, {:.2f} MB/s)".format(
+            totals["lines"],
+            totals["rows"],
+            totals["errors"],
+            len(failed),
+            elapsed,
+            totals["lines"] / elapsed if elapsed else 0,
+            totals["bytes"] / elapsed / 1024 / 1024 if elapsed else 0,
+        )
+    )
+
+    if failed:
+        raise SystemExit(1)
+
+
+@main.command("fake-bigquery")
+@click.option("--bind", default="127.0.0.1")
+@click.option("--port", type=int, default=8080)
+@click.option("--latency", type=float, default=0.0)
+@click.option("--jitter", type=float, default=0.0)
+@click.option(
+    "--error-rate",
+    type=float,
+    default=0.0,
+    callback=_float_range(0, 1),
+)
+@click.option(
+    "--quota-rate",
+    type=float,
+    default=0.0,
+    callback=_float_range(0, 1),
+)
+@click.option(
+    "--row-error-rate",
+    type=float,
+    default=0.0,
+    callback=_float_range(0, 1),
+)
+@click.option(
+    "--invalid-row-rate",
+    type=float,
+    default=0.0,
+    callback=_float_range(0, 1),
+)
+@click.option("--seed", type=int)
+@click.option("--report-interval", type=float, default=5.0)
+def fake_bigquery_command(bind, port, latency, jitter, error_rate, quota_rate,
+                          row_error_rate, invalid_row_rate, seed,
+                          report_interval):
+    # Point linehaul at this with --api-url http://BIND:PORT, any key will
+    # do since we never check the tokens we're asked for.
+    fake = FakeBigQuery(
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        quota_rate=quota_rate,
+        row_error_rate=row_error_rate,
+        invalid_row_rate=invalid_row_rate,
+        seed=seed,
+    )
+
+    loop = asyncio.get_event_loop()
+    run(
+        serve_fake_bigquery(
+            fake,
+            bind=bind,
+            port=port,
+            interval=report_interval,
+            loop=loop,
+        ),
+        loop=loop,
+    )
+
+
+@main.command("loadgen")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=512)
+@click.option("--token")
+@click.option("--connections", type=click.IntRange(1), default=10)
+@click.option(
+    "--rate",
+    type=float,
+    default=1000,
+    callback=_float_range(0, min_open=True),
+)
+@click.option("--duration", type=float, help="Run forever if not given.")
+@click.option("--tls/--no-tls", default=False)
+@click.option(
+    "--tls-ca",
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    help="Don't verify the server's certificate if not given.",
+)
+@click.option("--report-interval", type=float, default=5.0)
+def loadgen_command(host, port, token, connections, rate, duration, tls,
+                    tls_ca, report_interval):
+    if tls:
+        ssl_context = ssl.create_default_context(cafile=tls_ca)
+        if tls_ca is None:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+    else:
+        ssl_context = None
+
+    loop = asyncio.get_event_loop()
+    run(
+        generate_load(
+            host,
+            port,
+            connections=connections,
+            rate=rate,
+            duration=duration,
+            token=token,
+            ssl_context=ssl_context,
+            interval=report_interval,
+            loop=loop,
+        ),
+        loop=loop,
+    )
@@ -12,35 +12,289 @@
 # limitations under the License.
 
 import asyncio
-import itertools
+import base64
+import collections
+import functools
+import logging
+import random
+import struct
+import time
 import weakref
-import uuid
+import zlib
 
-from . import parser, _metrics as m
+from . import parser, user_agents, _cache, _metrics as m, _rollup
+from .bigquery import BigQueryError, encode_row
+from ._limiter import AIMDLimiter
 from ._queue import CloseableFlowControlQueue, QueueClosed
+from .syslog import parser as syslog_parser
 from .syslog.protocol import SyslogProtocol
 
 
+logger = logging.getLogger(__name__)
+
+
 BATCH_SIZE = 500
+BATCH_BYTES = 5 * 1024 * 1024  # 5MB, half of BigQuery's request limit
 MAX_WAIT = 5 * 60  # 5 minutes
 
 
+# The most lines that we'll hand off to our parsing pool in one go.
+PARSE_BATCH_SIZE = 500
+
+# The fraction of events that we time each stage of processing for.
+SAMPLE_RATE = 0.01
+
+# How often we flush our rollup counts, and how many distinct keys we'll count
+# before flushing them early, to keep a bound on how much memory they use.
+ROLLUP_INTERVAL = 60
+ROLLUP_MAX_KEYS = 100000
+
+
+# How many distinct lines we remember, per connection, when telling apart
+# lines that are exactly the same.
+OCCURRENCE_WINDOW = 10000
+
+# Packs the checksums that make up an insertId into 12 bytes, which encode to
+# exactly 16 characters of base64 without any padding.
+_INSERT_ID = struct.Struct(">III")
+
+
+def insert_id(line, occurrence=0):
+    # Our insertIds are derived from the line itself, rather than being
+    # random, so that sending the same line twice, whether from a retry or
+    # from replaying a log, gives BigQuery the same insertId and lets it drop
+    # the duplicate for us. Lines that really are exactly the same (the same
+    # file, downloaded in the same second, through the same edge) are told
+    # apart by how many times we've already seen them, on any connection.
+    # We don't need a cryptographic hash for this, so we use a CRC32 and an
+    # Adler-32 of the line (along with its length), which zlib computes much
+    # faster than any hash in hashlib. The CRC alone already guarantees that
+    # lines which only differ within a few bytes of each other never collide.
+    digest = base64.urlsafe_b64encode(
+        _INSERT_ID.pack(zlib.crc32(line), zlib.adler32(line), len(line))
+    ).decode("ascii")
+
+    if occurrence:
+        return "{}-{}".format(digest, occurrence)
+    return digest
+
+
+class Occurrences:
+
+    # Counts how many times we've seen each line before, within a window of
+    # at least OCCURRENCE_WINDOW distinct lines. We only keep a hash of each
+    # line (the built in one, unless we're given another), rather than the
+    # line itself, and if two different lines ever happen to have the same
+    # hash, the worst that happens is that one of them gets an occurrence it
+    # didn't need.
+
+    def __init__(self, window=OCCURRENCE_WINDOW, *, key=hash):
+        self.window = window
+        self.key = key
+
+        self._current = {}
+        self._previous = {}
+
+    def count(self, lines):
+        current, previous = self._current, self._previous
+        key_of = self.key
+
+        counts = []
+        for line in lines:
+            key = key_of(line)
+            count = current.get(key)
+            if count is None:
+                count = previous.get(key, -1)
+            current[key] = count = count + 1
+            counts.append(count)
+
+            if len(current) >= self.window:
+                self._previous, self._current = current, {}
+                current, previous = self._current, self._previous
+
+        return counts
+
+    # Our counts can be saved and restored, so that counting can pick up
+    # where it left off in another process. That only works with a key that
+    # gives the same hash for a line in every process, which the built in
+    # hash doesn't.
+
+    def state(self):
+        return {
+            "current": list(self._current.items()),
+            "previous": list(self._previous.items()),
+        }
+
+    def load_state(self, state):
+        self._current = dict(state["current"])
+        self._previous = dict(state["previous"])
+
+
+def _encode(download, insert_id):
+    return (
+        download.timestamp,
+        encode_row(insert_id, download.serialize()),
+    )
+
+
+def _print_error(line, exc):
+    print((line, exc))  # TODO: Better Error Handling
+
+
+ParseResult = collections.namedtuple(
+    "ParseResult",
+    ["rows", "counts", "events", "ignored", "errors", "timings", "caches"],
+)
+
+
+def _error_reason(exc):
+    if isinstance(exc, user_agents.UnknownUserAgent):
+        return "unknown_user_agent"
+    return "invalid_message"
+
+
+def parse_batch(lines, *, occurrences=None, token=None, engine="fast",
+                rollup=None, raw=True, sample_rate=0.0,
+                on_error=_print_error):
+    # Does everything that needs to be done for a line, from a raw line of
+    # bytes all the way to an encoded row, for a whole batch of lines at a
+    # time. This might get run in our parsing pool, so it needs to be
+    # picklable and can't touch anything outside of its own process, which
+    # includes our metrics. Instead we return everything that our metrics
+    # need to know about this batch, and let record_batch take care of it.
+    rows = []
+    counts = collections.Counter()
+    events = 0
+    ignored = 0
+    errors = collections.Counter()
+    timings = []
+
+    # If we weren't told how many times we've seen each of these lines before,
+    # then we only look for duplicates within this batch.
+    if occurrences is None:
+        occurrences = Occurrences().count(lines)
+
+    decode = parser.ENGINES[engine]
+    clock = time.perf_counter
+
+    for line, occurrence in zip(lines, occurrences):
+        if token is not None:
+            if not line.startswith(token):
+                continue
+            line = line[len(token):]
+
+        # Timing every step of every event would cost us more than the steps
+        # themselves, so we only time a (random) sample of them.
+        sampled = sample_rate and random.random() < sample_rate
+        if sampled:
+            t0 = clock()
+
+        try:
+            message = syslog_parser.parse(line.decode("utf8"))
+        except Exception as exc:
+            errors["syslog"] += 1
+            on_error(line, exc)
+            continue
+
+        try:
+            if sampled:
+                t1 = clock()
+                fields = decode(message.message)
+                t2 = clock()
+                ua = user_agents.parse(fields[-1])
+                t3 = clock()
+                download = parser.create(fields, ua)
+                t4 = clock()
+            else:
+                download = parser.parse(message.message, engine=engine)
+        except Exception as exc:
+            errors[_error_reason(exc)] += 1
+            on_error(line, exc)
+            continue
+
+        if download is None:
+            ignored += 1
+            continue
+
+        events += 1
+
+        # If we're rolling our downloads up, then we count them here, rather
+        # than in the main process, so that it only has to merge our counts
+        # for the whole batch.
+        if rollup is not None:
+            counts[_rollup.key(download, rollup)] += 1
+
+        if raw:
+            rows.append(_encode(download, insert_id(line, occurrence)))
+
+        if sampled:
+            timings.extend([
+                ("syslog", t1 - t0),
+                ("decode", t2 - t1),
+                ("user_agent", t3 - t2),
+                ("record", t4 - t3),
+                ("serialize", clock() - t4),
+            ])
+
+    # Our caches count their hits and misses in whatever process they're in,
+    # so we hand those back too.
+    return ParseResult(
+        rows,
+        counts,
+        events,
+        ignored,
+        errors,
+        timings,
+        _cache.take_stats(),
+    )
+
+
+def parse_lines(lines, **kwargs):
+    return parse_batch(lines, **kwargs).rows
+
+
+def record_batch(result):
+    # Updates our metrics for an entire batch at once, rather than for every
+    # single event, since even just incrementing a counter adds up when it's
+    # done for every event.
+    m.EVENTS.inc(result.events)
+
+    if result.ignored:
+        m.IGNORED_EVENTS.inc(result.ignored)
+
+    for reason, count in result.errors.items():
+        m.PARSE_ERRORS.labels(reason).inc(count)
+
+    for stage, seconds in result.timings:
+        m.STAGE_SECONDS.labels(stage).observe(seconds)
+
+    _cache.record_stats(result.caches)
+
+
 class LinehaulProtocol(SyslogProtocol):
 
     transport = None
 
-    def __init__(self, *args, bigquery, **kwargs):
-        self.bigquery = bigquery
+    def __init__(self, *args, batcher, parser_engine="fast", pool=None,
+                 rollup=None, stream_raw=True, sample_rate=SAMPLE_RATE,
+                 occurrences=None, **kwargs):
+        self.batcher = batcher
+        self.parser_engine = parser_engine
+        self.pool = pool
+        self.rollup = rollup
+        self.stream_raw = stream_raw
+        self.sample_rate = sample_rate
+
+        self._lines = []
+        self._occurrences = (
+            occurrences if occurrences is not None else Occurrences()
+        )
+        self._parsing = collections.deque()
+        self._closed = False
+        self._removed = False
 
         return super().__init__(*args, **kwargs)
 
-    def _ensure_sender(self):
-        if self.sender is None or self.sender.done():
-            self.sender = asyncio.ensure_future(
-                send(self.bigquery, self.queue, loop=self.loop),
-                loop=self.loop,
-            )
-
     def close(self):
         if self.transport is not None:
             self.transport.close()
@@ -48,40 +302,414 @@ class LinehaulProtocol(SyslogProtocol):
     def connection_made(self, transport):
         super().connection_made(transport)
 
-        self.queue = CloseableFlowControlQueue(transport)
-        self.sender = None
+        self.batcher.add_producer(transport)
+        if self.pool is not None:
+            self.pool.add_transport(transport)
+        if self.rollup is not None:
+            self.rollup.add_transport(transport)
 
     def connection_lost(self, exc):
-        self.queue.close()
+        if self.pool is not None:
+            self.pool.remove_transport(self.transport)
+        if self.rollup is not None:
+            self.rollup.remove_transport(self.transport)
+
+        # If we still have lines being parsed, then we can't tell our batcher
+        # that we're gone until we've handed it the last of their rows.
+        self._closed = True
+        self._maybe_remove_producer()
 
         return super().connection_lost(exc)
 
-    def message_received(self, message):
-        try:
-            download = parser.parse(message.message)
-        except Exception as exc:
-            print((message, exc))  # TODO: Better Error Handling
+    def queue_sizes(self):
+        peer = None
+        if self.transport is not None:
+            peer = self.transport.get_extra_info("peername")
+
+        return {
+            "peer": "{}:{}".format(*peer[:2]) if peer else None,
+            "buffered_bytes": len(self._buffer),
+            "lines": len(self._lines),
+            "parsing": len(self._parsing),
+        }
+
+    def _maybe_remove_producer(self):
+        if self._closed and not self._parsing and not self._removed:
+            self._removed = True
+            self.batcher.remove_producer(self.transport)
+
+    def data_received(self, data):
+        super().data_received(data)
+
+        # Our lines were just collected by line_received, and now we'll parse
+        # them, either right here or by sending them off to our parsing pool
+        # in batches.
+        if self._lines:
+            lines, self._lines = self._lines, []
+
+            # Duplicate lines can span more than one batch, or even more than
+            # one connection, so we need to count them here, across every
+            # batch for every connection that shares our occurrences.
+            occurrences = self._occurrences.count(lines)
+
+            if self.pool is None:
+                self._put(self._parse(lines, occurrences))
+            else:
+                for i in range(0, len(lines), PARSE_BATCH_SIZE):
+                    self._submit(
+                        lines[i:i + PARSE_BATCH_SIZE],
+                        occurrences[i:i + PARSE_BATCH_SIZE],
+                    )
+
+    def line_received(self, line):
+        self._lines.append(line)
+
+    @property
+    def _dimensions(self):
+        return self.rollup.dimensions if self.rollup is not None else None
+
+    def _parse(self, lines, occurrences):
+        return parse_batch(
+            lines,
+            occurrences=occurrences,
+            token=self.token,
+            engine=self.parser_engine,
+            rollup=self._dimensions,
+            raw=self.stream_raw,
+            sample_rate=self.sample_rate,
+        )
+
+    def _submit(self, lines, occurrences):
+        fut = self.pool.submit(
+            parse_batch,
+            lines,
+            occurrences=occurrences,
+            token=self.token,
+            engine=self.parser_engine,
+            rollup=self._dimensions,
+            raw=self.stream_raw,
+            sample_rate=self.sample_rate,
+        )
+        self._parsing.append((fut, lines, occurrences))
+        fut.add_done_callback(self._parsed)
+
+    def _parsed(self, fut):
+        # Our batches might finish parsing in any order, but we want our rows
+        # to go into the batcher in the same order that they came in, so we
+        # only take batches off the front of our list once they're done.
+        while self._parsing and self._parsing[0][0].done():
+            fut, lines, occurrences = self._parsing.popleft()
+
+            if fut.cancelled():
+                continue
+
+            # parse_batch handles every error that a line can cause, so if we
+            # got one here then something went wrong with the pool itself,
+            # like one of its processes dying. Our lines are still perfectly
+            # good though, so rather than lose them we'll parse them here.
+            exc = fut.exception()
+            if exc is not None:
+                m.PARSE_POOL_ERRORS.inc()
+                logger.warning(
+                    "Parsing pool failed, parsing %d lines in process",
+                    len(lines),
+                    exc_info=exc,
+                )
+                self._put(self._parse(lines, occurrences))
+                continue
+
+            self._put(fut.result())
+
+        self._maybe_remove_producer()
+
+    def line_too_long(self):
+        m.DROPPED_LINES.labels("too_long").inc()
+
+    def _put(self, result):
+        for row in result.rows:
+            self.batcher.put(row)
+
+        if result.counts:
+            self.rollup.add(result.counts)
+
+        record_batch(result)
+        m.QUEUED.inc(len(result.rows))
+
+
+class Batcher:
+
+    # A single batching stage that is shared by all of the connections, so
+    # that rows from every connection end up in the same (full) batches, and
+    # we only need one sender talking to BigQuery instead of one for each
+    # connection.
+
+    def __init__(self, bigquery, *, limiter=None, spool=None, max_rows=None,
+                 max_bytes=None, loop=None):
+        self.bigquery = bigquery
+        self.spool = spool
+        self.max_rows = max_rows if max_rows is not None else BATCH_SIZE
+        self.max_bytes = max_bytes if max_bytes is not None else BATCH_BYTES
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.limiter = (
+            limiter if limiter is not None else AIMDLimiter(loop=self.loop)
+        )
+        self.queue = None
+        self.sender = None
+        self.drainer = None
+        self.session = None
+
+        self._closed = False
+        self._producers = set()
+        self._senders = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def start(self):
+        # If we have a spool, then our senders write their batches to it, and
+        # a single drainer is responsible for sending everything in it to
+        # BigQuery, including anything left over from a previous run.
+        if self.spool is not None:
+            self.spool.open()
+            self.drainer = asyncio.ensure_future(
+                drain(
+                    self._session(),
+                    self.spool,
+                    limiter=self.limiter,
+                    loop=self.loop,
+                ),
+                loop=self.loop,
+            )
+
+    def _session(self):
+        # All of our senders, and our drainer, share a single session with
+        # BigQuery for as long as we're running, rather than each opening up
+        # a new one.
+        if self.session is None:
+            self.session = self.bigquery()
+        return self.session
+
+    def queue_sizes(self):
+        data = {
+            "producers": len(self._producers),
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "senders": len(self._senders),
+            "inflight": self.limiter.inflight,
+        }
+
+        if self.spool is not None:
+            data["spool_segments"] = len(self.spool)
+            data["spool_bytes"] = self.spool.bytes
+
+        return data
+
+    def add_producer(self, transport):
+        # If we don't have a queue, or our last one was closed because all of
+        # the producers went away, then we'll need a new one.
+        if self.queue is None or self.queue.closed:
+            self.queue = CloseableFlowControlQueue()
+            self.sender = None
+
+        self._producers.add(transport)
+        self._idle.clear()
+        self.queue.add_transport(transport)
+
+    def remove_producer(self, transport):
+        self._producers.discard(transport)
+        if not self._producers:
+            self._idle.set()
+
+        if self.queue is not None:
+            self.queue.remove_transport(transport)
+
+            # Once the last producer has gone away, we'll close our queue,
+            # which will cause the sender to flush whatever rows are left in
+            # it and then exit.
+            if not self._producers:
+                self.queue.close()
+
+    def put(self, row):
+        self.queue.put_nowait(row)
+        self._ensure_sender()
+
+    def _ensure_sender(self):
+        if self.sender is None or self.sender.done():
+            self.sender = asyncio.ensure_future(
+                send(
+                    self._session(),
+                    self.queue,
+                    limiter=self.limiter,
+                    spool=self.spool,
+                    max_rows=self.max_rows,
+                    max_bytes=self.max_bytes,
+                    loop=self.loop,
+                ),
+                loop=self.loop,
+            )
+            # Keep track of all of our senders, including ones for queues
+            # that have been closed but are still being drained.
+            self._senders.add(self.sender)
+            self.sender.add_done_callback(self._senders.discard)
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        # Our producers might still be handing us their last rows, and once
+        # they've all gone away our senders will flush whatever is left.
+        await self._idle.wait()
+
+        if self._senders:
+            await asyncio.wait(list(self._senders))
+
+        # Everything that we were given is either in BigQuery or in our spool
+        # by now. If we've been closed then we only wait for the inserts that
+        # our drainer already has in flight, since everything else in the
+        # spool is already on disk and is sent the next time we start, and
+        # BigQuery might not be taking anything right now.
+        if self.spool is not None:
+            if self._closed:
+                self.spool.close()
+                await self.drainer
+            else:
+                await self.spool.join()
+
+        if self._closed and self.session is not None:
+            self.session.__exit__(None, None, None)
+            self.session = None
+
+
+class Rollup:
+
+    # Counts up our downloads by some set of dimensions, and every so often
+    # sends those counts off to a table of their own, as one row for each
+    # distinct key. Like our Batcher, this is shared by all of the connections.
+
+    def __init__(self, bigquery, *, dimensions=_rollup.DEFAULT_DIMENSIONS,
+                 interval=None, max_keys=None, limiter=None, max_rows=None,
+                 max_bytes=None, loop=None):
+        self.bigquery = bigquery
+        self.dimensions = tuple(dimensions)
+        self.interval = interval if interval is not None else ROLLUP_INTERVAL
+        self.max_keys = max_keys if max_keys is not None else ROLLUP_MAX_KEYS
+        self.max_rows = max_rows if max_rows is not None else BATCH_SIZE
+        self.max_bytes = max_bytes if max_bytes is not None else BATCH_BYTES
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.limiter = (
+            limiter if limiter is not None else AIMDLimiter(loop=self.loop)
+        )
+        self.counts = collections.Counter()
+        self.flusher = None
+
+        # All of our flushes go through a single queue and sender, and if the
+        # sender falls behind, the connections feeding us are paused until it
+        # has caught up again.
+        self.queue = CloseableFlowControlQueue()
+        self.sender = None
+
+    def start(self):
+        self.flusher = asyncio.ensure_future(
+            self._flush_periodically(),
+            loop=self.loop,
+        )
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush("interval")
+
+    def queue_sizes(self):
+        return {"keys": len(self.counts), "queued": self.queue.qsize()}
+
+    def add_transport(self, transport):
+        self.queue.add_transport(transport)
+
+    def remove_transport(self, transport):
+        self.queue.remove_transport(transport)
+
+    def add(self, counts):
+        ours = self.counts
+        for key, count in counts.items():
+            if key in ours:
+                ours[key] += count
+            else:
+                ours[_rollup.compact(key)] = count
+
+        m.ROLLUP_KEYS.set(len(ours))
+
+        # Our counts only grow with the number of distinct keys that we've
+        # seen, not with the number of downloads, but there's no bound on how
+        # many of those there might be, so once we have too many of them we
+        # flush early rather than keep using more memory.
+        if len(ours) >= self.max_keys:
+            self.flush("max_keys")
+
+    def flush(self, reason):
+        if not self.counts:
             return
 
-        if download is not None:
-            self.queue.put_nowait({
-                "insertId": str(uuid.uuid4()),
-                "json": download.serialize(),
-            })
-            m.EVENTS.inc()
-            m.QUEUED.inc()
+        counts, self.counts = self.counts, collections.Counter()
+        m.ROLLUP_KEYS.set(0)
+        m.ROLLUP_FLUSHES.labels(reason).inc()
+
+        # Our rows get sent exactly the same way as every other row, they
+        # just all show up at once.
+        rows = list(_rollup.encode(counts, self.dimensions))
+        for row in rows:
+            self.queue.put_nowait(row)
+        m.QUEUED.inc(len(rows))
 
         self._ensure_sender()
 
+    def _ensure_sender(self):
+        if self.sender is None or self.sender.done():
+            self.sender = asyncio.ensure_future(self._send(), loop=self.loop)
+
+    async def _send(self):
+        # Everything that we're going to send for a flush is put into our
+        # queue at once, so there's no point in waiting for any more of it.
+        with self.bigquery() as bq:
+            await send(
+                bq,
+                self.queue,
+                limiter=self.limiter,
+                max_rows=self.max_rows,
+                max_bytes=self.max_bytes,
+                max_wait=0,
+                loop=self.loop,
+            )
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+
+        self.flush("close")
+        self.queue.close()
+
+    async def wait_closed(self):
+        if self.sender is not None:
+            await self.sender
+
 
 class Linehaul:
 
-    def __init__(self, **options):
-        self.options = options
+    def __init__(self, *, batcher, loop=None, **options):
+        self.batcher = batcher
+        self.options = dict(options, loop=loop)
         self.protocols = weakref.WeakSet()
 
+        # An edge can send us the exact same line over two of its connections,
+        # and those are two different downloads, so we count our occurrences
+        # across all of our connections instead of for each one of them.
+        self.occurrences = Occurrences()
+
     def __call__(self, *args, **kwargs):
-        p = LinehaulProtocol(*args, **kwargs, **self.options)
+        p = LinehaulProtocol(
+            *args,
+            batcher=self.batcher,
+            occurrences=self.occurrences,
+            **kwargs,
+            **self.options
+        )
         self.protocols.add(p)
         return p
 
@@ -96,47 +724,222 @@ class Linehaul:
             protocol.close()
 
 
-def _extract_row_date(row):
-    return row["json"]["timestamp"].format("YYYYMDDD")
-
-
-async def send(client, queue, *, loop):
-    with client() as bq:
-        # Contiue processing rows while either the queue is not closed, or the
-        # queue is not empty. We want to exhaust it before finishing up.
-        while not queue.closed or not queue.empty():
-            all_rows = []
-
-            while len(all_rows) < BATCH_SIZE:
-                # Fetch an item off of the queue, if we have existing items in
-                # our list to be processed then we don't want to wait forever,
-                # prefering instead to send what we have. However if we do have
-                # items we'll only wait a few minutes before giving up and
-                # sending what we do have. In addition, if the queue is closed
-                # then we'll just go ahead and send what we have now since a
-                # closed, empty queue is never going to gain more items.
-                try:
-                    row = await asyncio.wait_for(
-                        queue.get(),
-                        timeout=MAX_WAIT if all_rows else None,
-                        loop=loop,
-                    )
-                except (asyncio.TimeoutError, QueueClosed):
-                    break
-
-                # Go ahead and add the row we've pulled off the queue onto our
-                # list of rows to process.
-                all_rows.append(row)
-                m.QUEUED.dec()
-
-            for date, rows in itertools.groupby(
-                    sorted(all_rows, key=_extract_row_date),
-                    _extract_row_date):
-                rows = list(rows)
-                suffix = rows[0]["json"]["timestamp"].format("YYYYMMDD")
-
-                await bq.insert_all(
-                    rows,
-                    template_suffix=suffix,
-                    skip_invalid_rows=True,
+def _finished(exc):
+    # Whether we're done with some rows that we tried to insert, either because
+    # they were inserted, or because they're never going to be, as opposed to
+    # having failed in a way that might succeed if they're sent again later.
+    return exc is None or (isinstance(exc, BigQueryError) and
+                           not exc.retryable)
+
+
+async def _insert(bq, limiter, rows, suffix, *, loop):
+    # Returns the exception that inserting our rows failed with, if it did.
+    size = sum(len(row) for row in rows)
+
+    m.REQUEST_ROWS.observe(len(rows))
+    m.REQUEST_BYTES.observe(size)
+    m.INFLIGHT_INSERTS.inc()
+    m.INFLIGHT_BYTES.inc(size)
+    start = loop.time()
+    try:
+        await bq.insert_all(
+            rows,
+            template_suffix=suffix,
+            skip_invalid_rows=True,
+        )
+    except Exception as exc:
+        limiter.release(error=True)
+        logger.warning(
+            "Failed to insert %d rows into %s",
+            len(rows),
+            suffix,
+            exc_info=exc,
+        )
+        return exc
+    else:
+        limiter.release(latency=loop.time() - start)
+        return None
+    finally:
+        m.INFLIGHT_INSERTS.dec()
+        m.INFLIGHT_BYTES.dec(size)
+
+
+async def _insert_segment(bq, limiter, spool, segment, rows, *, loop):
+    if _finished(await _insert(bq, limiter, rows, segment.suffix, loop=loop)):
+        spool.ack(segment)
+    else:
+        spool.nack(segment)
+
+
+async def drain(bq, spool, *, limiter, loop):
+    inserts = set()
+
+    while True:
+        try:
+            segment = await spool.get()
+        except QueueClosed:
+            break
+
+        try:
+            rows = await spool.read(segment)
+        except Exception as exc:
+            # Segments are only ever renamed into place once they've been
+            # completely written, so if we can't read one there's nothing
+            # that trying again is going to fix.
+            m.SPOOL_ERRORS.inc()
+            logger.error(
+                "Discarding unreadable spool segment %s",
+                segment.name,
+                exc_info=exc,
+            )
+            spool.ack(segment)
+            continue
+
+        await limiter.acquire()
+        insert = loop.create_task(
+            _insert_segment(bq, limiter, spool, segment, rows, loop=loop)
+        )
+        inserts.add(insert)
+        insert.add_done_callback(inserts.discard)
+
+    if inserts:
+        await asyncio.wait(list(inserts))
+
+
+class _Partition:
+
+    # The rows for a single day, which are all sent with the same template
+    # suffix, that haven't been sent yet.
+
+    def __init__(self, suffix, started):
+        self.suffix = suffix
+        self.started = started
+        self.rows = []
+        self.bytes = 0
+
+
+async def send(bq, queue, *, limiter, spool=None, max_rows, max_bytes,
+               max_wait=None, loop):
+    # Returns how many rows we failed to insert, which only ever happens when
+    # we don't have a spool to hand them to. A max_wait of 0 means that rows
+    # are sent as soon as there aren't any more waiting in the queue.
+    if max_wait is None:
+        max_wait = MAX_WAIT
+
+    inserts = set()
+    failed = 0
+
+    # Rows are put into a partition for the day that they happened on as soon
+    # as we pull them off of the queue, and each partition is sent on its own,
+    # as soon as it is full or has been waiting for long enough. Since nearly
+    # all of our rows are for the same day, there's usually only one of them,
+    # except right around midnight.
+    partitions = {}
+    suffixes = {}
+
+    def inserted(count, insert):
+        nonlocal failed
+        inserts.discard(insert)
+        if not insert.cancelled() and insert.result() is not None:
+            failed += count
+
+    async def flush(partition):
+        rows = partition.rows
+        m.QUEUED.dec(len(rows))
+
+        # If we have a spool, then we'll just write our batch to it and let
+        # the drainer worry about getting it into BigQuery.
+        if spool is not None:
+            await spool.write(partition.suffix, rows)
+            return
+
+        # Wait until our limiter lets us have another request in flight, and
+        # then start it in the background so we can go on to building the next
+        # batch. Since the limiter hands out slots in order, requests are
+        # still started in the order that their batches were built in.
+        await limiter.acquire()
+        insert = loop.create_task(
+            _insert(bq, limiter, rows, partition.suffix, loop=loop)
+        )
+        inserts.add(insert)
+        insert.add_done_callback(functools.partial(inserted, len(rows)))
+
+        # We don't otherwise give anything else a chance to run while we have
+        # rows in our queue, so this is where we let our insert get started.
+        await asyncio.sleep(0)
+
+    # Contiue processing rows while either the queue is not closed, or the
+    # queue is not empty. We want to exhaust it before finishing up.
+    while not queue.closed or not queue.empty():
+        # Fetch an item off of the queue, if we have rows waiting to be
+        # sent then we don't want to wait forever, preferring instead to
+        # send them once the oldest partition has waited for a few
+        # minutes. In addition, if the queue is closed then we'll just go
+        # ahead and send what we have now since a closed, empty queue is
+        # never going to gain more items.
+        timeout = None
+        if partitions:
+            started = min(p.started for p in partitions.values())
+            timeout = max(0, started + max_wait - loop.time())
+
+        try:
+            # Waiting on the queue costs us a whole task, so when it
+            # already has rows in it we just take them.
+            if (timeout != 0 or not max_wait) and not queue.empty():
+                timestamp, data = queue.get_nowait()
+            else:
+                timestamp, data = await asyncio.wait_for(
+                    queue.get(),
+                    timeout=timeout,
                 )
+        except asyncio.TimeoutError:
+            now = loop.time()
+            for date, partition in list(partitions.items()):
+                if now - partition.started >= max_wait:
+                    del partitions[date]
+                    await flush(partition)
+            continue
+        except QueueClosed:
+            break
+
+        date = int(timestamp // 86400)
+        partition = partitions.get(date)
+
+        # Our rows are already encoded, so we know exactly how many bytes
+        # each one will add to the request (plus the comma that separates
+        # it from the next row). If this row would push its partition over
+        # our limit, then we'll send what that partition has now and this
+        # row will start it over. A single row that is larger than our
+        # limit on its own still gets sent, just by itself.
+        size = len(data) + 1
+        if partition is not None and partition.bytes + size > max_bytes:
+            del partitions[date]
+            await flush(partition)
+            partition = None
+
+        if partition is None:
+            suffix = suffixes.get(date)
+            if suffix is None:
+                suffix = suffixes[date] = time.strftime(
+                    "%Y%m%d",
+                    time.gmtime(date * 86400),
+                )
+            partition = partitions[date] = _Partition(suffix, loop.time())
+
+        partition.rows.append(data)
+        partition.bytes += size
+
+        if (len(partition.rows) >= max_rows or
+                partition.bytes >= max_bytes):
+            del partitions[date]
+            await flush(partition)
+
+    for partition in partitions.values():
+        await flush(partition)
+
+    # Wait for any requests that are still in flight to finish, so that our
+    # caller knows that every row has either made it or failed.
+    if inserts:
+        await asyncio.wait(list(inserts))
+
+    return failed
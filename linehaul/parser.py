@@ -10,17 +10,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import enum
 import posixpath
-
-import arrow
-import pyrsistent
+import re
+import types
 
 from pyparsing import Literal as L, Word, Optional
 from pyparsing import printables as _printables, restOfLine
 from pyparsing import ParseException
 
 from . import user_agents
+from ._cache import LRUCache
+from ._records import Record, field
 
 
 class NullValue:
@@ -88,12 +90,12 @@ class PackageType(enum.Enum):
     unknown = None
 
 
-class File(pyrsistent.PRecord):
+class File(Record):
 
-    filename = pyrsistent.field(type=str, mandatory=True)
-    project = pyrsistent.field(type=str, mandatory=True)
-    version = pyrsistent.field(type=str, mandatory=True)
-    type = pyrsistent.field(
+    filename = field(type=str, mandatory=True)
+    project = field(type=str, mandatory=True)
+    version = field(type=str, mandatory=True)
+    type = field(
         type=(str, PackageType),
         mandatory=True,
         factory=PackageType,
@@ -101,17 +103,87 @@ class File(pyrsistent.PRecord):
     )
 
 
-class Download(pyrsistent.PRecord):
+_MONTHS = types.MappingProxyType({
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12,
+})
+
+# These are the zones that RFC 1123 (via RFC 822) allows, in practice Fastly
+# only ever sends us GMT.
+_ZONES = types.MappingProxyType({
+    "GMT": 0, "UT": 0, "UTC": 0,
+    "EST": -5 * 3600, "EDT": -4 * 3600,
+    "CST": -6 * 3600, "CDT": -5 * 3600,
+    "MST": -7 * 3600, "MDT": -6 * 3600,
+    "PST": -8 * 3600, "PDT": -7 * 3600,
+})
+
+_TIMESTAMP_RE = re.compile(
+    r"""
+    [A-Z][a-z]{2},\x20
+    (?P<day>[0-9]{2})\x20(?P<month>[A-Z][a-z]{2})\x20(?P<year>[0-9]{4})\x20
+    (?P<hour>[0-9]{2}):(?P<minute>[0-9]{2}):(?P<second>[0-9]{2})\x20
+    (?P<zone>[A-Z]+)
+    """,
+    re.VERBOSE,
+)
+
+# Fastly only gives us a timestamp with a resolution of one second, and we get
+# many events every second, so we keep a small cache of the timestamps that
+# we've seen recently to avoid having to parse the same one over and over.
+_timestamps = LRUCache(256, name="timestamp")
+
+
+def parse_timestamp(value):
+    timestamp = _timestamps.get(value)
+    if timestamp is not None:
+        return timestamp
+
+    m = _TIMESTAMP_RE.fullmatch(value)
+    if (m is None or m.group("month") not in _MONTHS or
+            m.group("zone") not in _ZONES):
+        raise ValueError("Invalid timestamp: {!r}".format(value))
+
+    timestamp = datetime.datetime(
+        int(m.group("year")),
+        _MONTHS[m.group("month")],
+        int(m.group("day")),
+        int(m.group("hour")),
+        int(m.group("minute")),
+        int(m.group("second")),
+        tzinfo=datetime.timezone.utc,
+    ).timestamp() - _ZONES[m.group("zone")]
+
+    _timestamps.set(value, timestamp)
+
+    return timestamp
+
 
-    timestamp = pyrsistent.field(
-        type=arrow.Arrow,
+class Download(Record):
+
+    timestamp = field(
+        type=float,
         mandatory=True,
-        factory=lambda t: arrow.get(t[5:-4], "DD MMM YYYY HH:mm:ss"),
+        factory=parse_timestamp,
+    )
+    country_code = field(type=(str, type(None)), mandatory=True)
+    url = field(type=str, mandatory=True)
+    file = field(type=File, mandatory=True, factory=File.create)
+    details = field(type=user_agents.UserAgent)
+
+
+# A lookup table mapping the raw package type strings that the grammar above
+# accepts to the value that we want to store, used by the fast decoder.
+_PACKAGE_TYPES = types.MappingProxyType(
+    dict(
+        [(t.value, t) for t in PackageType if t.value is not None] +
+        [("(null)", None)]
     )
-    country_code = pyrsistent.field(type=(str, type(None)), mandatory=True)
-    url = pyrsistent.field(type=str, mandatory=True)
-    file = pyrsistent.field(type=File, mandatory=True, factory=File.create)
-    details = pyrsistent.field(type=user_agents.UserAgent)
+)
+
+# The grammar only accepts printable ASCII (plus spaces and tabs) for the
+# pipe delimited fields, anything else is an error.
+_printable = re.compile(r"[ -~]*").fullmatch
 
 
 def _value_or_none(value):
@@ -121,29 +193,109 @@ def _value_or_none(value):
         return value
 
 
-def parse(message):
+def _decode_grammar(message):
     try:
         parsed = MESSAGE.parseString(message, parseAll=True)
     except ParseException as exc:
         raise ValueError("{!r} {}".format(message, exc)) from None
 
-    data = {}
-    data["timestamp"] = parsed.timestamp
-    data["country_code"] = _value_or_none(parsed.country_code)
-    data["url"] = parsed.url
-    data["file"] = {}
-    data["file"]["filename"] = posixpath.basename(parsed.url)
-    data["file"]["project"] = _value_or_none(parsed.project_name)
-    data["file"]["version"] = _value_or_none(parsed.version)
-    data["file"]["type"] = _value_or_none(parsed.package_type)
+    return (
+        parsed.timestamp,
+        _value_or_none(parsed.country_code),
+        parsed.url,
+        _value_or_none(parsed.project_name),
+        _value_or_none(parsed.version),
+        _value_or_none(parsed.package_type),
+        parsed.user_agent,
+    )
+
+
+def _null_or_value(value):
+    # This mirrors the NULL | Word(printables) in the grammar, which will not
+    # backtrack once it has matched a (null), so "(null)foo" is an error.
+    if value.startswith("(null)"):
+        if value != "(null)":
+            raise ValueError
+        return None
+    elif not value:
+        raise ValueError
+    return value
+
+
+def _decode_fast(message):
+    # pyparsing expands tabs and has its own ideas about trailing whitespace,
+    # so lines with either of those will just be handed off to the grammar.
+    if "\t" in message or "\n" in message:
+        return _decode_grammar(message)
+
+    parts = message.split("|", 6)
+    if len(parts) != 7:
+        raise ValueError("{!r} Expected 7 fields".format(message))
+
+    timestamp, country_code, url, project, version, package_type, ua = parts
+
+    if not _printable(message, 0, len(message) - len(ua)):
+        raise ValueError("{!r} Expected printable characters".format(message))
+
+    if not timestamp or not url:
+        raise ValueError("{!r} Expected a timestamp and url".format(message))
+
+    try:
+        project = _null_or_value(project)
+        version = _null_or_value(version)
+        package_type = _PACKAGE_TYPES[package_type]
+    except (ValueError, KeyError):
+        raise ValueError(
+            "{!r} Expected a project, version, and package type".format(
+                message,
+            )
+        ) from None
+
+    return (
+        timestamp,
+        country_code or None,
+        url,
+        project,
+        version,
+        package_type,
+        ua,
+    )
 
-    ua = user_agents.parse(parsed.user_agent)
+
+ENGINES = {
+    "fast": _decode_fast,
+    "pyparsing": _decode_grammar,
+}
+
+
+def parse(message, engine="fast"):
+    fields = ENGINES[engine](message)
+    return create(fields, user_agents.parse(fields[-1]))
+
+
+def create(fields, ua):
+    # Builds a Download out of the fields that one of our ENGINES decoded and
+    # the result of parsing its user agent. This is split out of parse so
+    # that each of those steps can be timed on its own.
     if ua is None:
         return  # Ignored user agents mean we'll skip trying to log this event
 
+    (timestamp, country_code, url, project, version, package_type,
+     user_agent) = fields
+
+    data = {}
+    data["timestamp"] = timestamp
+    data["country_code"] = country_code
+    data["url"] = url
+    data["file"] = {}
+    data["file"]["filename"] = posixpath.basename(url)
+    data["file"]["project"] = project
+    data["file"]["version"] = version
+    data["file"]["type"] = package_type
+
     data["details"] = ua
 
     try:
         return Download.create(data)
-    except (pyrsistent.PTypeError, pyrsistent.InvariantException) as exc:
+    except TypeError as exc:
         raise ValueError(str(exc)) from None
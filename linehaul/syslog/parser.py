@@ -11,15 +11,17 @@
 # limitations under the License.
 
 import datetime
+import re
 
 import arrow
-import pyrsistent
 
+from arrow.parser import ParserError
 from pyparsing import Combine, Literal as L, Word
 from pyparsing import srange, restOfLine, printables
 from pyparsing import ParseException
 
 from . import Facility, Severity
+from .._records import Record, field
 
 
 class NilValue:
@@ -48,7 +50,7 @@ TIMESTAMP = Word(printables)
 TIMESTAMP = TIMESTAMP.setResultsName("timestamp")
 TIMESTAMP.setName("Timestamp")
 
-HOSTNAME = Combine(NIL | Word(printables))
+HOSTNAME = NIL | Word(printables)
 HOSTNAME = HOSTNAME.setResultsName("hostname")
 HOSTNAME.setName("Hostname")
 
@@ -69,19 +71,100 @@ SYSLOG_MESSAGE = HEADER + COLON + SP + MESSAGE
 SYSLOG_MESSAGE.leaveWhitespace()
 
 
-class SyslogMessage(pyrsistent.PClass):
+# The hand written parser below mirrors the grammar above, but it is a good
+# deal faster since it avoids pyparsing entirely. Each of these character
+# classes is the regex equivalent of the pyparsing Word() used above, which
+# only ever matches printable ASCII.
+_FAST_HEADER_RE = re.compile(
+    r"""
+    <(?P<priority>[0-9]{1,3})>
+    (?P<timestamp>[!-~]+)\x20
+    (?P<hostname>[!-~]+)\x20
+    (?P<appname>[!-Z\\-~]+)
+    \[(?P<procid>[!-\\^-~]+)
+    """,
+    re.VERBOSE,
+)
+
+_FAST_TIMESTAMP_RE = re.compile(
+    r"""
+    (?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})
+    T
+    (?P<hour>[0-9]{2}):(?P<minute>[0-9]{2}):(?P<second>[0-9]{2})
+    (?:\.(?P<fraction>[0-9]{1,6}))?
+    (?:(?P<utc>Z)|(?P<offset>[+-][0-9]{2}:[0-9]{2}))
+    """,
+    re.VERBOSE,
+)
+
+
+def _parse_timestamp(value):
+    # If we've already got a datetime, then there's nothing left for us to do
+    # here, otherwise we'll defer to arrow to parse whatever we've been given.
+    if isinstance(value, datetime.datetime):
+        return value
+
+    # Some versions of arrow raise a RuntimeError instead of a ValueError for
+    # a timestamp they can't parse, and we want a bad timestamp to fail the
+    # same way no matter which of our parsers it went through.
+    try:
+        timestamp = arrow.get(value).datetime
+    except ParserError as exc:
+        raise ValueError(str(exc)) from None
+
+    # Those same versions will also give us a timestamp with a UTC offset of a
+    # day or more, which only fails once something asks for that offset, so
+    # we ask for it now.
+    timestamp.utcoffset()
+
+    return timestamp
 
-    facility = pyrsistent.field(type=int, mandatory=True, factory=Facility)
-    severity = pyrsistent.field(type=int, mandatory=True, factory=Severity)
-    timestamp = pyrsistent.field(
+
+def _fast_timestamp(value):
+    m = _FAST_TIMESTAMP_RE.fullmatch(value)
+    if m is None:
+        return value
+
+    try:
+        if m.group("utc"):
+            tz = datetime.timezone.utc
+        else:
+            offset = m.group("offset")
+            tz = datetime.timezone(
+                datetime.timedelta(hours=int(offset[1:3]),
+                                   minutes=int(offset[4:6])) *
+                (-1 if offset[0] == "-" else 1)
+            )
+
+        return datetime.datetime(
+            int(m.group("year")),
+            int(m.group("month")),
+            int(m.group("day")),
+            int(m.group("hour")),
+            int(m.group("minute")),
+            int(m.group("second")),
+            int((m.group("fraction") or "0").ljust(6, "0")),
+            tzinfo=tz,
+        )
+    except ValueError:
+        # Things like a 24:00:00 timestamp are valid ISO 8601, but aren't
+        # valid for datetime, so we'll let arrow sort those out.
+        return value
+
+
+class SyslogMessage(Record):
+
+    facility = field(type=int, mandatory=True, factory=Facility)
+    severity = field(type=int, mandatory=True, factory=Severity)
+    timestamp = field(
         type=datetime.datetime,
         mandatory=True,
-        factory=lambda t: arrow.get(t).datetime,
+        factory=_parse_timestamp,
     )
-    hostname = pyrsistent.field(type=(str, type(None)), mandatory=True)
-    appname = pyrsistent.field(type=str, mandatory=True)
-    procid = pyrsistent.field(type=str, mandatory=True)
-    message = pyrsistent.field(type=str, mandatory=True)
+    hostname = field(type=(str, type(None)), mandatory=True)
+    appname = field(type=str, mandatory=True)
+    procid = field(type=str, mandatory=True)
+    message = field(type=str, mandatory=True)
 
 
 def _value_or_none(value):
@@ -91,7 +174,7 @@ def _value_or_none(value):
         return value
 
 
-def parse(message):
+def _parse_grammar(message):
     try:
         parsed = SYSLOG_MESSAGE.parseString(message, parseAll=True)
     except ParseException as exc:
@@ -107,3 +190,46 @@ def parse(message):
     data["message"] = parsed.message
 
     return SyslogMessage(**data)
+
+
+def _parse_fast(message):
+    # pyparsing expands tabs and treats newlines specially, rather than try to
+    # replicate that here we'll just hand those lines off to the grammar. The
+    # same goes for anything else that doesn't look like a normal line, we
+    # return None and let the grammar either parse it or generate the error.
+    if not message.startswith("<") or "\t" in message or "\n" in message:
+        return
+
+    header, sep, msg = message.partition("]: ")
+    if not sep:
+        return
+
+    m = _FAST_HEADER_RE.fullmatch(header)
+    if m is None:
+        return
+
+    hostname = m.group("hostname")
+    if hostname.startswith('"-"'):
+        if hostname != '"-"':
+            return
+        hostname = None
+
+    priority = int(m.group("priority"))
+    facility = priority // 8
+
+    return SyslogMessage(
+        facility=facility,
+        severity=priority - (facility * 8),
+        timestamp=_fast_timestamp(m.group("timestamp")),
+        hostname=hostname,
+        appname=m.group("appname"),
+        procid=m.group("procid"),
+        message=msg,
+    )
+
+
+def parse(message):
+    parsed = _parse_fast(message)
+    if parsed is None:
+        parsed = _parse_grammar(message)
+    return parsed
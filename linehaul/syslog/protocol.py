@@ -19,29 +19,89 @@ class LineProtocol(asyncio.Protocol):
 
     delimiter = b"\r\n"
 
+    def __init__(self, *args, max_line_length=64 * 1024, **kwargs):
+        self.max_line_length = max_line_length
+
+        return super().__init__(*args, **kwargs)
+
     def connection_made(self, transport):
         self.transport = transport
-        self._buffer = b""
+
+        # Whatever we've read, but haven't handed off as a line yet. Since
+        # every line that is longer than max_line_length gets thrown away,
+        # this never grows much past max_line_length plus a single read.
+        self._buffer = bytearray()
+        self._discarding = False
 
         return super().connection_made(transport)
 
     def data_received(self, data):
-        # Get all of the lines of the buffer, and the new data, and then split
-        # this into lines.
-        lines = (self._buffer + data).split(self.delimiter)
-
-        # The last line may not yet be complete, so we'll pop this data off of
-        # our list of lines and return it to the buffer.
-        self._buffer = lines.pop(-1)
-
-        # For each line that we've be given call our line_received method with
-        # the line.
-        for line in lines:
-            self.line_received(line)
+        buffer = self._buffer
+
+        if len(buffer) > len(data):
+            # We're in the middle of a line that is longer than what we were
+            # just given, so rather than copying all of it again on every
+            # read, we'll add onto it and only look for a delimiter in the
+            # bytes that we haven't already looked at.
+            scan = len(buffer) - len(self.delimiter) + 1
+            buffer += data
+            if buffer.find(self.delimiter, scan) == -1:
+                self._check_length()
+                return
+            data = bytes(buffer)
+            del buffer[:]
+        elif buffer:
+            # Our partial line is short, so it's cheaper to just join it onto
+            # the front of our new data, which is the common case when our
+            # lines are much shorter than our reads.
+            data = bytes(buffer) + data
+            del buffer[:]
+
+        lines = data.split(self.delimiter)
+        partial = lines.pop()
+        buffer += partial
+
+        # The first line we have is the end of a line that we've already
+        # decided was too long.
+        if self._discarding and lines:
+            self._discarding = False
+            del lines[0]
+
+        # Checking the length of every line costs about as much as splitting
+        # them did, so we only do it when our complete lines add up to more
+        # than max_line_length, since otherwise none of them can be too long.
+        # Even then, we only check each line on its own if one of them is.
+        if (lines and len(data) - len(partial) > self.max_line_length and
+                max(map(len, lines)) > self.max_line_length):
+            for line in lines:
+                if len(line) > self.max_line_length:
+                    self.line_too_long()
+                else:
+                    self.line_received(line)
+        else:
+            for line in lines:
+                self.line_received(line)
+
+        self._check_length()
+
+    def _check_length(self):
+        # If our partial line has gotten too long, then we'll throw it away,
+        # along with the rest of the line whenever it shows up. The end of our
+        # buffer might be the start of a delimiter, so it doesn't count
+        # towards the length of the line.
+        length = len(self._buffer) - len(self.delimiter) + 1
+        if length > self.max_line_length:
+            if not self._discarding:
+                self._discarding = True
+                self.line_too_long()
+            del self._buffer[:]
 
     def line_received(self, line):
         raise NotImplementedError
 
+    def line_too_long(self):
+        pass
+
     def send_line(self, line):
         self.transport.write(line + self.delimiter)
 
@@ -66,14 +126,21 @@ class SyslogProtocol(LineProtocol):
             else:
                 line = line[len(self.token):]
 
-        # We're going to just assume that all of our lines are valid UTF8 lines
-        line = line.decode("utf8")
-
-        # Actually parse our message and get a SyslogMessage object
-        message = parser.parse(line)
+        # We're going to assume that all of our lines are UTF8, and actually
+        # parse our message to get a SyslogMessage object. Lines that aren't
+        # either get handed off, rather than letting one bad line take down
+        # the entire connection.
+        try:
+            message = parser.parse(line.decode("utf8"))
+        except ValueError as exc:
+            self.invalid_line_received(line, exc)
+            return
 
         # Dispatch our message so that subclasses can handle them.
         self.message_received(message)
 
+    def invalid_line_received(self, line, exc):
+        pass
+
     def message_received(self, message):
         raise NotImplementedError
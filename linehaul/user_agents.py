@@ -14,87 +14,105 @@ import json
 import re
 
 import packaging.version
-import pyrsistent
 
-from packaging.specifiers import SpecifierSet
+from ._cache import LRUCache
+from ._records import Record, field
 
 
-class Installer(pyrsistent.PRecord):
+class UnknownUserAgent(ValueError):
+    pass
 
-    name = pyrsistent.field(type=str)
-    version = pyrsistent.field(type=str)
 
+class Installer(Record):
 
-class Implementation(pyrsistent.PRecord):
+    name = field(type=str)
+    version = field(type=str)
 
-    name = pyrsistent.field(type=str)
-    version = pyrsistent.field(type=str)
 
+class Implementation(Record):
 
-class LibC(pyrsistent.PRecord):
+    name = field(type=str)
+    version = field(type=str)
 
-    lib = pyrsistent.field(type=str)
-    version = pyrsistent.field(type=str)
 
+class LibC(Record):
 
-class Distro(pyrsistent.PRecord):
+    lib = field(type=str)
+    version = field(type=str)
 
-    name = pyrsistent.field(type=str)
-    version = pyrsistent.field(type=str)
-    id = pyrsistent.field(type=str)
-    libc = pyrsistent.field(type=LibC, factory=LibC.create)
 
+class Distro(Record):
 
-class System(pyrsistent.PRecord):
+    name = field(type=str)
+    version = field(type=str)
+    id = field(type=str)
+    libc = field(type=LibC, factory=LibC.create)
 
-    name = pyrsistent.field(type=str)
-    release = pyrsistent.field(type=str)
 
+class System(Record):
 
-class UserAgent(pyrsistent.PRecord):
+    name = field(type=str)
+    release = field(type=str)
 
-    installer = pyrsistent.field(type=Installer, factory=Installer.create)
-    python = pyrsistent.field(type=str)
-    implementation = pyrsistent.field(
+
+class UserAgent(Record):
+
+    installer = field(type=Installer, factory=Installer.create)
+    python = field(type=str)
+    implementation = field(
         type=Implementation,
         factory=Implementation.create,
     )
-    distro = pyrsistent.field(type=Distro, factory=Distro.create)
-    system = pyrsistent.field(type=System, factory=System.create)
-    cpu = pyrsistent.field(type=str)
-    openssl_version = pyrsistent.field(type=str)
+    distro = field(type=Distro, factory=Distro.create)
+    system = field(type=System, factory=System.create)
+    cpu = field(type=str)
+    openssl_version = field(type=str)
+
+
+_PIP_1_4 = packaging.version.Version("1.4")
+_PIP_6 = packaging.version.Version("6")
+
+
+def _pip_6(version):
+    # Equivalent to: version in SpecifierSet(">=6", prereleases=True)
+    return version >= _PIP_6
+
+
+def _pip_1_4(version):
+    # Equivalent to: version in SpecifierSet(">=1.4,<6", prereleases=True),
+    # which includes the rule that <6 excludes pre-releases of 6 itself.
+    return (
+        _PIP_1_4 <= version < _PIP_6 and
+        not (version.is_prerelease and
+             packaging.version.Version(version.base_version) == _PIP_6)
+    )
 
 
 class Parser:
 
-    @staticmethod
-    def pip_6_format(user_agent):
+    @classmethod
+    def pip_format(cls, user_agent):
         # We're only concerned about pip user agents.
         if not user_agent.startswith("pip/"):
             return
 
-        # This format was brand new in pip 6.0, so we'll need to restrict it
-        # to only versions of pip newer than that.
         version_str = user_agent.split()[0].split("/", 1)[1]
         version = packaging.version.parse(version_str)
-        if version not in SpecifierSet(">=6", prereleases=True):
-            return
 
-        return json.loads(user_agent.split(maxsplit=1)[1])
+        # The JSON format was brand new in pip 6.0, prior to that pip 1.4
+        # introduced a simpler format, and prior to pip 1.4 pip used the
+        # default urllib2 user agent and we have no way to identify it here.
+        if _pip_6(version):
+            return cls._pip_6_format(user_agent)
+        elif _pip_1_4(version):
+            return cls._pip_1_4_format(user_agent, version_str)
 
     @staticmethod
-    def pip_1_4_format(user_agent):
-        # We're only concerned about pip user agents.
-        if not user_agent.startswith("pip/"):
-            return
-
-        # This format was brand new in pip 1.4, and went away in pip 6.0, so
-        # we'll need to restrict it to only versions of pip between 1.4 and 6.0
-        version_str = user_agent.split()[0].split("/", 1)[1]
-        version = packaging.version.parse(version_str)
-        if version not in SpecifierSet(">=1.4,<6", prereleases=True):
-            return
+    def _pip_6_format(user_agent):
+        return json.loads(user_agent.split(maxsplit=1)[1])
 
+    @staticmethod
+    def _pip_1_4_format(user_agent, version_str):
         _, impl, system = user_agent.split()
 
         data = {
@@ -399,27 +417,51 @@ class Parser:
         m = cls._ignore_re.search(user_agent)
         return m is not None
 
+    # All of the formats, in the order that they should be tried, along with
+    # the leading product token (everything before the first "/" or space)
+    # that a user agent *must* have for that format to possibly match, or
+    # None if the format could match any user agent.
+    formats = [
+        ("pip_format", "pip"),
+        ("setuptools_format", "Python-urllib"),
+        ("distribute_format", "Python-urllib"),
+        ("pex_format", None),
+        ("conda_format", "conda"),
+        ("bandersnatch_format", "bandersnatch"),
+        ("z3c_pypimirror_format", "z3c.pypimirror"),
+        ("devpi_format", None),
+        ("artifactory_format", "Artifactory"),
+        ("pep381client_format", "pep381client"),
+        ("urllib2_format", "Python-urllib"),
+        ("requests_format", "python-requests"),
+        ("os_format", None),
+        ("browser_format", None),
+    ]
+
+    _product_re = re.compile(r"[^/ ]*")
+
+    @classmethod
+    def _compile(cls):
+        # Build up a table mapping each product token to the formats that we
+        # need to try for it, for anything else we only need to try the
+        # formats that can match any user agent.
+        cls._generic = tuple(
+            getattr(cls, name) for name, product in cls.formats
+            if product is None
+        )
+        cls._dispatch = {
+            product: tuple(
+                getattr(cls, name) for name, p in cls.formats
+                if p is None or p == product
+            )
+            for product in {p for _, p in cls.formats if p is not None}
+        }
+
     @classmethod
     def parse(cls, user_agent):
-        formats = [
-            cls.pip_6_format,
-            cls.pip_1_4_format,
-            cls.setuptools_format,
-            cls.distribute_format,
-            cls.pex_format,
-            cls.conda_format,
-            cls.bandersnatch_format,
-            cls.z3c_pypimirror_format,
-            cls.devpi_format,
-            cls.artifactory_format,
-            cls.pep381client_format,
-            cls.urllib2_format,
-            cls.requests_format,
-            cls.os_format,
-            cls.browser_format,
-        ]
-
-        for format in formats:
+        product = cls._product_re.match(user_agent).group()
+
+        for format in cls._dispatch.get(product, cls._generic):
             data = format(user_agent)
             if data is not None:
                 return UserAgent.create(data)
@@ -427,7 +469,33 @@ class Parser:
         if cls.ignored(user_agent):
             return
 
-        raise ValueError("Unknown UserAgent: {!r}".format(user_agent))
+        raise UnknownUserAgent("Unknown UserAgent: {!r}".format(user_agent))
+
+
+Parser._compile()
+
+
+# The vast majority of our traffic comes from a relatively small number of
+# distinct user agents, so we cache the result of parsing them. This includes
+# ignored (None) and unknown user agents, so that repeated bot traffic doesn't
+# have to go through every format just to fail again.
+cache = LRUCache(8192, name="user_agent")
+
+_MISSING = object()
+_UNKNOWN = object()
+
+
+def parse(user_agent):
+    result = cache.get(user_agent, _MISSING)
+
+    if result is _MISSING:
+        try:
+            result = Parser.parse(user_agent)
+        except UnknownUserAgent:
+            result = _UNKNOWN
+        cache.set(user_agent, result)
 
+    if result is _UNKNOWN:
+        raise UnknownUserAgent("Unknown UserAgent: {!r}".format(user_agent))
 
-parse = Parser.parse
+    return result
@@ -0,0 +1,179 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import pstats
+import threading
+import tracemalloc
+
+import aiohttp
+import pretend
+import pytest
+
+from linehaul import _admin
+
+
+class _Server:
+
+    async def __aenter__(self):
+        linehaul = pretend.stub(
+            protocols=[
+                pretend.stub(
+                    queue_sizes=lambda: {"peer": "1.2.3.4:5", "lines": 3},
+                ),
+            ],
+        )
+        batcher = pretend.stub(queue_sizes=lambda: {"queued": 7})
+
+        self.server = await _admin.start(
+            _admin.Admin(linehaul=linehaul, batcher=batcher),
+            "127.0.0.1",
+            0,
+        )
+        self.session = aiohttp.ClientSession()
+
+        url = "http://127.0.0.1:{}".format(
+            self.server.sockets[0].getsockname()[1],
+        )
+        return self.session, url
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Older versions of aiohttp close their sessions right away, newer
+        # ones want us to wait for them to finish.
+        result = self.session.close()
+        if asyncio.iscoroutine(result):
+            await result
+
+        await _admin.stop(self.server)
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def test_sample():
+    done = threading.Event()
+
+    def busy():
+        while not done.is_set():
+            sum(range(100))
+
+    thread = threading.Thread(target=busy)
+    thread.start()
+    try:
+        samples = _admin.sample(thread.ident, 0.1, interval=0.001)
+    finally:
+        done.set()
+        thread.join()
+
+    assert sum(samples.values()) > 10
+    assert all("busy (" in stack for stack in samples)
+
+
+@pytest.mark.asyncio
+async def test_profile_collapsed():
+    async with _Server() as (session, url):
+        resp = await session.get(url + "/debug/profile?seconds=0.1")
+        assert resp.status == 200
+        body = await resp.text()
+
+        # Every line is a stack, with the number of times we saw it.
+        for line in body.splitlines():
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+        assert "_run_once" in body
+
+
+@pytest.mark.asyncio
+async def test_profile_pstats(tmpdir):
+    async with _Server() as (session, url):
+        resp = await session.get(
+            url + "/debug/profile?seconds=0.1&format=pstats",
+        )
+        assert resp.status == 200
+        assert "linehaul.pstats" in resp.headers["Content-Disposition"]
+        tmpdir.join("linehaul.pstats").write_binary(await resp.read())
+
+        stats = pstats.Stats(str(tmpdir.join("linehaul.pstats")))
+        assert stats.total_calls > 0
+
+
+@pytest.mark.asyncio
+async def test_profile_one_at_a_time():
+    async with _Server() as (session, url):
+        first = asyncio.ensure_future(
+            session.get(url + "/debug/profile?seconds=0.2")
+        )
+        await asyncio.sleep(0.05)
+
+        resp = await session.get(url + "/debug/profile?seconds=0.1")
+        assert resp.status == 409
+        resp.release()
+
+        resp = await first
+        assert resp.status == 200
+        resp.release()
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["seconds=abc", "seconds=0", "seconds=1000", "format=svg"],
+)
+@pytest.mark.asyncio
+async def test_profile_invalid(query):
+    async with _Server() as (session, url):
+        resp = await session.get(url + "/debug/profile?" + query)
+        assert resp.status == 400
+        resp.release()
+
+
+@pytest.mark.asyncio
+async def test_memory(tmpdir):
+    async with _Server() as (session, url):
+        resp = await session.get(url + "/debug/memory")
+        assert resp.status == 409
+        resp.release()
+
+        resp = await session.post(url + "/debug/memory/start?frames=5")
+        assert resp.status == 200
+        resp.release()
+        assert tracemalloc.is_tracing()
+
+        data = [bytearray(1024) for _ in range(100)]  # noqa
+
+        resp = await session.get(url + "/debug/memory?limit=5&group=traceback")
+        assert resp.status == 200
+        body = await resp.text()
+        assert body.startswith("Top 5 allocators by traceback:")
+        assert "test_admin.py" in body
+        assert "batcher queued: 7" in body
+        assert "lines=3 peer=1.2.3.4:5" in body
+
+        resp = await session.get(url + "/debug/memory/snapshot")
+        assert resp.status == 200
+        tmpdir.join("snapshot").write_binary(await resp.read())
+        snapshot = tracemalloc.Snapshot.load(str(tmpdir.join("snapshot")))
+        assert snapshot.traces
+
+        resp = await session.post(url + "/debug/memory/stop")
+        assert resp.status == 200
+        resp.release()
+        assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.asyncio
+async def test_queues():
+    async with _Server() as (session, url):
+        resp = await session.get(url + "/debug/queues")
+        assert await resp.json() == {
+            "connections": [{"peer": "1.2.3.4:5", "lines": 3}],
+            "batcher": {"queued": 7},
+        }
@@ -0,0 +1,394 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+import json
+import logging
+
+import aiohttp
+import pretend
+import pytest
+
+from linehaul import bigquery
+from linehaul._retry import RetryBudget, RetryPolicy
+from linehaul._server import Server
+
+
+class FakeResponse:
+
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        pass
+
+    async def text(self):
+        if isinstance(self.data, str):
+            return self.data
+        return json.dumps(self.data)
+
+
+class FakeSession:
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.encodings = []
+
+    def post(self, url, headers, data, compress=None):
+        assert compress is False
+        self.encodings.append(headers.get("Content-Encoding"))
+        if headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+
+        rows = json.loads(data.decode("utf8"))["rows"]
+        self.requests.append([row["insertId"] for row in rows])
+
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+async def _add_token(url, http_method, headers, body):
+    return url, headers, body
+
+
+def _session(monkeypatch, responses, attempts=3, reserve=10,
+             compresslevel=None):
+    session = FakeSession(responses)
+    monkeypatch.setattr(bigquery.aiohttp, "ClientSession", lambda: session)
+
+    client = bigquery.BigQueryClient(
+        "project",
+        "dataset",
+        "table",
+        retry=RetryPolicy(
+            attempts=attempts,
+            base=0,
+            budget=RetryBudget(reserve=reserve),
+        ),
+        compresslevel=compresslevel,
+    )
+    client.tokens = pretend.stub(
+        add_token=_add_token,
+        invalidate=pretend.call_recorder(lambda: None),
+    )
+
+    return client(), session
+
+
+@pytest.mark.asyncio
+async def test_client_close_closes_tokens():
+    client = bigquery.BigQueryClient("project", "dataset", "table")
+    client.tokens = pretend.stub(close=pretend.call_recorder(lambda: None))
+
+    client.close()
+
+    assert client.tokens.close.calls == [pretend.call()]
+
+
+def _ok(insert_errors=()):
+    data = {"kind": "bigquery#tableDataInsertAllResponse"}
+    if insert_errors:
+        data["insertErrors"] = [
+            {"index": index, "errors": [{"reason": reason}]}
+            for index, reason in insert_errors
+        ]
+    return FakeResponse(200, data)
+
+
+def _error(status, reason=None):
+    if reason is None:
+        return FakeResponse(status, "Oops")
+    return FakeResponse(status, {"error": {"errors": [{"reason": reason}]}})
+
+
+def _rows(count):
+    return [bigquery.encode_row(str(i), {}) for i in range(count)]
+
+
+def test_encode_row():
+    data = bigquery.encode_row("an-id", {"timestamp": 1.5, "url": "/é"})
+
+    assert isinstance(data, bytes)
+    assert json.loads(data.decode("utf8")) == {
+        "insertId": "an-id",
+        "json": {"timestamp": 1.5, "url": "/é"},
+    }
+
+
+@pytest.mark.parametrize(
+    ("kwargs", "expected"),
+    [
+        ({}, {}),
+        ({"template_suffix": "20160101"}, {"templateSuffix": "20160101"}),
+        ({"skip_invalid_rows": True}, {"skipInvalidRows": True}),
+    ],
+)
+def test_encode_request(kwargs, expected):
+    rows = [
+        bigquery.encode_row("1", {"a": 1}),
+        bigquery.encode_row("2", {"b": 2}),
+    ]
+
+    body = bigquery.encode_request(rows, **kwargs)
+
+    assert json.loads(body.decode("utf8")) == dict(
+        expected,
+        kind="bigquery#tableDataInsertAllRequest",
+        rows=[
+            {"insertId": "1", "json": {"a": 1}},
+            {"insertId": "2", "json": {"b": 2}},
+        ],
+    )
+
+
+def test_encode_request_no_rows():
+    body = bigquery.encode_request([])
+
+    assert json.loads(body.decode("utf8")) == {
+        "kind": "bigquery#tableDataInsertAllRequest",
+        "rows": [],
+    }
+
+
+@pytest.mark.asyncio
+async def test_insert_all_retries_only_failed_rows(monkeypatch):
+    session, fake = _session(
+        monkeypatch,
+        [
+            _ok([(1, "backendError"), (2, "invalid"), (3, "stopped")]),
+            _ok([(1, "timeout")]),
+            _ok(),
+        ],
+    )
+
+    await session.insert_all(_rows(5))
+
+    assert fake.requests == [["0", "1", "2", "3", "4"], ["1", "3"], ["3"]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "response",
+    [
+        _error(500),
+        _error(503),
+        _error(429),
+        _error(403, "rateLimitExceeded"),
+        aiohttp.ClientConnectionError(),
+    ],
+)
+async def test_insert_all_retries_transient_errors(monkeypatch, response):
+    session, fake = _session(monkeypatch, [response, _ok()])
+
+    await session.insert_all(_rows(2))
+
+    assert fake.requests == [["0", "1"], ["0", "1"]]
+
+
+@pytest.mark.asyncio
+async def test_insert_all_drops_permanent_row_errors(monkeypatch, caplog):
+    session, fake = _session(monkeypatch, [_ok([(1, "invalid")])])
+    failed = bigquery.m.FAILED_ROWS.labels("invalid")
+    before = failed._value.get()
+
+    with caplog.at_level(logging.WARNING, logger=bigquery.logger.name):
+        await session.insert_all(_rows(2))
+
+    assert fake.requests == [["0", "1"]]
+    assert failed._value.get() == before + 1
+    assert [r.getMessage() for r in caplog.records] == [
+        "Dropping row rejected by BigQuery: {!r} {!r}".format(
+            _rows(2)[1],
+            [{"reason": "invalid"}],
+        ),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "response",
+    [
+        _error(400, "invalid"),
+        _error(404, "notFound"),
+        _error(403),
+        FakeResponse(200, {"kind": "something#else"}),
+        FakeResponse(200, "Not JSON"),
+    ],
+)
+async def test_insert_all_does_not_retry_permanent(monkeypatch, response):
+    session, fake = _session(monkeypatch, [response, _ok()])
+
+    with pytest.raises(bigquery.BigQueryError) as excinfo:
+        await session.insert_all(_rows(2))
+
+    assert not excinfo.value.retryable
+    assert fake.requests == [["0", "1"]]
+
+
+@pytest.mark.asyncio
+async def test_insert_all_gives_up(monkeypatch):
+    session, fake = _session(
+        monkeypatch,
+        [_ok([(0, "backendError")]), _error(500), _error(500)],
+        attempts=3,
+    )
+
+    with pytest.raises(bigquery.BigQueryError) as excinfo:
+        await session.insert_all(_rows(2))
+
+    assert excinfo.value.retryable
+    assert excinfo.value.reason == "http_500"
+    assert fake.requests == [["0", "1"], ["0"], ["0"]]
+
+
+@pytest.mark.asyncio
+async def test_insert_all_respects_budget(monkeypatch):
+    session, fake = _session(
+        monkeypatch,
+        [_error(500), _error(500), _ok()],
+        reserve=1,
+    )
+
+    with pytest.raises(bigquery.BigQueryError):
+        await session.insert_all(_rows(1))
+
+    # We only had one retry in our budget, so we had to give up even though
+    # we had attempts left.
+    assert fake.requests == [["0"], ["0"]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    ("compresslevel", "encoding"),
+    [(None, None), (6, "gzip")],
+)
+async def test_insert_all_compression(monkeypatch, compresslevel, encoding):
+    session, fake = _session(monkeypatch, [_ok()], compresslevel=compresslevel)
+
+    await session.insert_all(_rows(3))
+
+    assert fake.requests == [["0", "1", "2"]]
+    assert fake.encodings == [encoding]
+
+
+def _dechunk(data):
+    # Returns the body of a chunked request, or None if we haven't gotten all
+    # of it yet.
+    body = b""
+    while True:
+        size, sep, data = data.partition(b"\r\n")
+        if not sep:
+            return
+        size = int(size, 16)
+        if size == 0:
+            return body
+        if len(data) < size + 2:
+            return
+        body, data = body + data[:size], data[size + 2:]
+
+
+class RecordingProtocol(asyncio.Protocol):
+
+    # Records the raw bytes of the requests that are sent to it, exactly as
+    # they came over the wire, and answers each of them like BigQuery would.
+
+    def __init__(self, requests):
+        self.requests = requests
+        self.data = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data += data
+
+        head, sep, body = self.data.partition(b"\r\n\r\n")
+        if not sep:
+            return
+
+        headers = {}
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower().decode("ascii")] = value.strip()
+
+        if "content-length" in headers:
+            if len(body) < int(headers["content-length"]):
+                return
+        else:
+            body = _dechunk(body)
+            if body is None:
+                return
+
+        self.requests.append((headers, body))
+
+        response = b'{"kind":"bigquery#tableDataInsertAllResponse"}'
+        self.transport.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Length: " + str(len(response)).encode("ascii") +
+            b"\r\n"
+            b"Connection: close\r\n"
+            b"\r\n" + response
+        )
+        self.transport.close()
+
+
+@pytest.mark.asyncio
+async def test_insert_all_compresses_once():
+    requests = []
+    async with Server(lambda: RecordingProtocol(requests),
+                      "127.0.0.1", 0) as server:
+        client = bigquery.BigQueryClient(
+            "project",
+            "dataset",
+            "table",
+            compresslevel=6,
+            streaming_url="http://127.0.0.1:{}/{}".format(
+                server.sockets[0].getsockname()[1],
+                "{project_id}/{dataset_id}/{table_id}",
+            ),
+        )
+        client.tokens = pretend.stub(add_token=_add_token)
+
+        session = client()
+        try:
+            await asyncio.wait_for(session.insert_all(_rows(3)), timeout=5)
+        finally:
+            # Older versions of aiohttp close their sessions right away, newer
+            # ones want us to wait for them to finish.
+            result = session.session.close()
+            if asyncio.iscoroutine(result):
+                await result
+
+    [(headers, body)] = requests
+    assert headers["content-encoding"] == b"gzip"
+
+    rows = json.loads(gzip.decompress(body).decode("utf8"))["rows"]
+    assert [row["insertId"] for row in rows] == ["0", "1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_insert_all_invalidates_rejected_token(monkeypatch):
+    session, fake = _session(monkeypatch, [_error(401), _ok()])
+
+    await session.insert_all(_rows(1))
+
+    assert fake.requests == [["0"], ["0"]]
+    assert session.client.tokens.invalidate.calls == [pretend.call()]
@@ -0,0 +1,76 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from linehaul import _cache, _metrics as m
+from linehaul._cache import LRUCache
+
+
+def _value(metric, name):
+    return metric.labels(name)._value.get()
+
+
+def test_hits_and_misses():
+    cache = LRUCache(2, name="test-hits")
+
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b", 2) == 2
+
+    assert cache.take_stats() == (1, 2, 0)
+    assert cache.take_stats() == (0, 0, 0)
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(2, name="test-evict")
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.take_stats() == (1, 0, 1)
+
+
+def test_shrinking_evicts():
+    cache = LRUCache(3, name="test-shrink")
+
+    for key in "abc":
+        cache.set(key, key)
+
+    cache.maxsize = 1
+
+    assert len(cache) == 1
+    assert "c" in cache
+    assert cache.take_stats() == (0, 0, 2)
+
+
+def test_record_stats():
+    cache = LRUCache(1, name="test-record")
+    cache.get("a")
+    cache.set("a", 1)
+    cache.get("a")
+    cache.set("b", 2)
+
+    # Whatever else has been using its cache shouldn't matter to us.
+    stats = [s for s in _cache.take_stats() if s[0] == "test-record"]
+    assert stats == [("test-record", 1, 1, 1)]
+    assert [s for s in _cache.take_stats() if s[0] == "test-record"] == []
+
+    _cache.record_stats(stats)
+
+    assert _value(m.CACHE_HITS, "test-record") == 1
+    assert _value(m.CACHE_MISSES, "test-record") == 1
+    assert _value(m.CACHE_EVICTIONS, "test-record") == 1
@@ -0,0 +1,899 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import threading
+
+import pretend
+import prometheus_client
+import pytest
+
+from linehaul import core, _metrics as m
+from linehaul._limiter import AIMDLimiter
+from linehaul._pool import BoundedExecutor
+from linehaul._spool import Spool
+from linehaul.bigquery import BigQueryError
+
+
+class FakeBigQuery:
+
+    def __init__(self):
+        self.inserts = []
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    async def insert_all(self, rows, template_suffix=None,
+                         skip_invalid_rows=False):
+        self.inserts.append((template_suffix, rows))
+
+
+def _value(metric, *labels):
+    # Reads a metric directly, rather than through the registry, since the
+    # names of the samples that it exports vary between versions of
+    # prometheus_client.
+    if labels:
+        metric = metric.labels(*labels)
+    return metric._value.get()
+
+
+def _transport():
+    return pretend.stub(
+        pause_reading=pretend.call_recorder(lambda: None),
+        resume_reading=pretend.call_recorder(lambda: None),
+    )
+
+
+@pytest.mark.asyncio
+async def test_batches_across_producers(monkeypatch):
+    monkeypatch.setattr(core, "BATCH_SIZE", 4)
+
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, loop=asyncio.get_event_loop())
+    t1, t2 = _transport(), _transport()
+
+    batcher.add_producer(t1)
+    batcher.add_producer(t2)
+
+    for i in range(6):
+        batcher.put((86400.0 * 2, str(i).encode("ascii")))
+    await asyncio.sleep(0.01)
+
+    # We should have only sent one full batch, the rest will wait around for
+    # more rows to come in, or for all of the producers to go away.
+    assert bq.inserts == [("19700103", [b"0", b"1", b"2", b"3"])]
+
+    batcher.remove_producer(t1)
+    assert not batcher.queue.closed
+    batcher.remove_producer(t2)
+    assert batcher.queue.closed
+
+    await batcher.wait_closed()
+
+    assert bq.inserts == [
+        ("19700103", [b"0", b"1", b"2", b"3"]),
+        ("19700103", [b"4", b"5"]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_batches_by_bytes():
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, max_rows=100, max_bytes=12)
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    for row in [b"aaaa", b"bbbb", b"cccc", b"d" * 20, b"ee"]:
+        batcher.put((0.0, row))
+    batcher.remove_producer(transport)
+
+    await batcher.wait_closed()
+
+    # Each row costs its length plus one for the separating comma, rows that
+    # would go over our limit start the next batch, and a row that is larger
+    # than the limit on its own is sent by itself.
+    assert bq.inserts == [
+        ("19700101", [b"aaaa", b"bbbb"]),
+        ("19700101", [b"cccc"]),
+        ("19700101", [b"d" * 20]),
+        ("19700101", [b"ee"]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_flushes_on_time(monkeypatch):
+    monkeypatch.setattr(core, "MAX_WAIT", 0.01)
+
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, loop=asyncio.get_event_loop())
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    batcher.put((0.0, b"0"))
+    batcher.put((86400.0, b"1"))
+
+    await asyncio.sleep(0.1)
+
+    assert bq.inserts == [("19700101", [b"0"]), ("19700102", [b"1"])]
+
+    batcher.remove_producer(transport)
+    await batcher.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_partitions_by_day():
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, max_rows=2, loop=asyncio.get_event_loop())
+    transport = _transport()
+
+    # Rows from either side of midnight can come in interleaved, but each day
+    # fills up a batch of its own rather than splitting each other's.
+    batcher.add_producer(transport)
+    for i in range(4):
+        batcher.put((86400.0 * (i % 2) + i, str(i).encode("ascii")))
+    await asyncio.sleep(0.01)
+
+    assert bq.inserts == [
+        ("19700101", [b"0", b"2"]),
+        ("19700102", [b"1", b"3"]),
+    ]
+
+    batcher.remove_producer(transport)
+    await batcher.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_partitions_flush_on_their_own_time(monkeypatch):
+    monkeypatch.setattr(core, "MAX_WAIT", 0.1)
+
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, loop=asyncio.get_event_loop())
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    batcher.put((0.0, b"0"))
+    await asyncio.sleep(0.06)
+    batcher.put((86400.0, b"1"))
+    await asyncio.sleep(0.06)
+
+    assert bq.inserts == [("19700101", [b"0"])]
+
+    await asyncio.sleep(0.06)
+
+    assert bq.inserts == [("19700101", [b"0"]), ("19700102", [b"1"])]
+
+    batcher.remove_producer(transport)
+    await batcher.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_new_producer_after_close():
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, loop=asyncio.get_event_loop())
+    t1, t2 = _transport(), _transport()
+
+    batcher.add_producer(t1)
+    batcher.put((0.0, b"0"))
+    batcher.remove_producer(t1)
+    first = batcher.queue
+
+    batcher.add_producer(t2)
+    batcher.put((0.0, b"1"))
+    batcher.remove_producer(t2)
+
+    assert batcher.queue is not first
+    await batcher.wait_closed()
+
+    assert sorted(bq.inserts) == [("19700101", [b"0"]), ("19700101", [b"1"])]
+
+
+@pytest.mark.asyncio
+async def test_pauses_all_producers():
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, loop=asyncio.get_event_loop())
+    t1, t2, t3 = _transport(), _transport(), _transport()
+
+    batcher.add_producer(t1)
+    batcher.add_producer(t2)
+    batcher.queue._high_water = 2
+
+    batcher.queue.put_nowait((0.0, b"0"))
+    assert t1.pause_reading.calls == []
+    batcher.queue.put_nowait((0.0, b"1"))
+    assert t1.pause_reading.calls == [pretend.call()]
+    assert t2.pause_reading.calls == [pretend.call()]
+
+    # Any new producers should start off paused too.
+    batcher.add_producer(t3)
+    assert t3.pause_reading.calls == [pretend.call()]
+
+    batcher.queue.get_nowait()
+    for t in [t1, t2, t3]:
+        assert t.resume_reading.calls == [pretend.call()]
+
+    for t in [t1, t2, t3]:
+        batcher.remove_producer(t)
+    await batcher.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_inserts(monkeypatch):
+    monkeypatch.setattr(core, "BATCH_SIZE", 1)
+
+    started = []
+    release = asyncio.Event()
+
+    class SlowBigQuery(FakeBigQuery):
+
+        async def insert_all(self, rows, **kwargs):
+            started.append(rows)
+            await release.wait()
+            await super().insert_all(rows, **kwargs)
+
+    bq = SlowBigQuery()
+    limiter = AIMDLimiter(initial=2, maximum=2)
+    batcher = core.Batcher(bq, limiter=limiter)
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    for i in range(4):
+        batcher.put((0.0, str(i).encode("ascii")))
+    await asyncio.sleep(0.01)
+
+    # Only two requests should be in flight at once, in the order that their
+    # batches were built.
+    assert started == [[b"0"], [b"1"]]
+    assert limiter.inflight == 2
+
+    release.set()
+    batcher.remove_producer(transport)
+    await batcher.wait_closed()
+
+    assert started == [[b"0"], [b"1"], [b"2"], [b"3"]]
+    assert len(bq.inserts) == 4
+    assert limiter.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_spools_batches(tmpdir):
+    # Anything left over in the spool from a previous run should be sent.
+    previous = Spool(str(tmpdir))
+    previous.open()
+    await previous.write("19700105", [b"old"])
+
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, spool=Spool(str(tmpdir)))
+    batcher.start()
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    batcher.put((0.0, b"0"))
+    batcher.put((86400.0, b"1"))
+    batcher.remove_producer(transport)
+
+    batcher.close()
+    await batcher.wait_closed()
+
+    assert sorted(bq.inserts) == [
+        ("19700101", [b"0"]),
+        ("19700102", [b"1"]),
+        ("19700105", [b"old"]),
+    ]
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_failed_batches(tmpdir):
+    errors = [
+        BigQueryError("Oops", retryable=True),
+        BigQueryError("Oops", retryable=False),
+    ]
+
+    class FailingBigQuery(FakeBigQuery):
+
+        async def insert_all(self, rows, **kwargs):
+            if errors:
+                raise errors.pop(0)
+            await super().insert_all(rows, **kwargs)
+
+    bq = FailingBigQuery()
+    spool = Spool(str(tmpdir), retry_delay=0)
+    batcher = core.Batcher(bq, spool=spool)
+    batcher.start()
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    batcher.put((0.0, b"0"))
+    batcher.remove_producer(transport)
+
+    # The first failure can be retried, so we should send it again, but the
+    # second can't, so we should give up on it.
+    await asyncio.wait_for(batcher.wait_closed(), timeout=1)
+
+    assert errors == []
+    assert bq.inserts == []
+    assert tmpdir.listdir() == []
+
+    batcher.close()
+    await batcher.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_close_leaves_failing_batches_in_spool(tmpdir):
+    class FailingBigQuery(FakeBigQuery):
+
+        async def insert_all(self, rows, **kwargs):
+            raise BigQueryError("Oops", retryable=True)
+
+    bq = FailingBigQuery()
+    batcher = core.Batcher(bq, spool=Spool(str(tmpdir), retry_delay=0.01))
+    batcher.start()
+    transport = _transport()
+
+    batcher.add_producer(transport)
+    batcher.put((0.0, b"0"))
+    batcher.remove_producer(transport)
+    await asyncio.sleep(0.05)
+
+    # BigQuery is never going to take our batch, but that shouldn't stop us
+    # from shutting down, since it's already safely in our spool.
+    batcher.close()
+    await asyncio.wait_for(batcher.wait_closed(), timeout=1)
+
+    assert bq.inserts == []
+    assert len(tmpdir.listdir()) == 1
+    assert batcher.drainer.done()
+
+
+@pytest.mark.asyncio
+async def test_spool_discards_unreadable_segments(tmpdir, caplog):
+    tmpdir.join("0000000000000000-19700101.seg").write("not gzip")
+    errors = _value(m.SPOOL_ERRORS)
+
+    bq = FakeBigQuery()
+    batcher = core.Batcher(bq, spool=Spool(str(tmpdir)))
+    batcher.start()
+
+    await asyncio.wait_for(batcher.wait_closed(), timeout=1)
+    batcher.close()
+    await batcher.wait_closed()
+
+    assert bq.inserts == []
+    assert tmpdir.listdir() == []
+    assert _value(m.SPOOL_ERRORS) == errors + 1
+    assert [r.getMessage() for r in caplog.records] == [
+        "Discarding unreadable spool segment 0000000000000000-19700101.seg",
+    ]
+
+
+LINE = (
+    "tok<134>2015-09-07T01:53:44Z cache-iad2122 linehaul[411617]: "
+    "Mon, 07 Sep 2015 01:53:44 GMT|US|"
+    "/packages/source/f/foo/foo-1.{}.tar.gz|foo|1.{}|sdist|"
+    "pip/1.5.6 CPython/3.5.1 Darwin/15.2.0\n"
+)
+
+
+def _versions(rows):
+    return [
+        json.loads(data.decode("utf8"))["json"]["file"]["version"]
+        for _, data in rows
+    ]
+
+
+def test_parse_lines():
+    lines = [
+        LINE.format(1, 1).encode("utf8").rstrip(),
+        b"notok" + LINE.format(2, 2).encode("utf8").rstrip(),
+        b"tok<134>garbage",
+        LINE.format(3, 3).encode("utf8").rstrip(),
+    ]
+
+    rows = core.parse_lines(lines, token=b"tok")
+
+    assert [ts for ts, _ in rows] == [1441590824.0, 1441590824.0]
+    assert _versions(rows) == ["1.1", "1.3"]
+
+
+def test_insert_id():
+    line = LINE.format(1, 1).encode("utf8")
+
+    assert core.insert_id(line) == core.insert_id(line)
+    assert len(core.insert_id(line)) == 16
+    assert core.insert_id(line, 1) == core.insert_id(line) + "-1"
+    assert core.insert_id(line) != core.insert_id(line + b" ")
+
+
+def test_occurrences():
+    occurrences = core.Occurrences(window=3)
+
+    assert occurrences.count([b"a", b"b", b"a"]) == [0, 0, 1]
+    assert occurrences.count([b"c", b"a"]) == [0, 2]
+
+    # We've seen more distinct lines than fit in our window, but we still
+    # remember the ones from the window before this one.
+    assert occurrences.count([b"d", b"e", b"f", b"a"]) == [0, 0, 0, 3]
+    assert occurrences.count([b"g", b"h", b"i", b"b"]) == [0, 0, 0, 0]
+
+
+def test_occurrences_state():
+    occurrences = core.Occurrences(window=3, key=len)
+    occurrences.count([b"a", b"bb", b"a", b"ccc", b"dddd"])
+
+    restored = core.Occurrences(window=3, key=len)
+    restored.load_state(json.loads(json.dumps(occurrences.state())))
+
+    assert restored.count([b"a", b"bb", b"eeeee"]) == [2, 1, 0]
+
+
+def test_parse_lines_insert_ids():
+    lines = [
+        LINE.format(1, 1).encode("utf8").rstrip(),
+        LINE.format(2, 2).encode("utf8").rstrip(),
+        LINE.format(1, 1).encode("utf8").rstrip(),
+    ]
+
+    def ids(rows):
+        return [json.loads(row.decode("utf8"))["insertId"] for _, row in rows]
+
+    first = ids(core.parse_lines(lines, token=b"tok"))
+
+    # The same lines always give us the same ids, even when they're parsed
+    # again, but lines that are exactly the same get their own ids.
+    assert first == ids(core.parse_lines(lines, token=b"tok"))
+    assert first[2] == first[0] + "-1"
+    assert len(set(first)) == 3
+
+    assert ids(
+        core.parse_lines(lines, occurrences=[3, 0, 4], token=b"tok")
+    ) == [first[0] + "-3", first[1], first[0] + "-4"]
+
+
+def test_parse_batch():
+    lines = [
+        LINE.format(1, 1).encode("utf8").rstrip(),
+        b"tok<134>garbage",
+        LINE.format(2, 2).encode("utf8").rstrip().replace(
+            b"pip/1.5.6 CPython/3.5.1 Darwin/15.2.0",
+            b"Go-http-client/1.1",
+        ),
+        LINE.format(3, 3).encode("utf8").rstrip().replace(
+            b"pip/1.5.6 CPython/3.5.1 Darwin/15.2.0",
+            b"a user agent we do not know about",
+        ),
+        LINE.format(4, 4).encode("utf8").rstrip().replace(b"|US|", b"|"),
+        LINE.format(5, 5).encode("utf8").rstrip(),
+    ]
+    errors = []
+
+    result = core.parse_batch(
+        lines,
+        token=b"tok",
+        sample_rate=1,
+        on_error=lambda line, exc: errors.append(line),
+    )
+
+    assert _versions(result.rows) == ["1.1", "1.5"]
+    assert result.events == 2
+    assert result.ignored == 1
+    assert result.errors == {
+        "syslog": 1,
+        "unknown_user_agent": 1,
+        "invalid_message": 1,
+    }
+    assert errors == [lines[1][3:], lines[3][3:], lines[4][3:]]
+
+    # Every stage was timed for every row, since we sampled everything.
+    stages = ["syslog", "decode", "user_agent", "record", "serialize"]
+    assert [stage for stage, _ in result.timings] == stages * 2
+    assert all(seconds >= 0 for _, seconds in result.timings)
+
+    assert core.parse_batch(lines, token=b"tok").timings == []
+
+
+def test_parse_batch_rollup():
+    lines = [
+        LINE.format(1, 1).encode("utf8").rstrip(),
+        LINE.format(2, 2).encode("utf8").rstrip(),
+        LINE.format(1, 1).encode("utf8").rstrip(),
+    ]
+    day = int(1441590824.0 // 86400)
+
+    result = core.parse_batch(
+        lines,
+        token=b"tok",
+        rollup=("version", "installer"),
+        raw=False,
+    )
+
+    assert result.rows == []
+    assert result.counts == {
+        (day, "1.1", "pip"): 2,
+        (day, "1.2", "pip"): 1,
+    }
+    assert result.events == 3
+
+    result = core.parse_batch(lines, token=b"tok", rollup=("project",))
+    assert _versions(result.rows) == ["1.1", "1.2", "1.1"]
+    assert result.counts == {(day, "foo"): 3}
+
+
+def test_record_batch():
+    def samples():
+        return [
+            _value(m.EVENTS),
+            _value(m.IGNORED_EVENTS),
+            _value(m.PARSE_ERRORS, "syslog"),
+            prometheus_client.REGISTRY.get_sample_value(
+                "linehaul_stage_seconds_count",
+                {"stage": "decode"},
+            ) or 0,
+            _value(m.CACHE_HITS, "test-record-batch"),
+        ]
+
+    before = samples()
+
+    core.record_batch(
+        core.ParseResult(
+            rows=[(0.0, b"a"), (0.0, b"b")],
+            counts=collections.Counter(),
+            events=2,
+            ignored=3,
+            errors=collections.Counter({"syslog": 4}),
+            timings=[("decode", 0.001), ("decode", 0.002)],
+            caches=[("test-record-batch", 5, 6, 7)],
+        )
+    )
+
+    after = samples()
+    assert [a - b for a, b in zip(after, before)] == [2, 3, 4, 2, 5]
+
+
+def test_protocol():
+    puts = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=pretend.call_recorder(lambda transport: None),
+        put=puts.append,
+    )
+    transport = _transport()
+
+    protocol = core.LinehaulProtocol(batcher=batcher, token="tok")
+    protocol.connection_made(transport)
+
+    data = "".join(LINE.format(i, i) for i in range(5)).encode("utf8")
+    protocol.data_received(data[:-10])
+    assert _versions(puts) == ["1.{}".format(i) for i in range(4)]
+
+    protocol.data_received(data[-10:])
+
+    # The same line in a later read still gets an id of its own.
+    protocol.data_received(LINE.format(0, 0).encode("utf8"))
+    protocol.connection_lost(None)
+
+    assert _versions(puts) == ["1.{}".format(i) for i in range(5)] + ["1.0"]
+    assert batcher.remove_producer.calls == [pretend.call(transport)]
+
+    ids = [json.loads(row.decode("utf8"))["insertId"] for _, row in puts]
+    assert ids[-1] == ids[0] + "-1"
+
+
+def test_protocols_share_occurrences():
+    puts = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=lambda transport: None,
+        put=puts.append,
+    )
+    lh = core.Linehaul(batcher=batcher, token="tok")
+
+    # The same line sent over two different connections is two different
+    # downloads, and BigQuery shouldn't drop either of them as a duplicate.
+    for _ in range(2):
+        protocol = lh()
+        protocol.connection_made(_transport())
+        protocol.data_received(LINE.format(0, 0).encode("utf8"))
+        protocol.connection_lost(None)
+
+    ids = [json.loads(row.decode("utf8"))["insertId"] for _, row in puts]
+    assert ids[1] == ids[0] + "-1"
+
+
+def test_protocol_rollup():
+    puts = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=lambda transport: None,
+        put=puts.append,
+    )
+    rollup = pretend.stub(
+        dimensions=("project",),
+        add=pretend.call_recorder(lambda counts: None),
+        add_transport=lambda transport: None,
+        remove_transport=lambda transport: None,
+    )
+
+    protocol = core.LinehaulProtocol(
+        batcher=batcher,
+        rollup=rollup,
+        stream_raw=False,
+        token="tok",
+    )
+    protocol.connection_made(_transport())
+    protocol.data_received(
+        "".join(LINE.format(i, i) for i in range(3)).encode("utf8")
+    )
+    protocol.connection_lost(None)
+
+    assert puts == []
+    assert rollup.add.calls == [
+        pretend.call({(int(1441590824.0 // 86400), "foo"): 3}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rollup():
+    bq = FakeBigQuery()
+    rollup = core.Rollup(
+        bq,
+        dimensions=("project", "version"),
+        max_keys=3,
+        loop=asyncio.get_event_loop(),
+    )
+
+    rollup.add(
+        collections.Counter({(1, "foo", "1.0"): 2, (1, "foo", "1.1"): 1})
+    )
+    rollup.add(collections.Counter({(1, "foo", "1.0"): 3}))
+    assert rollup.counts == {(1, "foo", "1.0"): 5, (1, "foo", "1.1"): 1}
+    await asyncio.sleep(0.01)
+    assert bq.inserts == []
+
+    # Once we have too many keys, we flush them all early.
+    rollup.add(collections.Counter({(2, "bar", "2.0"): 1}))
+    assert rollup.counts == {}
+    await asyncio.sleep(0.01)
+
+    def rows(insert):
+        suffix, rows = insert
+        return suffix, sorted(
+            (row["json"]["date"], row["json"]["version"], row["json"]["count"])
+            for row in (json.loads(row.decode("utf8")) for row in rows)
+        )
+
+    assert [rows(insert) for insert in bq.inserts] == [
+        ("19700102", [("1970-01-02", "1.0", 5), ("1970-01-02", "1.1", 1)]),
+        ("19700103", [("1970-01-03", "2.0", 1)]),
+    ]
+
+    # Whatever we have left is flushed when we're closed.
+    rollup.add(collections.Counter({(1, "foo", "1.0"): 7}))
+    rollup.close()
+    await rollup.wait_closed()
+
+    assert rows(bq.inserts[-1]) == ("19700102", [("1970-01-02", "1.0", 7)])
+
+
+@pytest.mark.asyncio
+async def test_rollup_shares_one_sender():
+    bq = FakeBigQuery()
+    client = pretend.call_recorder(lambda: bq)
+    rollup = core.Rollup(
+        client,
+        dimensions=("project",),
+        loop=asyncio.get_event_loop(),
+    )
+    rollup.queue = core.CloseableFlowControlQueue(maxsize=2)
+
+    transport = _transport()
+    rollup.add_transport(transport)
+
+    # Our connections are paused while the sender is behind, and resumed
+    # once it has caught up.
+    rollup.add(collections.Counter({(1, "foo"): 1, (1, "bar"): 1}))
+    rollup.flush("interval")
+    sender = rollup.sender
+    assert transport.pause_reading.calls == [pretend.call()]
+    await asyncio.sleep(0.01)
+    assert transport.resume_reading.calls == [pretend.call()]
+    assert len(bq.inserts) == 1
+
+    # Every flush goes through the same sender, and the same session.
+    rollup.add(collections.Counter({(1, "foo"): 1}))
+    rollup.flush("interval")
+    await asyncio.sleep(0.01)
+    assert rollup.sender is sender
+    assert len(bq.inserts) == 2
+
+    rollup.remove_transport(transport)
+    rollup.close()
+    await rollup.wait_closed()
+
+    assert sender.done()
+    assert client.calls == [pretend.call()]
+
+
+@pytest.mark.asyncio
+async def test_rollup_flushes_on_time():
+    bq = FakeBigQuery()
+    rollup = core.Rollup(
+        bq,
+        dimensions=("project",),
+        interval=0.05,
+        loop=asyncio.get_event_loop(),
+    )
+    rollup.start()
+
+    rollup.add(collections.Counter({(1, "foo"): 2}))
+    await asyncio.sleep(0.1)
+
+    assert len(bq.inserts) == 1
+    assert rollup.counts == {}
+
+    rollup.close()
+    await rollup.wait_closed()
+    assert len(bq.inserts) == 1
+
+
+@pytest.mark.parametrize(
+    "executor",
+    [
+        concurrent.futures.ThreadPoolExecutor,
+        concurrent.futures.ProcessPoolExecutor,
+    ],
+)
+@pytest.mark.asyncio
+async def test_protocol_with_pool(monkeypatch, executor):
+    monkeypatch.setattr(core, "PARSE_BATCH_SIZE", 2)
+
+    puts = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=pretend.call_recorder(lambda transport: None),
+        put=puts.append,
+    )
+    pool = BoundedExecutor(executor(2), max_inflight=4)
+    transport = _transport()
+
+    def lookups():
+        return (
+            _value(m.CACHE_HITS, "user_agent") +
+            _value(m.CACHE_MISSES, "user_agent")
+        )
+
+    before = lookups()
+
+    protocol = core.LinehaulProtocol(batcher=batcher, token="tok", pool=pool)
+    protocol.connection_made(transport)
+
+    data = "".join(LINE.format(i, i) for i in range(10)).encode("utf8")
+    protocol.data_received(data[:-10])
+    protocol.data_received(data[-10:])
+    protocol.connection_lost(None)
+
+    # We shouldn't go away until all of our lines have been parsed.
+    assert batcher.remove_producer.calls == []
+
+    while len(puts) < 10:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+
+    assert _versions(puts) == ["1.{}".format(i) for i in range(10)]
+    assert batcher.remove_producer.calls == [pretend.call(transport)]
+
+    # Even when our lines were parsed in another process, we still know how
+    # our caches did.
+    assert lookups() - before == 10
+
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_protocol_with_failing_pool(monkeypatch):
+    monkeypatch.setattr(core, "PARSE_BATCH_SIZE", 2)
+
+    parse_batch = core.parse_batch
+
+    def broken_parse_batch(lines, **kwargs):
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("Broken")
+        return parse_batch(lines, **kwargs)
+
+    monkeypatch.setattr(core, "parse_batch", broken_parse_batch)
+
+    errors = _value(m.PARSE_POOL_ERRORS)
+
+    puts = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=pretend.call_recorder(lambda transport: None),
+        put=puts.append,
+    )
+    pool = BoundedExecutor(
+        concurrent.futures.ThreadPoolExecutor(2),
+        max_inflight=4,
+    )
+    transport = _transport()
+
+    protocol = core.LinehaulProtocol(batcher=batcher, token="tok", pool=pool)
+    protocol.connection_made(transport)
+    protocol.data_received(
+        "".join(LINE.format(i, i) for i in range(3)).encode("utf8")
+    )
+    protocol.connection_lost(None)
+
+    while not batcher.remove_producer.calls:
+        await asyncio.sleep(0.01)
+
+    # Every batch failed in the pool, so they were all parsed in process.
+    assert _versions(puts) == ["1.0", "1.1", "1.2"]
+    assert _value(m.PARSE_POOL_ERRORS) == errors + 2
+
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_protocol_with_pool_keeps_order(monkeypatch):
+    monkeypatch.setattr(core, "PARSE_BATCH_SIZE", 1)
+
+    # Hold up our first batch until every other batch has been parsed, so
+    # that they finish out of order.
+    first = threading.Event()
+    parse_batch = core.parse_batch
+
+    def slow_parse_batch(lines, **kwargs):
+        if b"foo-1.0.tar.gz" in lines[0]:
+            first.wait(5)
+        else:
+            first.set()
+        return parse_batch(lines, **kwargs)
+
+    monkeypatch.setattr(core, "parse_batch", slow_parse_batch)
+
+    puts = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=lambda transport: None,
+        put=puts.append,
+    )
+    pool = BoundedExecutor(
+        concurrent.futures.ThreadPoolExecutor(3),
+        max_inflight=2,
+    )
+    transport = _transport()
+
+    protocol = core.LinehaulProtocol(batcher=batcher, token="tok", pool=pool)
+    protocol.connection_made(transport)
+    protocol.data_received(
+        "".join(LINE.format(i, i) for i in range(3)).encode("utf8")
+    )
+
+    # We've got more batches in flight than we're allowed, so we should
+    # have stopped reading.
+    assert transport.pause_reading.calls == [pretend.call()]
+
+    while len(puts) < 3:
+        await asyncio.sleep(0.01)
+
+    assert _versions(puts) == ["1.0", "1.1", "1.2"]
+    assert transport.resume_reading.calls == [pretend.call()]
+
+    pool.shutdown()
@@ -0,0 +1,153 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os.path
+import random
+import time
+
+import pytest
+
+from linehaul import bigquery, core
+from linehaul._fake_bigquery import FakeBigQuery
+from linehaul._loadgen import make_line
+from linehaul._retry import RetryPolicy
+from linehaul._server import AppServer
+
+
+with open(os.path.join(os.path.dirname(__file__), "test.pem")) as fp:
+    KEY = fp.read()
+
+
+def _client(monkeypatch, server, **kwargs):
+    monkeypatch.setenv("OAUTHLIB_INSECURE_TRANSPORT", "1")
+
+    api_url = "http://127.0.0.1:{}".format(
+        server.sockets[0].getsockname()[1],
+    )
+
+    client = bigquery.BigQueryClient(
+        "project",
+        "dataset",
+        "table",
+        client_id="test@example.com",
+        key=KEY,
+        retry=RetryPolicy(attempts=1),
+        streaming_url=api_url + bigquery.STREAMING_PATH,
+        token_url=api_url + bigquery.TOKEN_PATH,
+        **kwargs
+    )
+    return client()
+
+
+async def _close(session):
+    # Older versions of aiohttp close their sessions right away, newer ones
+    # want us to wait for them to finish.
+    result = session.session.close()
+    if asyncio.iscoroutine(result):
+        await result
+
+    session.client.close()
+
+
+def _rows(count):
+    rand = random.Random(0)
+
+    # Some of our load generator's user agents are ignored, so we keep going
+    # until we have as many rows as we asked for.
+    rows = []
+    while len(rows) < count:
+        rows.extend(
+            data for _, data in core.parse_lines([make_line(rand).rstrip()])
+        )
+    return rows
+
+
+@pytest.mark.parametrize("compresslevel", [None, 1])
+@pytest.mark.asyncio
+async def test_insert_all(monkeypatch, compresslevel):
+    fake = FakeBigQuery()
+    rows = _rows(10)
+    async with AppServer(fake.app(), "127.0.0.1", 0) as server:
+        session = _client(monkeypatch, server, compresslevel=compresslevel)
+        try:
+            await session.insert_all(rows[:6], template_suffix="20170101")
+            await session.insert_all(rows[6:], template_suffix="20170101")
+        finally:
+            await _close(session)
+
+    stats = fake.snapshot()
+    assert stats["tokens"] == 1
+    assert stats["requests"] == 2
+    assert stats["rows"] == len(rows)
+
+    # Our rows were stamped with the time they were made, so we should have
+    # been able to tell how long they took to get to us.
+    assert 0 <= stats["latency_max"] < 60
+
+
+@pytest.mark.parametrize(
+    ("options", "reason"),
+    [
+        ({"error_rate": 1}, "backendError"),
+        ({"quota_rate": 1}, "quotaExceeded"),
+        ({"row_error_rate": 1}, "backendError"),
+    ],
+)
+@pytest.mark.asyncio
+async def test_insert_all_errors(monkeypatch, options, reason):
+    fake = FakeBigQuery(**options)
+    async with AppServer(fake.app(), "127.0.0.1", 0) as server:
+        session = _client(monkeypatch, server)
+        try:
+            with pytest.raises(bigquery.BigQueryError) as excinfo:
+                await session.insert_all(_rows(3))
+        finally:
+            await _close(session)
+
+    assert excinfo.value.reason == reason
+    assert excinfo.value.retryable
+    assert fake.stats["rows"] == 0
+
+
+@pytest.mark.asyncio
+async def test_insert_all_invalid_rows(monkeypatch):
+    fake = FakeBigQuery(invalid_row_rate=1)
+    async with AppServer(fake.app(), "127.0.0.1", 0) as server:
+        session = _client(monkeypatch, server)
+        try:
+            # Invalid rows are never going to succeed, so they just get
+            # dropped rather than failing the whole insert.
+            await session.insert_all(_rows(3))
+        finally:
+            await _close(session)
+
+    assert fake.stats["row_errors"] == 3
+    assert fake.stats["rows"] == 0
+
+
+def test_snapshot_resets_latencies():
+    fake = FakeBigQuery()
+    now = time.time()
+    for delay in range(1, 101):
+        fake._observe(
+            {"file": {"project": "linehaul-loadgen", "version": str(now)}},
+            now + delay,
+        )
+    fake._observe({"file": {"project": "foo", "version": "1.0"}}, now)
+
+    stats = fake.snapshot()
+    assert stats["latency_p50"] == pytest.approx(51)
+    assert stats["latency_p99"] == pytest.approx(100)
+    assert stats["latency_max"] == pytest.approx(100)
+
+    assert fake.snapshot()["latency_p50"] is None
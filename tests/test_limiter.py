@@ -0,0 +1,90 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from linehaul._limiter import AIMDLimiter
+
+
+@pytest.mark.asyncio
+async def test_additive_increase_multiplicative_decrease():
+    limiter = AIMDLimiter(initial=2, maximum=4, latency_target=1.0)
+    assert limiter.concurrency == 2
+
+    # A window's worth of fast operations should grow our limit by one.
+    for _ in range(3):
+        await limiter.acquire()
+        limiter.release(latency=0.1)
+    assert limiter.concurrency == 3
+
+    # A slow operation should cut it back down.
+    await limiter.acquire()
+    limiter.release(latency=2.0)
+    assert limiter.concurrency == 1
+
+    # As should an error, but never below our minimum.
+    await limiter.acquire()
+    limiter.release(error=True)
+    assert limiter.concurrency == 1
+
+    for _ in range(100):
+        await limiter.acquire()
+        limiter.release(latency=0.1)
+    assert limiter.concurrency == 4
+
+
+@pytest.mark.asyncio
+async def test_limits_and_orders_waiters():
+    limiter = AIMDLimiter(initial=2, maximum=2)
+    order = []
+
+    async def worker(i):
+        await limiter.acquire()
+        order.append(i)
+
+    await limiter.acquire()
+    await limiter.acquire()
+    assert limiter.inflight == 2
+
+    tasks = [asyncio.ensure_future(worker(i)) for i in range(3)]
+    await asyncio.sleep(0)
+    assert order == []
+
+    limiter.release(latency=0)
+    await asyncio.sleep(0)
+    assert order == [0]
+
+    limiter.release(latency=0)
+    limiter.release(latency=0)
+    await asyncio.wait(tasks)
+    assert order == [0, 1, 2]
+    assert limiter.inflight == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter():
+    limiter = AIMDLimiter(initial=1, maximum=1)
+
+    await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    limiter.release(latency=0)
+    assert limiter.inflight == 0
+    await limiter.acquire()
+    assert limiter.inflight == 1
@@ -0,0 +1,67 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import random
+
+import pytest
+
+from linehaul import core
+from linehaul._loadgen import LOADGEN_PROJECT, generate, make_line
+
+
+def test_make_line():
+    line = make_line(random.Random(0), token=b"tok", now=1483228800.5)
+
+    assert line.startswith(b"tok<134>2017-01-01T00:00:00Z ")
+    assert line.endswith(b"\n")
+
+    rows = core.parse_lines([line.rstrip()], token=b"tok")
+    assert len(rows) == 1 or b"Go-http-client" in line
+
+
+@pytest.mark.asyncio
+async def test_generate():
+    loop = asyncio.get_event_loop()
+    received = []
+
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            received.append(line)
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        stats = await generate(
+            "127.0.0.1",
+            port,
+            connections=4,
+            rate=400,
+            duration=0.5,
+            token="tok",
+            loop=loop,
+        )
+        await asyncio.sleep(0.1)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    # We should have gotten roughly half a second's worth of lines.
+    assert 100 <= stats["lines"] <= 220
+    assert len(received) == stats["lines"]
+    assert stats["connections"] == 0
+    assert all(line.startswith(b"tok<134>") for line in received)
+    assert all(LOADGEN_PROJECT.encode("ascii") in line for line in received)
@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import pytest
+
+from linehaul import parser
+
+
+def _outcome(line, engine):
+    try:
+        return ("ok", parser.parse(line, engine=engine))
+    except Exception as exc:
+        return ("error", type(exc))
+
+
+def _corpus(count, seed=1234):
+    rand = random.Random(seed)
+
+    fields = [
+        ["Mon, 07 Sep 2015 01:53:44 GMT", "Tue, 29 Mar 2016 23:59:59 GMT"],
+        ["US", "", " ", "(null)"],
+        [
+            "/packages/source/f/foo/foo-1.0.tar.gz",
+            "/packages/3.5/f/foo/foo-1.0-py3-none-any.whl",
+        ],
+        ["foo", "(null)", "(null)foo", ""],
+        ["1.0", "(null)", "1.0 ", ""],
+        [t.value or "(null)" for t in parser.PackageType] + ["sdistx", ""],
+        [
+            "pip/1.5.6 CPython/3.5.1 Darwin/15.2.0",
+            'pip/8.0.2 {"installer":{"name":"pip","version":"8.0.2"}}',
+            "Python-urllib/2.7 setuptools/20.1.1",
+            "conda/4.0.5 requests/2.9.1 CPython/3.5.1",
+            "Mozilla/5.0 (Windows NT 10.0; WOW64) | pipes",
+            "Debian uscan/1.0",
+            "a user agent we do not know about",
+        ],
+    ]
+    noise = ["", " ", "|", "\t", "é", "\n", "(null)", "x"]
+
+    for _ in range(count):
+        # Most of our fields will use a valid value, but every so often we'll
+        # pick one of the odd ones instead.
+        line = "|".join(
+            rand.choice(choices) if rand.random() < 0.2 else choices[0]
+            for choices in fields[:-1]
+        )
+        line += "|" + rand.choice(fields[-1])
+
+        # Randomly mutate some of our lines so that we exercise the decoders
+        # with inputs that are just a little bit off.
+        for _ in range(rand.choice([0, 0, 0, 1, 2])):
+            idx = rand.randrange(len(line) + 1)
+            line = (
+                line[:idx] +
+                rand.choice(noise) +
+                line[idx + rand.choice([0, 1]):]
+            )
+
+        yield line
+
+
+@pytest.mark.parametrize("engine", sorted(parser.ENGINES))
+def test_parse(engine):
+    download = parser.parse(
+        "Mon, 07 Sep 2015 01:53:44 GMT|US|"
+        "/packages/source/f/foo/foo-1.0.tar.gz|foo|1.0|sdist|"
+        "pip/1.5.6 CPython/3.5.1 Darwin/15.2.0",
+        engine=engine,
+    )
+
+    assert download.timestamp == 1441590824.0
+    assert download.country_code == "US"
+    assert download.url == "/packages/source/f/foo/foo-1.0.tar.gz"
+    assert download.file.filename == "foo-1.0.tar.gz"
+    assert download.file.project == "foo"
+    assert download.file.version == "1.0"
+    assert download.file.type is parser.PackageType.sdist
+    assert download.details.installer.name == "pip"
+
+
+@pytest.mark.parametrize("engine", sorted(parser.ENGINES))
+@pytest.mark.parametrize(
+    "line",
+    [
+        "",
+        "Mon, 07 Sep 2015 01:53:44 GMT|US|/foo-1.0.tar.gz|foo|1.0|sdist",
+        "Mon, 07 Sep 2015 01:53:44 GMT|US|/foo-1.0.tar.gz|foo|1.0|egg|pip/8",
+        "Mon, 07 Sep 2015 01:53:44 GMT|US||foo|1.0|sdist|pip/8",
+        "Mon, 07 Sep 2015 01:53:44 GMT|US|/foo.tar.gz|(null)x|1.0|sdist|pip/8",
+        "Mon, 07 Sep 2015 01:53:44 GMT|US|/föo.tar.gz|foo|1.0|sdist|pip/8",
+    ],
+)
+def test_parse_invalid(engine, line):
+    with pytest.raises(ValueError):
+        parser.parse(line, engine=engine)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("Mon, 07 Sep 2015 01:53:44 GMT", 1441590824.0),
+        ("Mon, 07 Sep 2015 01:53:44 UTC", 1441590824.0),
+        ("Sun, 06 Sep 2015 20:53:44 EST", 1441590824.0),
+        ("Tue, 29 Mar 2016 23:59:59 GMT", 1459295999.0),
+    ],
+)
+def test_parse_timestamp(value, expected):
+    assert parser.parse_timestamp(value) == expected
+    # The second time through we should get the same value out of our cache.
+    assert parser.parse_timestamp(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "",
+        "07 Sep 2015 01:53:44",
+        "Mon, 07 Foo 2015 01:53:44 GMT",
+        "Mon, 07 Sep 2015 01:53:44 XYZ",
+        "Mon, 31 Feb 2015 01:53:44 GMT",
+        "Mon, 07 Sep 2015 01:53:44 GMT ",
+    ],
+)
+def test_parse_timestamp_invalid(value):
+    with pytest.raises(ValueError):
+        parser.parse_timestamp(value)
+
+
+def test_engines_are_identical():
+    for line in _corpus(3000):
+        assert _outcome(line, "fast") == _outcome(line, "pyparsing"), line
@@ -0,0 +1,54 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+
+from linehaul._queue import FlowControl
+
+
+def _transport():
+    return pretend.stub(
+        pause_reading=pretend.call_recorder(lambda: None),
+        resume_reading=pretend.call_recorder(lambda: None),
+    )
+
+
+def test_flow_control_shares_transports():
+    queue, pool = FlowControl(), FlowControl()
+    transport = _transport()
+
+    queue.add_transport(transport)
+    pool.add_transport(transport)
+
+    queue.pause()
+    pool.pause()
+    assert transport.pause_reading.calls == [pretend.call()]
+
+    # We can't resume reading until everyone that paused us is ready for us
+    # to resume.
+    queue.resume()
+    assert transport.resume_reading.calls == []
+    pool.resume()
+    assert transport.resume_reading.calls == [pretend.call()]
+
+
+def test_flow_control_new_transport_paused():
+    flow = FlowControl()
+    flow.pause()
+
+    transport = _transport()
+    flow.add_transport(transport)
+    assert transport.pause_reading.calls == [pretend.call()]
+
+    # Removing a transport releases any pause we were holding on it.
+    flow.remove_transport(transport)
+    assert transport.resume_reading.calls == [pretend.call()]
@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+
+import pytest
+
+from linehaul._records import Record, field
+
+
+class Inner(Record):
+
+    name = field(type=str, mandatory=True)
+
+
+class Outer(Record):
+
+    inner = field(type=Inner, factory=Inner.create)
+    count = field(type=int, factory=int)
+    label = field(type=(str, type(None)), serializer=lambda f, v: v or "")
+
+
+def test_create():
+    record = Outer.create({"inner": {"name": "foo"}, "count": "3"})
+
+    assert record.inner == Inner(name="foo")
+    assert record.count == 3
+    assert Outer.create(record) is record
+
+    with pytest.raises(AttributeError):
+        record.label
+
+
+def test_serialize():
+    record = Outer.create({"inner": {"name": "foo"}, "label": None})
+
+    assert record.serialize() == {"inner": {"name": "foo"}, "label": ""}
+
+
+def test_equality():
+    assert Inner(name="foo") == Inner(name="foo")
+    assert Inner(name="foo") != Inner(name="bar")
+    assert Outer(count=1) != Outer(count=1, label="a")
+    assert hash(Inner(name="foo")) == hash(Inner(name="foo"))
+
+
+def test_immutable():
+    record = Inner(name="foo")
+
+    with pytest.raises(AttributeError):
+        record.name = "bar"
+
+
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+def test_pickle(protocol):
+    record = Outer.create({"inner": {"name": "foo"}, "count": 3})
+
+    restored = pickle.loads(pickle.dumps(record, protocol=protocol))
+
+    assert restored == record
+    assert restored.inner == Inner(name="foo")
+    assert restored.serialize() == record.serialize()
+
+    with pytest.raises(AttributeError):
+        restored.label
+
+
+@pytest.mark.parametrize(
+    ("cls", "data", "exc"),
+    [
+        (Inner, {}, ValueError),
+        (Inner, {"name": 1}, TypeError),
+        (Inner, {"name": "foo", "other": "bar"}, AttributeError),
+        (Outer, {"inner": {}}, ValueError),
+    ],
+)
+def test_invalid(cls, data, exc):
+    with pytest.raises(exc):
+        cls.create(data)
@@ -0,0 +1,288 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+
+import click
+import pretend
+import pytest
+
+from click.testing import CliRunner
+
+from linehaul import _replay, core
+from linehaul._click import DefaultGroup
+from linehaul.bigquery import BigQueryError
+
+
+LINE = (
+    "tok<134>2015-09-07T01:53:44Z cache-iad2122 linehaul[411617]: "
+    "Mon, 07 Sep 2015 01:53:44 GMT|US|"
+    "/packages/source/f/foo/foo-1.{0}.tar.gz|foo|1.{0}|sdist|"
+    "pip/1.5.6 CPython/3.5.1 Darwin/15.2.0\n"
+)
+
+
+class FakeBigQuery:
+
+    def __init__(self, fail_after=None):
+        self.inserts = []
+        self.fail_after = fail_after
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    async def insert_all(self, rows, template_suffix=None,
+                         skip_invalid_rows=False):
+        if self.fail_after is not None and \
+                len(self.inserts) >= self.fail_after:
+            raise BigQueryError("Nope", retryable=True)
+        self.inserts.append((template_suffix, rows))
+
+
+def _versions(bq):
+    return [
+        json.loads(row.decode("utf8"))["json"]["file"]["version"]
+        for _, rows in bq.inserts
+        for row in rows
+    ]
+
+
+@pytest.fixture(params=["plain", "gzip"])
+def logfile(request, tmpdir):
+    data = "".join(LINE.format(i) for i in range(10)) + "tok<134>garbage\n"
+
+    if request.param == "gzip":
+        path = tmpdir.join("fastly.log.gz")
+        with gzip.open(str(path), "wt") as fp:
+            fp.write(data)
+    else:
+        path = tmpdir.join("fastly.log")
+        path.write(data)
+
+    return str(path)
+
+
+def test_read_chunks(logfile):
+    chunks = list(_replay.read_chunks(logfile, chunk_lines=4))
+
+    assert [len(lines) for lines, _ in chunks] == [4, 4, 3]
+    assert chunks[-1][0][-1] == b"tok<134>garbage"
+
+    # Starting from the offset of any chunk should give us back the rest of
+    # the file, no matter whether it was compressed or not.
+    _, offset = chunks[0]
+    assert list(_replay.read_chunks(logfile, offset, chunk_lines=4)) == \
+        chunks[1:]
+
+
+@pytest.mark.asyncio
+async def test_replay_file(logfile, tmpdir):
+    bq = FakeBigQuery()
+    checkpoints = _replay.Checkpoints(str(tmpdir.join("checkpoints")))
+
+    stats = await _replay.replay_file(
+        logfile,
+        client=bq,
+        checkpoints=checkpoints,
+        token=b"tok",
+        max_rows=4,
+        max_bytes=1024 * 1024,
+        chunk_lines=6,
+    )
+
+    assert stats["lines"] == 11
+    assert stats["rows"] == 10
+    assert stats["errors"] == 1
+    assert len(bq.inserts) == 3
+    assert _versions(bq) == ["1.{}".format(i) for i in range(10)]
+    assert checkpoints.load(logfile)[:2] == (stats["bytes"], True)
+
+    # Now that we've finished the file, replaying it again is a no-op.
+    stats = await _replay.replay_file(
+        logfile,
+        client=bq,
+        checkpoints=checkpoints,
+        token=b"tok",
+        max_rows=4,
+        max_bytes=1024 * 1024,
+    )
+
+    assert stats == {"skipped": 1}
+    assert len(bq.inserts) == 3
+
+
+@pytest.mark.asyncio
+async def test_replay_file_resumes(logfile, tmpdir):
+    checkpoints = _replay.Checkpoints(str(tmpdir.join("checkpoints")))
+
+    # Our second chunk will fail, which should leave our checkpoint at the
+    # end of the first one.
+    bq = FakeBigQuery(fail_after=1)
+    with pytest.raises(BigQueryError):
+        await _replay.replay_file(
+            logfile,
+            client=bq,
+            checkpoints=checkpoints,
+            token=b"tok",
+            max_rows=100,
+            max_bytes=1024 * 1024,
+            chunk_lines=4,
+        )
+
+    offset, done, _ = checkpoints.load(logfile)
+    assert offset == len(LINE.format(0)) * 4
+    assert not done
+
+    bq.fail_after = None
+    stats = await _replay.replay_file(
+        logfile,
+        client=bq,
+        checkpoints=checkpoints,
+        token=b"tok",
+        max_rows=100,
+        max_bytes=1024 * 1024,
+        chunk_lines=4,
+    )
+
+    assert stats["lines"] == 7
+    assert _versions(bq) == ["1.{}".format(i) for i in range(10)]
+    assert checkpoints.load(logfile)[1]
+
+
+@pytest.mark.asyncio
+async def test_replay_matches_live(tmpdir):
+    # The same line shows up more than once, including on either side of a
+    # chunk boundary, and every copy of it should get the same insertId that
+    # it got when it was sent to us live.
+    lines = [LINE.format(i % 2 and 1) for i in range(7)]
+    path = tmpdir.join("fastly.log")
+    path.write("".join(lines))
+
+    live = []
+    batcher = pretend.stub(
+        add_producer=lambda transport: None,
+        remove_producer=lambda transport: None,
+        put=live.append,
+    )
+    protocol = core.LinehaulProtocol(batcher=batcher, token="tok")
+    protocol.connection_made(pretend.stub(close=lambda: None))
+    for line in lines:
+        protocol.data_received(line.encode("utf8"))
+    protocol.connection_lost(None)
+
+    bq = FakeBigQuery()
+    await _replay.replay_file(
+        str(path),
+        client=bq,
+        checkpoints=_replay.Checkpoints(),
+        token=b"tok",
+        max_rows=100,
+        max_bytes=1024 * 1024,
+        chunk_lines=3,
+    )
+
+    def ids(rows):
+        return sorted(json.loads(row.decode("utf8"))["insertId"]
+                      for row in rows)
+
+    replayed = ids(row for _, rows in bq.inserts for row in rows)
+    assert replayed == ids(data for _, data in live)
+    assert len(set(replayed)) == 7
+
+
+@pytest.mark.asyncio
+async def test_replay_resumes_occurrences(tmpdir):
+    # The same line shows up on either side of where our first replay fails,
+    # and its copies should get the same insertIds when we resume as they do
+    # when nothing fails at all.
+    path = tmpdir.join("fastly.log")
+    path.write("".join(LINE.format(i % 2 and 1) for i in range(7)))
+
+    def ids(bq):
+        return sorted(
+            json.loads(row.decode("utf8"))["insertId"]
+            for _, rows in bq.inserts
+            for row in rows
+        )
+
+    async def replay(bq, checkpoints):
+        await _replay.replay_file(
+            str(path),
+            client=bq,
+            checkpoints=checkpoints,
+            token=b"tok",
+            max_rows=100,
+            max_bytes=1024 * 1024,
+            chunk_lines=3,
+        )
+
+    expected = FakeBigQuery()
+    await replay(expected, _replay.Checkpoints())
+
+    checkpoints = _replay.Checkpoints(str(tmpdir.join("checkpoints")))
+    bq = FakeBigQuery(fail_after=1)
+    with pytest.raises(BigQueryError):
+        await replay(bq, checkpoints)
+
+    bq.fail_after = None
+    await replay(bq, checkpoints)
+
+    assert ids(bq) == ids(expected)
+    assert len(set(ids(bq))) == 7
+
+
+def test_replay_dry_run(logfile, tmpdir):
+    stats = _replay.replay(
+        logfile,
+        token="tok",
+        max_rows=4,
+        max_bytes=1024 * 1024,
+        checkpoint_dir=str(tmpdir.join("checkpoints")),
+        dry_run=True,
+    )
+
+    assert stats["lines"] == 11
+    assert stats["rows"] == 10
+    assert stats["errors"] == 1
+    assert stats["seconds"] > 0
+
+    # A dry run shouldn't leave any checkpoints behind.
+    assert not tmpdir.join("checkpoints").exists()
+
+
+def test_default_group():
+    @click.group(cls=DefaultGroup, default="first")
+    def group():
+        pass
+
+    @group.command()
+    @click.argument("value")
+    def first(value):
+        click.echo("first {}".format(value))
+
+    @group.command()
+    def second():
+        click.echo("second")
+
+    runner = CliRunner()
+
+    assert runner.invoke(group, ["first", "a"]).output == "first a\n"
+    assert runner.invoke(group, ["a"]).output == "first a\n"
+    assert runner.invoke(group, ["second"]).output == "second\n"
+    assert "Commands:" in runner.invoke(group, ["--help"]).output
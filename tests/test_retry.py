@@ -0,0 +1,50 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from linehaul._retry import RetryBudget, RetryPolicy
+
+
+def test_budget():
+    budget = RetryBudget(ratio=0.5, reserve=2)
+
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    # Every request we make earns us a fraction of a retry.
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+    # But we never save up more than our reserve.
+    for _ in range(10):
+        budget.deposit()
+    assert budget.balance == 2
+
+
+def test_policy_attempts():
+    policy = RetryPolicy(attempts=3, budget=RetryBudget(reserve=10))
+
+    assert policy.should_retry(0)
+    assert policy.should_retry(1)
+    assert not policy.should_retry(2)
+
+
+@pytest.mark.parametrize("attempt", range(10))
+def test_policy_delay(attempt):
+    policy = RetryPolicy(base=0.5, cap=4.0)
+
+    for _ in range(100):
+        assert 0 <= policy.delay(attempt) <= min(4.0, 0.5 * (2 ** attempt))
@@ -0,0 +1,113 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+
+import pytest
+
+from linehaul import _rollup, parser
+
+
+MESSAGE = (
+    "Mon, 07 Sep 2015 01:53:44 GMT|{country}|"
+    "/packages/source/f/foo/foo-1.0.tar.gz|foo|1.0|sdist|{ua}"
+)
+
+
+def _download(country="US", ua="pip/1.5.6 CPython/3.5.1 Darwin/15.2.0"):
+    return parser.parse(MESSAGE.format(country=country, ua=ua))
+
+
+def test_key():
+    dimensions = tuple(sorted(_rollup.DIMENSIONS))
+
+    assert dict(
+        zip(dimensions, _rollup.key(_download(), dimensions)[1:])
+    ) == {
+        "country_code": "US",
+        "project": "foo",
+        "version": "1.0",
+        "type": "sdist",
+        "installer": "pip",
+        "installer_version": "1.5.6",
+        "python": "3.5.1",
+        "implementation": "CPython",
+        "implementation_version": "3.5.1",
+        "distro": None,
+        "distro_version": None,
+        "system": "Darwin",
+        "system_release": "15.2.0",
+        "cpu": None,
+    }
+
+
+@pytest.mark.parametrize(
+    ("kwargs", "expected"),
+    [
+        ({}, (16685, "foo", "pip", "US")),
+        ({"country": ""}, (16685, "foo", "pip", None)),
+        ({"ua": "curl/7.35.0"}, (16685, "foo", "Browser", "US")),
+        ({"ua": "Python-urllib/2.7"}, (16685, "foo", None, "US")),
+    ],
+)
+def test_key_defaults(kwargs, expected):
+    dimensions = ("project", "installer", "country_code")
+    assert _rollup.key(_download(**kwargs), dimensions) == expected
+
+
+def test_compact():
+    first = _rollup.compact((1, "".join(["f", "oo"]), None))
+    second = _rollup.compact((2, "".join(["fo", "o"]), "1.0"))
+
+    assert first == (1, "foo", None)
+    assert first[1] is second[1]
+
+
+def test_encode():
+    counts = collections.Counter({
+        (16685, "foo", None): 3,
+        (16686, "bar", "US"): 1,
+    })
+
+    first = _rollup.encode(counts, ("project", "country_code"))
+    second = _rollup.encode(counts, ("project", "country_code"))
+
+    assert [day for day, _ in first] == [16685 * 86400, 16686 * 86400]
+
+    rows = [json.loads(row.decode("utf8")) for _, row in first]
+    assert [row["json"] for row in rows] == [
+        {"date": "2015-09-07", "project": "foo", "country_code": None,
+         "count": 3},
+        {"date": "2015-09-08", "project": "bar", "country_code": "US",
+         "count": 1},
+    ]
+
+    # Every flush needs its own ids, since the same key can easily have the
+    # same count more than once.
+    ids = {json.loads(row.decode("utf8"))["insertId"] for _, row in first}
+    ids |= {json.loads(row.decode("utf8"))["insertId"] for _, row in second}
+    assert len(ids) == 4
+
+
+def test_parse_dimensions():
+    assert _rollup.parse_dimensions("project, version,,python") == (
+        "project",
+        "version",
+        "python",
+    )
+
+
+@pytest.mark.parametrize("value", ["project,nope", "project,project"])
+def test_parse_dimensions_invalid(value):
+    with pytest.raises(ValueError):
+        _rollup.parse_dimensions(value)
@@ -16,7 +16,9 @@ import asyncio
 import pretend
 import pytest
 
-from linehaul._server import Server
+from aiohttp import web
+
+from linehaul._server import AppServer, Server
 
 
 class FakeServer:
@@ -57,3 +59,24 @@ async def test_creates_server(early_close):
             assert s.closed
 
     assert s.closed
+
+
+@pytest.mark.asyncio
+async def test_serves_app():
+    async def hello(request):
+        return web.Response(text="Hello")
+
+    app = web.Application()
+    app.router.add_route("GET", "/", hello)
+
+    async with AppServer(app, "127.0.0.1", 0) as s:
+        port = s.sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET / HTTP/1.0\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+
+    assert response.startswith(b"HTTP/1.0 200 OK\r\n")
+    assert response.endswith(b"\r\n\r\nHello")
+    assert not s.sockets
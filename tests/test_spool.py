@@ -0,0 +1,132 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+
+import pytest
+
+from linehaul._queue import QueueClosed
+from linehaul._spool import Spool
+
+
+@pytest.mark.asyncio
+async def test_write_read_ack(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.open()
+
+    segment = await spool.write("20160101", [b'{"a":1}', b'{"b":2}'])
+
+    assert segment.suffix == "20160101"
+    assert os.listdir(str(tmpdir)) == [segment.name]
+    assert len(spool) == 1
+    assert spool.bytes == segment.size
+
+    assert await spool.get() is segment
+    assert await spool.read(segment) == [b'{"a":1}', b'{"b":2}']
+
+    spool.ack(segment)
+
+    assert os.listdir(str(tmpdir)) == []
+    assert len(spool) == 0
+    assert spool.bytes == 0
+    await spool.join()
+
+
+@pytest.mark.asyncio
+async def test_replays_unacknowledged(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.open()
+
+    first = await spool.write("20160101", [b"1"])
+    second = await spool.write("20160102", [b"2"])
+    spool.ack(first)
+
+    # A segment that we never finished writing.
+    tmpdir.join("0000000000000099-20160103.seg.tmp").write("")
+
+    spool = Spool(str(tmpdir))
+    spool.open()
+
+    assert len(spool) == 1
+    replayed = await spool.get()
+    assert (replayed.name, replayed.suffix) == (second.name, "20160102")
+    assert await spool.read(replayed) == [b"2"]
+    assert os.listdir(str(tmpdir)) == [second.name]
+
+    # New segments should sort after the ones that already existed.
+    third = await spool.write("20160101", [b"3"])
+    assert sorted([second.name, third.name]) == [second.name, third.name]
+
+
+@pytest.mark.asyncio
+async def test_nack_requeues(tmpdir):
+    spool = Spool(str(tmpdir), retry_delay=0)
+    spool.open()
+
+    segment = await spool.write("20160101", [b"1"])
+    assert await spool.get() is segment
+
+    spool.nack(segment)
+    assert await asyncio.wait_for(spool.get(), timeout=1) is segment
+
+    spool.ack(segment)
+    spool.close()
+    with pytest.raises(QueueClosed):
+        await spool.get()
+
+
+@pytest.mark.asyncio
+async def test_close_leaves_segments(tmpdir):
+    spool = Spool(str(tmpdir), retry_delay=0)
+    spool.open()
+
+    first = await spool.write("20160101", [b"1"])
+    second = await spool.write("20160101", [b"2"])
+    assert await spool.get() is first
+
+    # Once we've been closed we stop handing out segments, and one that fails
+    # isn't put back in line, but they're all still on disk.
+    spool.close()
+    with pytest.raises(QueueClosed):
+        await spool.get()
+
+    spool.nack(first)
+    await asyncio.sleep(0.01)
+    with pytest.raises(QueueClosed):
+        await spool.get()
+
+    # The next time that we're opened, they're all sent again, in order.
+    spool = Spool(str(tmpdir))
+    spool.open()
+    assert [(await spool.get()).name for _ in range(2)] == [
+        first.name,
+        second.name,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_max_bytes(tmpdir):
+    spool = Spool(str(tmpdir), max_bytes=1)
+    spool.open()
+
+    first = await spool.write("20160101", [b"1"])
+
+    # We're over our limit, so the next write has to wait until we've had
+    # something acknowledged.
+    write = asyncio.ensure_future(spool.write("20160101", [b"2"]))
+    await asyncio.sleep(0.01)
+    assert not write.done()
+
+    spool.ack(first)
+    second = await asyncio.wait_for(write, timeout=1)
+    assert os.listdir(str(tmpdir)) == [second.name]
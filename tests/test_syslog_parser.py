@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import random
+
+import pytest
+
+from linehaul.syslog import Facility, Severity, parser
+
+
+def _outcome(func, line):
+    try:
+        return ("ok", func(line))
+    except ValueError:
+        return ("error", None)
+
+
+def _corpus(count, seed=1234):
+    rand = random.Random(seed)
+
+    timestamps = [
+        "2015-09-07T01:53:44Z",
+        "2016-02-29T23:59:59Z",
+        "2016-02-29T23:59:59.5Z",
+        "2016-02-29T23:59:59.123456Z",
+        "2016-01-10T10:30:00+02:00",
+        "2016-01-10T10:30:00-05:30",
+        "2016-01-10T24:00:00Z",
+        "2016-01-10",
+        "2016-13-10T10:30:00Z",
+    ]
+    hostnames = ["cache-iad2122", "cache-ams4130", '"-"', '"-"x', "h]:"]
+    appnames = ["linehaul", "app]x", "a:b"]
+    procids = ["411617", "1", "a[b"]
+    messages = [
+        "2015-09-07T01:53:44Z|US|/packages/foo-1.0.tar.gz|foo|1.0|sdist|pip/8",
+        "",
+        "a message]: with a separator",
+        "unicode ☃ message",
+    ]
+    noise = ["", " ", "[", "]", ":", "<", ">", '"', "-", "\t", "é", "1"]
+
+    for _ in range(count):
+        line = "<{}>{} {} {}[{}]: {}".format(
+            rand.choice([0, 7, 134, 191, 192, 999]),
+            rand.choice(timestamps),
+            rand.choice(hostnames),
+            rand.choice(appnames),
+            rand.choice(procids),
+            rand.choice(messages),
+        )
+
+        # Randomly mutate some of our lines so that we exercise the parsers
+        # with inputs that are just a little bit off.
+        for _ in range(rand.choice([0, 0, 0, 1, 2])):
+            idx = rand.randrange(len(line) + 1)
+            line = (
+                line[:idx] +
+                rand.choice(noise) +
+                line[idx + rand.choice([0, 1]):]
+            )
+
+        yield line
+
+
+@pytest.mark.parametrize(
+    ("line", "expected"),
+    [
+        (
+            "<134>2015-09-07T01:53:44Z cache-iad2122 linehaul[411617]: "
+            "a message",
+            {
+                "facility": Facility.local0,
+                "severity": Severity.informational,
+                "timestamp": datetime.datetime(
+                    2015, 9, 7, 1, 53, 44,
+                    tzinfo=datetime.timezone.utc,
+                ),
+                "hostname": "cache-iad2122",
+                "appname": "linehaul",
+                "procid": "411617",
+                "message": "a message",
+            },
+        ),
+        (
+            '<11>2015-09-07T01:53:44.25-01:00 "-" app[x]: ',
+            {
+                "facility": Facility.user,
+                "severity": Severity.error,
+                "timestamp": datetime.datetime(
+                    2015, 9, 7, 2, 53, 44, 250000,
+                    tzinfo=datetime.timezone.utc,
+                ),
+                "hostname": None,
+                "appname": "app",
+                "procid": "x",
+                "message": "",
+            },
+        ),
+    ],
+)
+def test_parse(line, expected):
+    assert parser.parse(line) == parser.SyslogMessage(**expected)
+    assert parser._parse_grammar(line) == parser.SyslogMessage(**expected)
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "",
+        "134>2015-09-07T01:53:44Z host app[1]: message",
+        "<1345>2015-09-07T01:53:44Z host app[1]: message",
+        "<134>2015-09-07T01:53:44Z host app: message",
+        "<134>2015-09-07T01:53:44Z host app[1] message",
+        "<134>2015-09-07T01:53:44Z hést app[1]: message",
+        "<134>not-a-timestamp host app[1]: message",
+        "<999>2015-09-07T01:53:44Z host app[1]: message",
+    ],
+)
+def test_parse_invalid(line):
+    with pytest.raises(ValueError):
+        parser.parse(line)
+
+
+def test_fast_parser_matches_grammar():
+    for line in _corpus(5000):
+        expected = _outcome(parser._parse_grammar, line)
+
+        # The fast parser is allowed to punt on a line by returning None, but
+        # if it doesn't then it must agree with the grammar exactly.
+        fast = _outcome(parser._parse_fast, line)
+        if fast != ("ok", None):
+            assert fast == expected, line
+
+        assert _outcome(parser.parse, line) == expected, line
@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import pytest
+
+from linehaul.syslog.protocol import LineProtocol, SyslogProtocol
+
+
+class RecordingLineProtocol(LineProtocol):
+
+    def __init__(self, *args, **kwargs):
+        self.lines = []
+        self.too_long = 0
+
+        super().__init__(*args, **kwargs)
+
+    def line_received(self, line):
+        self.lines.append(line)
+
+    def line_too_long(self):
+        self.too_long += 1
+
+
+def _feed(protocol, data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        protocol.data_received(data[i:i + chunk_size])
+
+
+def _protocol(**kwargs):
+    protocol = RecordingLineProtocol(**kwargs)
+    protocol.connection_made(pretend.stub())
+    return protocol
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1024, 1024 * 1024])
+def test_lines(chunk_size):
+    lines = [b"a line", b"", b"another line", b"x" * 50000, b"\r", b"last"]
+    protocol = _protocol()
+
+    _feed(protocol, b"\r\n".join(lines) + b"\r\npartial", chunk_size)
+
+    assert protocol.lines == lines
+
+
+def test_data_received():
+    protocol = _protocol()
+
+    protocol.data_received(b"one\r\ntw")
+    protocol.data_received(b"o\r\n" + b"x" * 50000 + b"\r\nthree\r\n")
+
+    assert protocol.lines == [b"one", b"two", b"x" * 50000, b"three"]
+
+
+def test_split_delimiter():
+    protocol = _protocol()
+
+    # A long line, so that we're only adding onto our buffer, and a short
+    # one, so that we're joining our buffer onto the next read.
+    for data in [b"x" * 100, b"\r", b"\nab\r", b"\ncd"]:
+        protocol.data_received(data)
+
+    assert protocol.lines == [b"x" * 100, b"ab"]
+    assert protocol._buffer == b"cd"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 1024 * 1024])
+def test_line_too_long(chunk_size):
+    protocol = _protocol(max_line_length=1000)
+
+    _feed(
+        protocol,
+        b"short\r\n" + b"x" * 5000 + b"\r\n" + b"y" * 1000 + b"\r\nafter\r\n",
+        chunk_size,
+    )
+
+    assert protocol.lines == [b"short", b"y" * 1000, b"after"]
+    assert protocol.too_long == 1
+
+
+def test_bounded_buffer():
+    protocol = _protocol(max_line_length=10000)
+
+    for _ in range(1000):
+        _feed(protocol, b"x" * 1024, 1024)
+
+    assert protocol.too_long == 1
+    assert len(protocol._buffer) <= 10000 + 1024
+
+
+def test_invalid_lines():
+    class Protocol(SyslogProtocol):
+
+        def __init__(self, *args, **kwargs):
+            self.messages = []
+            self.invalid = []
+
+            super().__init__(*args, **kwargs)
+
+        def message_received(self, message):
+            self.messages.append(message.message)
+
+        def invalid_line_received(self, line, exc):
+            self.invalid.append(line)
+
+    protocol = Protocol(token="tok")
+    protocol.connection_made(pretend.stub())
+
+    protocol.data_received(
+        b"tok<134>2015-09-07T01:53:44Z host app[1]: \xff\xfe\n"
+        b"tok<134>not a syslog line\n"
+        b"nope<134>2015-09-07T01:53:44Z host app[1]: ignored\n"
+        b"tok<134>2015-09-07T01:53:44Z host app[1]: a message\n"
+    )
+
+    assert protocol.messages == ["a message"]
+    assert protocol.invalid == [
+        b"<134>2015-09-07T01:53:44Z host app[1]: \xff\xfe",
+        b"<134>not a syslog line",
+    ]
@@ -0,0 +1,167 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+
+import pytest
+
+from linehaul import _metrics as m
+from linehaul._tokens import TokenError, TokenManager
+
+
+class FakeOAuth2:
+
+    def __init__(self):
+        self.access_token = None
+
+    def prepare_token_request(self, url, scope=None):
+        return url, {}, "a signed assertion"
+
+    def parse_request_body_response(self, body):
+        token = json.loads(body)
+        self.access_token = token["access_token"]
+        return token
+
+    def add_token(self, url, http_method=None, headers=None, body=None):
+        return url, dict(headers, Authorization=self.access_token), body
+
+
+class FakeResponse:
+
+    def __init__(self, status, text):
+        self.status = status
+        self._text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        pass
+
+    async def text(self):
+        # Give other requests a chance to pile up behind this one.
+        await asyncio.sleep(0)
+        return self._text
+
+
+class FakeSession:
+
+    def __init__(self, expires_in=3600, fail=0):
+        self.expires_in = expires_in
+        self.fail = fail
+        self.requests = 0
+
+    def post(self, url, headers, data):
+        self.requests += 1
+
+        if self.fail:
+            self.fail -= 1
+            return FakeResponse(500, "Oops")
+
+        return FakeResponse(
+            200,
+            json.dumps({
+                "access_token": "token{}".format(self.requests),
+                "token_type": "Bearer",
+                "expires_in": self.expires_in,
+            }),
+        )
+
+
+def _manager(session, **kwargs):
+    return TokenManager(
+        FakeOAuth2(),
+        "https://example.com/token",
+        session=session,
+        **kwargs
+    )
+
+
+@pytest.mark.asyncio
+async def test_shares_one_refresh():
+    session = FakeSession()
+    tokens = _manager(session)
+
+    results = await asyncio.gather(*[
+        tokens.add_token("https://example.com/", headers={})
+        for _ in range(10)
+    ])
+
+    assert session.requests == 1
+    assert {r[1]["Authorization"] for r in results} == {"token1"}
+    assert tokens.valid
+
+    tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_refreshes_before_expiry():
+    session = FakeSession(expires_in=3600)
+    tokens = _manager(session, margin=3600 - 0.02)
+
+    await tokens.add_token("https://example.com/", headers={})
+    assert session.requests == 1
+
+    # Our token hasn't expired, but we should have refreshed it anyways.
+    await asyncio.sleep(0.1)
+    assert session.requests > 1
+    assert tokens.oauth2.access_token != "token1"
+
+    tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_invalidate():
+    session = FakeSession()
+    tokens = _manager(session)
+
+    await tokens.add_token("https://example.com/", headers={})
+    tokens.invalidate()
+    assert not tokens.valid
+
+    _, headers, _ = await tokens.add_token("https://example.com/", headers={})
+    assert headers["Authorization"] == "token2"
+
+    tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_refresh():
+    session = FakeSession(fail=1)
+    tokens = _manager(session)
+
+    with pytest.raises(TokenError):
+        await tokens.add_token("https://example.com/", headers={})
+
+    _, headers, _ = await tokens.add_token("https://example.com/", headers={})
+    assert headers["Authorization"] == "token2"
+
+    tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_background_refresh():
+    session = FakeSession(expires_in=3600)
+    tokens = _manager(session, margin=3600, retry_delay=0.01)
+
+    await tokens.add_token("https://example.com/", headers={})
+    session.fail = 1
+    errors = m.TOKEN_ERRORS._value.get()
+
+    # Our background refresh will fail, but we should keep trying.
+    await asyncio.sleep(0.05)
+    assert session.requests > 2
+    assert tokens.valid
+    assert m.TOKEN_ERRORS._value.get() == errors + 1
+
+    tokens.close()
@@ -10,11 +10,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os.path
+
+import packaging.version
 import pytest
 
+from packaging.specifiers import SpecifierSet
+
 from linehaul import user_agents as ua
 
 
+def _load_corpus():
+    # This corpus holds a large number of user agents, along with the result
+    # that the original, format by format, parser produced for each of them.
+    path = os.path.join(os.path.dirname(__file__), "user_agents.json")
+    with open(path, "r", encoding="utf8") as fp:
+        return json.load(fp)
+
+
 @pytest.mark.parametrize(
     ("user_agent", "expected"),
     [
@@ -147,3 +161,53 @@ def test_ignored_user_agent(user_agent):
 def test_invalid_user_agent(user_agent):
     with pytest.raises(ValueError):
         ua.parse(user_agent)
+
+
+def test_caches_results():
+    user_agent = "an unknown user agent that gets cached"
+    ua.cache.clear()
+
+    with pytest.raises(ValueError):
+        ua.parse(user_agent)
+    assert user_agent in ua.cache
+    with pytest.raises(ua.UnknownUserAgent):
+        ua.parse(user_agent)
+
+    assert ua.parse("Debian uscan/cached") is None
+    assert "Debian uscan/cached" in ua.cache
+    assert ua.parse("Debian uscan/cached") is None
+
+    result = ua.parse("conda/cached")
+    assert ua.parse("conda/cached") is result
+
+
+@pytest.mark.parametrize(
+    "version",
+    [
+        "0.8", "1.3.1", "1.4", "1.4rc1", "1.4.1", "1.5.6", "1.5.6+local",
+        "5.0b1", "5.9.post1", "5.9.dev0", "6", "6.0", "6.0rc1", "6.0.dev0",
+        "6.0.post1", "6.0+local", "6.0rc1+local", "6.1.1", "8.0.2", "1!2.0",
+    ],
+)
+def test_pip_version_boundaries(version):
+    version = packaging.version.parse(version)
+
+    assert ua._pip_6(version) == \
+        (version in SpecifierSet(">=6", prereleases=True))
+    assert ua._pip_1_4(version) == \
+        (version in SpecifierSet(">=1.4,<6", prereleases=True))
+
+
+def test_corpus():
+    for user_agent, expected in _load_corpus():
+        try:
+            result = ua.Parser.parse(user_agent)
+        except ValueError:
+            result = {"error": "ValueError"}
+        except Exception as exc:
+            result = {"error": type(exc).__name__}
+        else:
+            if result is not None:
+                result = {"result": result.serialize()}
+
+        assert result == expected, user_agent
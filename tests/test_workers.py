@@ -0,0 +1,122 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import time
+import urllib.request
+
+import prometheus_client
+import pytest
+
+from linehaul import _workers
+
+
+@pytest.fixture
+def signals():
+    saved = {
+        signum: signal.getsignal(signum)
+        for signum in [signal.SIGINT, signal.SIGTERM]
+    }
+    yield
+    for signum, handler in saved.items():
+        signal.signal(signum, handler)
+
+
+def test_worker_collector(tmpdir):
+    for worker_id, (events, queued) in enumerate([(3, 1), (5, 0)]):
+        registry = prometheus_client.CollectorRegistry()
+        counter = prometheus_client.Counter(
+            "events", "Events.", registry=registry,
+        )
+        gauge = prometheus_client.Gauge(
+            "queued", "Queued.", ["kind"], registry=registry,
+        )
+        counter.inc(events)
+        gauge.labels("a").set(queued)
+
+        _workers.write_metrics(
+            _workers.metrics_path(str(tmpdir), worker_id),
+            registry=registry,
+        )
+
+    families = {
+        family.name: family
+        for family in _workers.WorkerCollector(str(tmpdir)).collect()
+    }
+
+    # Depending on the version of prometheus_client, our counter's sample is
+    # either called events or events_total, and might come with an extra
+    # events_created sample.
+    assert families["events"].type == "counter"
+    assert {
+        labels["worker"]: value
+        for name, labels, value in (s[:3] for s in families["events"].samples)
+        if not name.endswith("_created")
+    } == {"0": 3, "1": 5}
+    assert sorted(
+        (labels["worker"], labels["kind"], value)
+        for name, labels, value in (s[:3] for s in families["queued"].samples)
+    ) == [("0", "a", 1), ("1", "a", 0)]
+
+
+def test_metrics_server():
+    registry = prometheus_client.CollectorRegistry()
+    counter = prometheus_client.Counter(
+        "events", "Events.", registry=registry,
+    )
+    counter.inc(3)
+
+    server = _workers.start_metrics_server(0, "127.0.0.1", registry=registry)
+    port = server.sockets[0].getsockname()[1]
+
+    url = "http://127.0.0.1:{}/metrics".format(port)
+    with urllib.request.urlopen(url) as resp:
+        assert resp.status == 200
+        assert resp.headers["Content-Type"] == (
+            prometheus_client.CONTENT_TYPE_LATEST
+        )
+        body = resp.read()
+
+    assert body == prometheus_client.generate_latest(registry)
+
+
+def test_supervisor_restarts_workers(tmpdir, signals):
+    def target(worker_id):
+        log = tmpdir.join("worker-{}.log".format(worker_id))
+        log.write("x", mode="a")
+
+        # The first time each of our workers run, they'll crash, after which
+        # they'll wait around until we ask them to stop. Once both have been
+        # restarted, we'll tell the supervisor to shut everything down.
+        if len(log.read()) == 1:
+            raise RuntimeError("Crash!")
+
+        tmpdir.join("running-{}".format(worker_id)).write("")
+        if worker_id == 0:
+            while len(tmpdir.listdir(lambda p: "running" in p.basename)) < 2:
+                time.sleep(0.01)
+            os.kill(os.getppid(), signal.SIGTERM)
+
+        time.sleep(30)
+
+    supervisor = _workers.Supervisor(
+        2,
+        target,
+        metrics_dir=str(tmpdir),
+        restart_delay=0,
+    )
+    supervisor.run()
+
+    assert supervisor.workers == {}
+    assert tmpdir.join("worker-0.log").read() == "xx"
+    assert tmpdir.join("worker-1.log").read() == "xx"